@@ -0,0 +1,57 @@
+'''
+Synthetic channel traffic and community rule sets for the benchmark suite.
+'''
+import random
+
+CHAT_WORDS = ("the a to and of you i it is that in for on this we they was have with are be at so "
+              "just like what lol can get do not all my your about know one time good game tonight "
+              "anyone homework class call food later thanks see tomorrow think really new movie "
+              "play team week weekend friends pizza coffee music project lecture exam help").split()
+SCAM_WORDS = ("crypto bitcoin btc eth wallet airdrop giveaway guaranteed profit returns invest "
+              "double send claim bonus exclusive urgent verify account seed phrase limited offer "
+              "mining pump moon signal token presale whitelist").split()
+BENIGN_DOMAINS = ["youtube.com/watch?v={n}", "github.com/user{n}/repo", "docs.google.com/document/d/{n}",
+                  "en.wikipedia.org/wiki/Topic_{n}", "stackoverflow.com/questions/{n}", "reddit.com/r/cs/{n}"]
+SCAM_DOMAINS = ["free-btc-{n}.ru/claim", "wallet-verify{n}.com/login", "airdrop-bonus{n}.io",
+                "hxxps://eth-double{n}[.]net/send", "binance-support{n}.xyz/verify"]
+
+
+def generate_message(rng, mean_length, url_density, spam):
+    words = SCAM_WORDS if spam else CHAT_WORDS
+    target = max(3, int(rng.lognormvariate(0, 0.6) * mean_length))
+    parts = []
+    length = 0
+    while length < target:
+        word = rng.choice(words) if not spam or rng.random() < 0.6 else rng.choice(CHAT_WORDS)
+        parts.append(word)
+        length += len(word) + 1
+    if rng.random() < url_density:
+        pool = SCAM_DOMAINS if spam else BENIGN_DOMAINS
+        # a limited number of distinct links, as in real traffic where the same links are reposted
+        url = rng.choice(pool).format(n=rng.randint(0, 200))
+        parts.insert(rng.randint(0, len(parts)), url)
+    return " ".join(parts)
+
+
+def generate_corpus(size, mean_length=60, url_density=0.1, spam_ratio=0.1, seed=152):
+    '''Returns (message, is_spam) pairs.'''
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        spam = rng.random() < spam_ratio
+        corpus.append((generate_message(rng, mean_length, url_density, spam), spam))
+    return corpus
+
+
+def generate_rules(count, seed=152):
+    '''Distinct one to three word phrases, drawn from a vocabulary wide enough to reach 100k.'''
+    rng = random.Random(seed)
+    vocabulary = CHAT_WORDS + SCAM_WORDS
+    rules = {"free cash", "give money", "crypto"}
+    while len(rules) < count:
+        size = rng.randint(1, 3)
+        phrase = " ".join(rng.choice(vocabulary) for _ in range(size))
+        if size == 1:
+            phrase += str(rng.randint(0, 10 ** 6))  # single common words would match everything
+        rules.add(phrase)
+    return sorted(rules)[:count]
@@ -0,0 +1,64 @@
+'''
+Side-by-side comparison of the scam classifier featurizers: cross-validated accuracy, memory held
+by the fitted featurizer (on the real data and on a corpus padded with synthetic vocabulary), size
+of the fitted model and per-message latency.
+
+Run from the DiscordBot folder:
+    python -m benchmarks.featurizers
+'''
+import pickle
+import random
+import string
+import time
+
+import pandas as pd
+from sklearn.model_selection import StratifiedKFold, cross_val_score
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.pipeline import make_pipeline
+
+from scam_classifier import FEATURIZERS, TRAINING_DATA, make_vectorizer
+
+
+def synthetic_messages(count, seed=152):
+    rng = random.Random(seed)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 10))) for _ in range(count * 2)]
+    return [" ".join(rng.choices(words, k=12)) for _ in range(count)]
+
+
+def featurizer_bytes(featurizer, messages):
+    vectorizer = make_vectorizer(featurizer)
+    vectorizer.fit(messages)
+    return len(pickle.dumps(vectorizer))
+
+
+def model_bytes(featurizer, messages, labels):
+    # MultinomialNB keeps a row of counts per feature, so this is where the hashing width shows up
+    vectorizer = make_vectorizer(featurizer)
+    model = MultinomialNB().fit(vectorizer.fit_transform(messages), labels)
+    return len(pickle.dumps(model))
+
+
+def latency_us(featurizer, messages, labels, repeat=3):
+    pipeline = make_pipeline(make_vectorizer(featurizer), MultinomialNB()).fit(messages, labels)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in messages:
+            pipeline.predict_proba([message])
+        best = min(best, time.perf_counter() - start)
+    return best / len(messages) * 1e6
+
+
+if __name__ == "__main__":
+    data = pd.read_csv(TRAINING_DATA)
+    messages, labels = data["Message"].tolist(), data["Label"].tolist()
+    grown = messages + synthetic_messages(20000)
+    folds = StratifiedKFold(n_splits=5, shuffle=True, random_state=79)
+
+    print(f"{'featurizer':<14}{'accuracy':>10}{'bytes (data)':>15}{'bytes (+20k)':>15}{'model bytes':>14}{'us/message':>12}")
+    for featurizer in FEATURIZERS:
+        pipeline = make_pipeline(make_vectorizer(featurizer), MultinomialNB())
+        accuracy = cross_val_score(pipeline, messages, labels, cv=folds).mean()
+        print(f"{featurizer:<14}{accuracy:>10.3f}{featurizer_bytes(featurizer, messages):>15}"
+              f"{featurizer_bytes(featurizer, grown):>15}{model_bytes(featurizer, messages, labels):>14}"
+              f"{latency_us(featurizer, messages, labels):>12.0f}")
@@ -0,0 +1,223 @@
+'''
+Offline throughput and latency benchmark for the moderation pipeline. Runs every stage on a
+synthetic corpus with VirusTotal replaced by an in-process fake, so no token or network is needed:
+
+    rules       UserRules.get_rules_scores, once per rule-set size
+    classifier  ScamClassier.predict_scam one message at a time, and batched as the bot does
+    links       identify_suspicious_links with a fresh verdict cache, all messages in flight at once
+    eval_text   the full ModerationPipeline, all messages in flight at once
+
+By default the fake answers in-process after --vt-latency seconds. --vt-server runs the link stages
+against fake_virus_total.py over HTTP instead, with its rate limit, 429s and queued analyses.
+
+Results are printed and written to benchmarks/results/<timestamp>-<commit>.json. Pass --compare
+with an earlier results file to see the change per stage.
+
+Run from the DiscordBot folder:
+    python -m benchmarks.suite [--messages 5000] [--rules 10,1000,100000] [--compare results.json]
+    python -m benchmarks.suite --vt-server --vt-rate-limit 600 --vt-error-rate 0.01 --vt-queued-for 0.5
+'''
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import suspicious_link_detection
+from benchmarks.corpus import generate_corpus, generate_rules
+from blocklist import DomainBlocklist
+from fake_virus_total import FakeVirusTotal
+from micro_batcher import MicroBatcher
+from pipeline import ModerationPipeline
+from rate_limiter import ScanScheduler, TokenBucket
+from rules_store import RulesStore
+from scam_classifier import ScamClassier
+from suspicious_link_detection import configure_link_checker, identify_suspicious_links
+from url_cache import VerdictCache
+from user_rules import UserRules
+
+RESULTS_DIR = os.path.join("benchmarks", "results")
+BATCH_SIZE = 64
+
+
+def fake_virus_total(latency):
+    '''Deterministic verdicts from a hash of the url: about 5% malicious and 5% suspicious.'''
+    async def check_with_virus_total(url, virus_total_token):
+        await asyncio.sleep(latency)
+        bucket = hashlib.blake2b(url.encode(), digest_size=1).digest()[0] % 20
+        if bucket == 0:
+            return {"malicious": 5, "suspicious": 1, "harmless": 60, "undetected": 10}
+        if bucket == 1:
+            return {"malicious": 0, "suspicious": 50, "harmless": 10, "undetected": 10}
+        return {"malicious": 0, "suspicious": 0, "harmless": 70, "undetected": 10}
+    return check_with_virus_total
+
+
+def summarize(latencies, elapsed):
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+
+    return {
+        "messages": len(ordered),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "messages_per_second": len(ordered) / elapsed,
+    }
+
+
+def measure(fn, messages):
+    latencies = []
+    start = time.perf_counter()
+    for message in messages:
+        begin = time.perf_counter()
+        fn(message)
+        latencies.append(time.perf_counter() - begin)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def measure_batched(fn, messages, batch_size=BATCH_SIZE):
+    # every message in a batch waits for the whole batch
+    latencies = []
+    start = time.perf_counter()
+    for i in range(0, len(messages), batch_size):
+        batch = messages[i:i + batch_size]
+        begin = time.perf_counter()
+        fn(batch)
+        latencies += [time.perf_counter() - begin] * len(batch)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def measure_concurrent(coroutine, messages):
+    async def timed(message):
+        begin = time.perf_counter()
+        await coroutine(message)
+        return time.perf_counter() - begin
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(timed(message) for message in messages))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def isolate_link_checker(workdir):
+    # a fresh cache and blocklist per run, and a bucket the fake never runs out of
+    os.makedirs(workdir, exist_ok=True)
+    configure_link_checker(verdict_cache=VerdictCache(os.path.join(workdir, "url_cache.db")),
+                           blocklist=DomainBlocklist(os.path.join(workdir, "blocklist.txt")),
+                           scheduler=ScanScheduler(TokenBucket(rate=1e6, capacity=1e6), workers=64, max_queue=10 ** 6))
+
+
+def bench_rules(rule_counts, messages, workdir):
+    results = {}
+    for count in rule_counts:
+        store = RulesStore(os.path.join(workdir, f"rules-{count}.db"))
+        store.add_rules("benchmark", generate_rules(count))
+        start = time.perf_counter()
+        user_rules = UserRules(None, store=store)
+        build_ms = (time.perf_counter() - start) * 1000
+        results[f"rules[{count}]"] = dict(measure(user_rules.get_rules_scores, messages), build_ms=build_ms)
+        store.close()
+    return results, user_rules
+
+
+async def bench_async(messages, classifier, user_rules, workdir, server=None):
+    def score_messages(batch):
+        probabilities = classifier.predict_scam_proba_batch(batch)
+        return [{"scam_probability": probability, "rules": user_rules.get_rules_scores(message).get("rules", [])}
+                for message, probability in zip(batch, probabilities)]
+
+    if server is not None:
+        configure_link_checker(endpoint=await server.start())
+    isolate_link_checker(os.path.join(workdir, "links"))
+    links = await measure_concurrent(lambda message: identify_suspicious_links(message, "fake-token"), messages)
+    await suspicious_link_detection.close_link_checker()
+
+    isolate_link_checker(os.path.join(workdir, "eval_text"))
+    pipeline = ModerationPipeline(MicroBatcher(score_messages).submit, classifier, "fake-token")
+    eval_text = await measure_concurrent(pipeline.evaluate, messages)
+    await suspicious_link_detection.close_link_checker()
+    if server is not None:
+        await server.close()
+        print(f"Fake VirusTotal answered {server.requests} requests, {server.rate_limited} with a 429")
+    return {"links": links, "eval_text": eval_text}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(stages, baseline=None):
+    print(f"{'stage':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}{'msgs/s':>12}"
+          + (f"{'vs base':>10}" if baseline else ""))
+    for stage, result in stages.items():
+        line = (f"{stage:<18}{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+                f"{result['mean_ms']:>10.3f}{result['messages_per_second']:>12.0f}")
+        if baseline and stage in baseline:
+            change = result['messages_per_second'] / baseline[stage]['messages_per_second'] - 1
+            line += f"{change:>+10.1%}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark for the moderation pipeline.")
+    parser.add_argument("--messages", type=int, default=5000, help="corpus size")
+    parser.add_argument("--length", type=int, default=60, help="mean message length in characters")
+    parser.add_argument("--url-density", type=float, default=0.1, help="share of messages with a link")
+    parser.add_argument("--spam-ratio", type=float, default=0.1)
+    parser.add_argument("--rules", default="10,1000,100000", help="comma separated rule-set sizes")
+    parser.add_argument("--vt-latency", type=float, default=0.2, help="seconds the fake VirusTotal takes per check")
+    parser.add_argument("--vt-server", action="store_true", help="check links against fake_virus_total.py over HTTP")
+    parser.add_argument("--vt-rate-limit", type=int, default=0, help="fake server requests per minute")
+    parser.add_argument("--vt-error-rate", type=float, default=0.0, help="share of fake server requests answered with a 429")
+    parser.add_argument("--vt-queued-for", type=float, default=0.0, help="seconds fake server analyses stay queued")
+    parser.add_argument("--seed", type=int, default=152)
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    params = {k: v for k, v in vars(args).items() if k not in ("compare", "no_save")}
+    rule_counts = [int(count) for count in args.rules.split(",")]
+    messages = [message for message, _ in generate_corpus(args.messages, args.length, args.url_density,
+                                                          args.spam_ratio, args.seed)]
+    server = None
+    if args.vt_server:
+        server = FakeVirusTotal(latency=args.vt_latency / 2, rate_limit=args.vt_rate_limit,  # two requests a check
+                                error_rate=args.vt_error_rate, queued_for=args.vt_queued_for, seed=args.seed)
+        suspicious_link_detection.ANALYSIS_POLL_SECONDS = args.vt_queued_for
+    else:
+        suspicious_link_detection.check_with_virus_total = fake_virus_total(args.vt_latency)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        stages, user_rules = bench_rules(rule_counts, messages, workdir)
+        classifier = ScamClassier()
+        stages["classifier"] = measure(classifier.predict_scam, messages)
+        stages["classifier_batch"] = measure_batched(classifier.predict_scam_proba_batch, messages)
+        # the async stages run with the largest rule set
+        stages.update(asyncio.run(bench_async(messages, classifier, user_rules, workdir, server)))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["stages"]
+    print_results(stages, baseline)
+
+    if not args.no_save:
+        commit = git_commit()
+        results = {"commit": commit, "run_at": datetime.now().isoformat(timespec="seconds"),
+                   "params": params, "stages": stages}
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{commit}.json")
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved {path}")
@@ -0,0 +1,61 @@
+'''
+Compares url extraction in identify_suspicious_links before and after url_extractor.
+
+Run from the DiscordBot folder:
+    python -m benchmarks.url_extraction
+'''
+import csv
+import random
+import re
+import time
+
+from url_extractor import extract_urls
+
+CHAT = ["gm everyone", "anyone up for a game tonight?", "lol that's wild", "thanks!! see you tomorrow",
+        "has anyone finished the homework", "I think the answer is 42", "brb getting food",
+        "check out my new setup", "who's joining the call", "that movie was so good"]
+LINKS = ["https://www.youtube.com/watch?v=dQw4w9WgXcQ", "github.com/stanfordio/cs152bots",
+         "free-nitro-giveaway.ru/claim", "hxxps://wallet-verify[.]com/login", "http://bit.ly/3xYz",
+         "docs.google.com/document/d/abc/edit", "https://binance-airdrop.io:443/bonus?ref=42"]
+
+
+def legacy_extract(message):
+    # the regex identify_suspicious_links compiled on every call before url_extractor
+    url_pattern = re.compile(
+        r'\b((http|https)://)?(www\.)?([a-zA-Z0-9-]+(\.[a-zA-Z]{2,})+)(/[a-zA-Z0-9@:%_\+.~#?&//=,-]*)?\b')
+    return [match.group(0) for match in url_pattern.finditer(message)]
+
+
+def build_corpus(size=20000, link_ratio=0.1, seed=152):
+    rng = random.Random(seed)
+    with open("crypto_data.csv", encoding="utf-8-sig") as f:
+        dataset = [row["Message"] for row in csv.DictReader(f)]
+    corpus = []
+    for _ in range(size):
+        roll = rng.random()
+        if roll < link_ratio:
+            corpus.append(f"{rng.choice(CHAT)} {rng.choice(LINKS)}")
+        elif roll < 0.3:
+            corpus.append(rng.choice(dataset))
+        else:
+            corpus.append(rng.choice(CHAT))
+    return corpus
+
+
+def bench(fn, corpus, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in corpus:
+            fn(message)
+        best = min(best, time.perf_counter() - start)
+    return best / len(corpus) * 1e6
+
+
+if __name__ == "__main__":
+    corpus = build_corpus()
+    legacy = bench(legacy_extract, corpus)
+    current = bench(extract_urls, corpus)
+    print(f"{len(corpus)} messages")
+    print(f"legacy regex:   {legacy:.2f} us/message")
+    print(f"url_extractor:  {current:.2f} us/message ({legacy / current:.1f}x)")
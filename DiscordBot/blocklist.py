@@ -0,0 +1,130 @@
+import os
+import time
+from urllib.parse import urlsplit
+
+BLOCKLIST_FILE = "blocklist.txt"
+# How often to look for entries other bot processes appended to the file
+RELOAD_CHECK_SECONDS = 5
+
+_END = ""  # marks a blocked domain in the trie, never a valid label
+
+
+def split_url(url):
+    '''Returns the lowercased host (without www.) and the rest of the url, ignoring the scheme.'''
+    if "://" not in url:
+        url = "http://" + url
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    rest = parts.path.rstrip("/")
+    if parts.query:
+        rest += "?" + parts.query
+    return host, rest
+
+
+class DomainBlocklist:
+    '''
+    Blocked urls and domains. Urls are matched exactly (ignoring scheme and www.) through a set,
+    domains through a trie of reversed labels so a blocked domain also covers its subdomains.
+    Entries are appended to a plain text file, one "domain <name>" or "url <url>" per line.
+    Lines other processes append (bots running other shards) are picked up every few seconds.
+    Large external feeds are consulted through prebuilt indexes (see blocklist_index.py).
+    '''
+
+    def __init__(self, path=BLOCKLIST_FILE, indexes=()):
+        self.path = path
+        self.indexes = list(indexes)
+        self._urls = set()
+        self._domains = {}
+        self.num_domains = 0
+        self._offset = 0  # bytes of the file read so far
+        self._checked_at = 0
+        self.reload()
+
+    def reload(self):
+        '''Reads the lines appended to the file since the last call.'''
+        self._checked_at = time.monotonic()
+        if not os.path.isfile(self.path) or os.path.getsize(self.path) <= self._offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        # a line still being written is left for the next call
+        data = data[:data.rfind(b"\n") + 1]
+        self._offset += len(data)
+        for line in data.decode().splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            kind, _, value = line.partition(" ")
+            if kind == "domain":
+                self._add_domain(value)
+            elif kind == "url":
+                self._add_url(value)
+
+    def _add_domain(self, domain):
+        node = self._domains
+        for label in reversed(domain.lower().strip(".").split(".")):
+            node = node.setdefault(label, {})
+        if _END in node:
+            return False
+        node[_END] = True
+        self.num_domains += 1
+        return True
+
+    def _add_url(self, url):
+        key = "".join(split_url(url))
+        if key in self._urls:
+            return False
+        self._urls.add(key)
+        return True
+
+    def _append(self, kind, value):
+        with open(self.path, "a") as f:
+            f.write(f"{kind} {value}\n")
+
+    def add_domain(self, domain):
+        domain = split_url(domain)[0]
+        if domain and self._add_domain(domain):
+            self._append("domain", domain)
+
+    def add_url(self, url):
+        if self._add_url(url):
+            self._append("url", url)
+
+    def match_domain(self, host):
+        node = self._domains
+        labels = host.split(".")
+        for i in range(len(labels) - 1, -1, -1):
+            node = node.get(labels[i])
+            if node is None:
+                return None
+            if _END in node:
+                return ".".join(labels[i:])
+        return None
+
+    def match(self, url):
+        '''Returns the blocklist entry that covers the url, or None.'''
+        if time.monotonic() - self._checked_at >= RELOAD_CHECK_SECONDS:
+            self.reload()
+        host, rest = split_url(url)
+        if host + rest in self._urls:
+            return host + rest
+        match = self.match_domain(host)
+        if match is None:
+            for index in self.indexes:
+                match = index.match_domain(host)
+                if match is not None:
+                    break
+        return match
+
+    def __contains__(self, url):
+        return self.match(url) is not None
+
+    def __len__(self):
+        return len(self._urls) + self.num_domains
+
+    def close(self):
+        for index in self.indexes:
+            index.close()
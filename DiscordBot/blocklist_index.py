@@ -0,0 +1,175 @@
+'''
+Compact on-disk index of externally maintained domain blocklists (hosts files, plain domain lists).
+
+Build it offline:
+    python blocklist_index.py build -o blocklist.idx phishing_hosts.txt crypto_scams.txt
+    python blocklist_index.py build --format bloom --fp-rate 0.0001 -o blocklist.idx feeds/*.txt
+
+The bot opens the file with mmap on the first lookup, so every bot process on the host shares the
+same read-only pages instead of holding millions of strings in memory.
+
+"sorted" stores the sorted 64-bit hash of every domain and answers with a binary search (8 bytes a
+domain, collisions are negligible). "bloom" stores a Bloom filter sized for the requested false
+positive rate, which is smaller still for very large feeds.
+'''
+import argparse
+import hashlib
+import math
+import mmap
+import os
+import struct
+
+from blocklist import split_url
+
+MAGIC = b"BLKIDX01"
+FORMAT_SORTED = 1
+FORMAT_BLOOM = 2
+HEADER = struct.Struct("<8sIIQQ")  # magic, format, bloom hash count, entry count, bloom bit count
+ENTRY = struct.Struct("<Q")
+
+HOSTS_ADDRESSES = {"0.0.0.0", "127.0.0.1", "::", "::1"}
+IGNORED_DOMAINS = {"localhost", "localhost.localdomain", "local", "broadcasthost", "0.0.0.0"}
+
+
+def parse_feed_line(line):
+    '''Returns the domain listed on a hosts file or plain domain list line, or None.'''
+    line = line.split("#", 1)[0].strip()
+    if not line:
+        return None
+    fields = line.split()
+    if len(fields) > 1 and fields[0] in HOSTS_ADDRESSES:
+        domain = fields[1]
+    elif len(fields) == 1:
+        domain = fields[0]
+    else:
+        return None
+    if domain.startswith("||"):  # adblock style "||evil.com^"
+        domain = domain[2:].rstrip("^")
+    domain = split_url(domain)[0]
+    if not domain or domain in IGNORED_DOMAINS or "." not in domain:
+        return None
+    try:
+        return domain.encode("idna").decode("ascii")
+    except UnicodeError:
+        return None
+
+
+def domain_hash(domain):
+    return int.from_bytes(hashlib.blake2b(domain.encode(), digest_size=8).digest(), "little")
+
+
+def _bloom_positions(domain, num_bits, num_hashes):
+    digest = hashlib.blake2b(domain.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return [(h1 + i * h2) % num_bits for i in range(num_hashes)]
+
+
+def read_feeds(paths):
+    for path in paths:
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                domain = parse_feed_line(line)
+                if domain:
+                    yield domain
+
+
+def build_index(paths, output, index_format="sorted", fp_rate=0.001):
+    hashes = sorted({domain_hash(domain) for domain in read_feeds(paths)})
+    count = len(hashes)
+    tmp = output + ".tmp"
+    with open(tmp, "wb") as f:
+        if index_format == "sorted":
+            f.write(HEADER.pack(MAGIC, FORMAT_SORTED, 0, count, 0))
+            for h in hashes:
+                f.write(ENTRY.pack(h))
+        else:
+            num_bits = max(8, math.ceil(-max(count, 1) * math.log(fp_rate) / math.log(2) ** 2))
+            num_hashes = max(1, round(num_bits / max(count, 1) * math.log(2)))
+            bits = bytearray((num_bits + 7) // 8)
+            for domain in read_feeds(paths):
+                for pos in _bloom_positions(domain, num_bits, num_hashes):
+                    bits[pos >> 3] |= 1 << (pos & 7)
+            f.write(HEADER.pack(MAGIC, FORMAT_BLOOM, num_hashes, count, num_bits))
+            f.write(bits)
+    # swap the file in atomically so running bots never map a half written index
+    os.replace(tmp, output)
+    return count
+
+
+class BlocklistIndex:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._mm = None
+
+    def _open(self):
+        self._file = open(self.path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.format, self.num_hashes, self.count, self.num_bits = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a blocklist index")
+
+    def _contains_hash(self, h):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = ENTRY.unpack_from(self._mm, HEADER.size + mid * ENTRY.size)[0]
+            if value < h:
+                lo = mid + 1
+            elif value > h:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def _bloom_contains(self, domain):
+        for pos in _bloom_positions(domain, self.num_bits, self.num_hashes):
+            if not self._mm[HEADER.size + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def contains_domain(self, domain):
+        if self._mm is None:
+            self._open()
+        if self.format == FORMAT_SORTED:
+            return self._contains_hash(domain_hash(domain))
+        return self._bloom_contains(domain)
+
+    def match_domain(self, host):
+        '''Returns the listed domain covering host (the host itself or a parent domain), or None.'''
+        labels = host.split(".")
+        for i in range(len(labels) - 1):
+            domain = ".".join(labels[i:])
+            if self.contains_domain(domain):
+                return domain
+        return None
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+        self._mm = None
+        self._file = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query an external blocklist index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="import hosts files / domain lists into an index")
+    build.add_argument("feeds", nargs="+")
+    build.add_argument("-o", "--output", default="blocklist.idx")
+    build.add_argument("--format", choices=["sorted", "bloom"], default="sorted")
+    build.add_argument("--fp-rate", type=float, default=0.001, help="false positive rate of the bloom filter")
+    check = subparsers.add_parser("check", help="look urls up in an index")
+    check.add_argument("index")
+    check.add_argument("urls", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        count = build_index(args.feeds, args.output, args.format, args.fp_rate)
+        print(f"Indexed {count} domains into {args.output} ({os.path.getsize(args.output)} bytes)")
+    else:
+        index = BlocklistIndex(args.index)
+        for url in args.urls:
+            print(f"{url}: {index.match_domain(split_url(url)[0]) or 'not listed'}")
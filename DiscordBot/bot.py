@@ -7,32 +7,72 @@ import json
 import logging
 import re
 import requests
+import time
 
-from user_rules import UserRules
+from user_rules import FAKE_DB, UserRules, MATCH_WHOLE_WORDS
 from scam_classifier import ScamClassier
+from scoring_pool import ScoringPool
+from pipeline import NETWORK_STAGES, PIPELINE_STAGES
+from metrics import (ACTIVE_REPORTS, GUILD_STATES, MOD_CHANNEL_SENDS, NEAR_DUPLICATE_CLUSTERS, NEAR_DUPLICATE_MATCHES,
+                     PENDING_CASES, REPORT_SESSIONS_BYTES, SCORING_SECONDS, THROTTLED_MESSAGES, WAIT_FOR_SECONDS,
+                     log_summary, serve_metrics)
 from report import Report
+from rules_store import RulesStore
+from flood_detector import BUSY, FLOOD
+from guild_config import GuildConfig
+from guild_state import GuildState
+from session_store import SessionStore
 from discord.components import SelectOption
 from discord.ui import Select, View, Button
 from datetime import datetime
 import re
-from suspicious_link_detection import identify_suspicious_links
+from suspicious_link_detection import close_link_checker, configure_link_checker, get_blocklist
+from rate_limiter import PRIORITY_AUTOMATED, PRIORITY_USER_REPORT
 
-# Set up logging to the console
 logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
-
-# There should be a file called 'tokens.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
-    tokens = json.load(f)
-    discord_token = tokens['discord']
-    virus_total_token = tokens['virus_total']
+
+# Number of worker processes scoring messages (rules + classifier), 0 scores on the event loop
+SCORING_WORKERS = 0
+# Local port for the text format /metrics endpoint (None to disable) and how often to log a
+# metrics summary (0 to disable)
+METRICS_PORT = 9152
+METRICS_LOG_INTERVAL_SECONDS = 0
+# In-progress reports are kept here so they survive a restart (None keeps them in memory only)
+REPORT_SESSIONS_DB = "report_sessions.db"
+# Mod channel commands listing the open cases and re-posting the one to review next
+QUEUE_KEYWORD = "queue"
+NEXT_KEYWORD = "next"
+QUEUE_LISTING_SIZE = 10
+# Servers listed when a "rules" DM does not say which one it is about
+MAX_LISTED_GUILDS = 10
+# Duplicate reports update the case's mod channel post at most this often
+CASE_POST_EDIT_INTERVAL_SECONDS = 5
+
+
+def setup_logging():
+    # Set up logging to the console
+    logger.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+    logger.addHandler(handler)
+
+
+def load_tokens():
+    # There should be a file called 'tokens.json' inside the same folder as this file
+    token_path = 'tokens.json'
+    if not os.path.isfile(token_path):
+        raise Exception(f"{token_path} not found!")
+    with open(token_path) as f:
+        # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
+        return json.load(f)
+
+# Report reasons whose confirmed verdicts are fed back into the scam classifier
+SCAM_REPORT_REASONS = ["Investment Scam", "Suspected Cryptocurrency Scam", "Blackmail"]
+
+
+def is_scam_report(report_reason):
+    return any(reason in (report_reason or "") for reason in SCAM_REPORT_REASONS)
+
 
 def predetermine_action(report_reason, user_client, user):
     actions = {"Ban User": False, "Remove Post": False, "Report User to Discord": False, "Place User on Probation": False}
@@ -61,13 +101,26 @@ def predetermine_action(report_reason, user_client, user):
 
     return actions
 
+
+async def notify_authors(authors, values):
+    for author in authors:
+        if "Actor has been banned" in values:
+            await author.send("You have been banned from the Trust and Safety - Spring 2024 server.")
+        elif "Actor has been placed on temporary probation" in values:
+            await author.send("Your account has been put on temporary probabtion and will have limited access to features due to policy violations.")
+
+
+def accounts_note(case):
+    authors = len(case.authors())
+    return f" Applied to {authors} accounts." if authors > 1 else ""
+
 class ModeratorActionDropdown(Select):
-    def __init__(self, mod_channel, reported_message, user_client):
+    def __init__(self, mod_channel, case, user_client):
         super().__init__(placeholder="What actions do you want to take?", min_values=1, max_values=4)
         self.mod_channel = mod_channel
-        self.reported_message = reported_message
+        self.case = case
         self.user_client = user_client
-        actions = predetermine_action(reported_message.get("report_reason"), self.user_client, self.reported_message.get("message").author.id)
+        actions = predetermine_action(case.report_reason, self.user_client, self.case.message.author.id)
         self.add_option(default=actions["Ban User"], label="Ban User", description="Ban the actor from the server", value="Actor has been banned")
         self.add_option(default=actions["Remove Post"], label="Remove Post", description="Remove the post from the channel", value="Post has been removed")
         self.add_option(default=actions["Report User to Discord"], label="Report User to Discord", description="Report the User to Discord", value="Actor has been reported to Discord")
@@ -75,45 +128,47 @@ class ModeratorActionDropdown(Select):
         self.add_option(label="No action required", description="Report was false or no action needed", value="No action taken")
 
     async def callback(self, interaction):
-        self.user_client.update_user_offenses(self.reported_message.get("message").author.id)
-        if "Actor has been banned" in self.values:
-            await self.reported_message.get("message").author.send("You have been banned from the Trust and Safety - Spring 2024 server.")
-        elif "Actor has been placed on temporary probation" in self.values:
-            await self.reported_message.get("message").author.send("Your account has been put on temporary probabtion and will have limited access to features due to policy violations.")
+        interaction.client.close_case(self.case, [] if self.values == ["No action taken"] else self.values)
+        for author in self.case.authors():
+            self.user_client.update_user_offenses(author.id)
+        if self.values == ["No action taken"]:
+            await interaction.client.record_verdict(self.case.message, False)
+        elif is_scam_report(self.case.report_reason):
+            await interaction.client.record_verdict(self.case.message, True)
+        await notify_authors(self.case.authors(), self.values)
         if self.values[0] == "No action required":
             action_status = "No actions were taken. Thank you for moderating this report!"
         else:
-            action_status = f'Actions taken: {", ".join(self.values)}. Thank you for moderating this report!'
-        await self.mod_channel.send(action_status)
+            action_status = f'Actions taken: {", ".join(self.values)}.{accounts_note(self.case)} Thank you for moderating this report!'
+        await interaction.client.send_to_mod_channel(self.mod_channel, action_status)
         await interaction.response.defer()
 
 class ConfirmButton(Button):
-    def __init__(self, mod_channel, reported_message, user_client):
+    def __init__(self, mod_channel, case, user_client):
         super().__init__(label="Confirm Action(s)")
         self.mod_channel = mod_channel
-        self.reported_message = reported_message
+        self.case = case
         self.user_client = user_client
-        self.actions = predetermine_action(reported_message.get("report_reason"), self.user_client, self.reported_message.get("message").author.id)
+        self.actions = predetermine_action(case.report_reason, self.user_client, self.case.message.author.id)
 
     async def callback(self, interaction):
-        self.user_client.update_user_offenses(self.reported_message.get("message").author.id)
         action_str = {"Ban User": "Actor has been banned", "Remove Post": "Post has been removed", "Report User to Discord": "Actor has been reported to Discord", "Place User on Probation": "Actor has been placed on temporary probation"}
-        if self.actions["Ban User"]:
-            await self.reported_message.get("message").author.send(
-                "You have been banned from the Trust and Safety - Spring 2024 server.")
-        elif self.actions["Place User on Probation"]:
-            await self.reported_message.get("message").author.send(
-                "Your account has been put on temporary probabtion and will have limited access to features due to policy violations.")
         values = [action_str[action] for action in self.actions if self.actions[action]]
-        action_status = f'Actions taken: {", ".join(values)}. Thank you for moderating this report!'
-        await self.mod_channel.send(action_status)
+        interaction.client.close_case(self.case, values)
+        for author in self.case.authors():
+            self.user_client.update_user_offenses(author.id)
+        if is_scam_report(self.case.report_reason):
+            await interaction.client.record_verdict(self.case.message, True)
+        await notify_authors(self.case.authors(), values)
+        action_status = f'Actions taken: {", ".join(values)}.{accounts_note(self.case)} Thank you for moderating this report!'
+        await interaction.client.send_to_mod_channel(self.mod_channel, action_status)
         await interaction.response.defer()
     
 class LegitimacyDropdown(Select):
-    def __init__(self, mod_channel, reported_message, user_client):
+    def __init__(self, mod_channel, case, user_client):
         super().__init__(placeholder="Select one", min_values=1, max_values=1)
         self.mod_channel = mod_channel
-        self.reported_message = reported_message
+        self.case = case
         self.user_client = user_client
         self.add_option(label="Yes", description="The report reason is appropriate", value="legitimate")
         self.add_option(label="No, revision required", description="The report reason needs to be revised", value="update required")
@@ -122,54 +177,65 @@ class LegitimacyDropdown(Select):
     async def callback(self, interaction):
         await interaction.response.defer()
         if self.values[0] == 'not legitimate':
-            await self.mod_channel.send("The content was falsely reported. No further action is required. Thank you for moderating this report!")
+            interaction.client.close_case(self.case, [])
+            await interaction.client.record_verdict(self.case.message, False)
+            await interaction.client.send_to_mod_channel(self.mod_channel, "The content was falsely reported. No further action is required. Thank you for moderating this report!")
         else:
             if self.values[0] == "update required":
                 prompt_message = "\n\nPlease specify the appropriate abuse type"
-                await self.mod_channel.send(prompt_message)
+                await interaction.client.send_to_mod_channel(self.mod_channel, prompt_message)
                 message = await interaction.client.wait_for_report_reason_update(self.mod_channel, interaction.user)
-                self.reported_message["report_reason"] = message
+                self.case.report_reason = message
             else:
-                await self.mod_channel.send("\nReport reason is confirmed.")
-                if "Imminent Danger" in self.reported_message.get("report_reason") or "Threat to do Physical Harm" in self.reported_message.get("report_reason") or "Assets Sent" in self.reported_message.get("report_reason"):
+                await interaction.client.send_to_mod_channel(self.mod_channel, "\nReport reason is confirmed.")
+                if is_scam_report(self.case.report_reason):
+                    await interaction.client.record_verdict(self.case.message, True)
+                if "Imminent Danger" in self.case.report_reason or "Threat to do Physical Harm" in self.case.report_reason or "Assets Sent" in self.case.report_reason:
                     prompt_message = "\n\nPlease type a message that can be sent to the authorities regarding this case."
-                    await self.mod_channel.send(prompt_message)
+                    await interaction.client.send_to_mod_channel(self.mod_channel, prompt_message)
                     await interaction.client.wait_for_user_reply(self.mod_channel, interaction.user, f"Thank you for your response, {interaction.user}. A report has been filed with the authorities. Please wait for further instructions.")
-                elif "Suspicious Link" in self.reported_message.get("report_reason"):
-                    scores = interaction.client.eval_text(self.reported_message.get("message").content)
-                    await interaction.client.handle_malicious_link(self.reported_message.get("message").content, scores, self.mod_channel, False)
-            if not "Suspicious Link" in self.reported_message.get("report_reason"):
-                view = View()
-                view.add_item(ModeratorActionDropdown(self.mod_channel, self.reported_message, self.user_client))
-                view.add_item(ConfirmButton(self.mod_channel, self.reported_message, self.user_client))
-                await self.mod_channel.send("\n\nPlease select the action(s) you want to take. If you would like to proceed with the preselected, recommended actions, press 'Confirm Action(s)'. If not, please update the selection of appropriate actions.", view=view)
+                elif "Suspicious Link" in self.case.report_reason:
+                    scores = await interaction.client.evaluate_case(self.case, priority=PRIORITY_USER_REPORT, stages=["blocklist", "links"])
+                    await interaction.client.handle_malicious_link(self.case, scores or {}, self.mod_channel, False)
+            if not "Suspicious Link" in self.case.report_reason:
+                await interaction.client.post_case(self.case, self.mod_channel, "\n\nPlease select the action(s) you want to take. If you would like to proceed with the preselected, recommended actions, press 'Confirm Action(s)'. If not, please update the selection of appropriate actions.",
+                                                   lambda: create_action_view(self.mod_channel, self.case, self.user_client))
 
 class MaliciousLinkDropdown(Select):
-    def __init__(self, mod_channel, reported_message, user_client):
+    def __init__(self, mod_channel, case, user_client, urls):
         super().__init__(placeholder="Is the link malicious?", min_values=1, max_values=1)
         self.mod_channel = mod_channel
-        self.reported_message = reported_message
+        self.case = case
         self.user_client = user_client
+        self.urls = urls
         self.add_option(label="Yes", description="The link is malicious", value="yes")
+        self.add_option(label="Yes, block the whole site", description="Every link to this domain is malicious", value="domain")
         self.add_option(label="No", description="The link is not malicious", value="no")
 
     async def callback(self, interaction):
         await interaction.response.defer()
         action_message = "\n\nPlease select the action(s) you want to take. If you would like to proceed with the preselected, recommended actions, press 'Confirm Action(s)'. If not, please update the selection of appropriate actions."
-        view = View()
-        view.add_item(ModeratorActionDropdown(self.mod_channel, self.reported_message, self.user_client))
-        view.add_item(ConfirmButton(self.mod_channel, self.reported_message, self.user_client))
-        if self.values[0] == 'yes':
-            await self.mod_channel.send(
-                "Link is marked as malicious and has been added to our internal blacklist." + action_message,
-                view=view)
+        malicious = self.values[0] != 'no'
+        await interaction.client.record_verdict(self.case.message, malicious)
+        if malicious:
+            # only the confirmed link is blocked, shared hosts like bit.ly or docs.google.com stay usable
+            # unless a moderator explicitly blocks the whole domain
+            for url in self.urls:
+                if self.values[0] == 'domain':
+                    get_blocklist().add_domain(url)
+                else:
+                    get_blocklist().add_url(url)
+            await interaction.client.post_case(
+                self.case, self.mod_channel, "Link is marked as malicious and has been added to our internal blacklist." + action_message,
+                lambda: create_action_view(self.mod_channel, self.case, self.user_client))
         else:
-            await self.mod_channel.send(
-                "Link was deemed not malicious. No further action is required. Thank you for moderating this report!")
+            interaction.client.close_case(self.case, [])
+            await interaction.client.send_to_mod_channel(
+                self.mod_channel, "Link was deemed not malicious. No further action is required. Thank you for moderating this report!")
 
 
 class ReportReasonDropdown(Select):
-    def __init__(self, mod_channel, reported_message):
+    def __init__(self, mod_channel, case):
         options = [
             SelectOption(emoji="📫", label='Blackmail', value='Blackmail',
                          description="You are being threatened to send cryptocurrency"),
@@ -184,45 +250,86 @@ class ReportReasonDropdown(Select):
         ]
         super().__init__(placeholder='Update the reporting reason', min_values=1, max_values=1, options=options)
         self.mod_channel = mod_channel
-        self.reported_message = reported_message
+        self.case = case
 
     async def callback(self, interaction):
         report_status = f'Report reason has been updated to: {self.values[0]}'
-        await self.mod_channel.send(report_status)
+        await interaction.client.send_to_mod_channel(self.mod_channel, report_status)
         await interaction.response.defer()
-        if "Imminent Danger" in self.reported_message.get(
-                "report_reason") or "Threat to do Physical Harm" in self.reported_message.get(
-                "report_reason") or "Assets Sent" in self.reported_message.get("report_reason"):
+        if "Imminent Danger" in self.case.report_reason or "Threat to do Physical Harm" in self.case.report_reason or "Assets Sent" in self.case.report_reason:
             prompt_message = "Please type a message that can be sent to the authorities regarding this case."
-            await self.mod_channel.send(prompt_message)
+            await interaction.client.send_to_mod_channel(self.mod_channel, prompt_message)
             await interaction.client.wait_for_user_reply(self.mod_channel, interaction.user,
                                                          f"Thank you for your response, {interaction.user}. A report has been filed with the authorities. Please wait for further instructions.")
 
         action_view = View()
-        action_view.add_item(ModeratorActionDropdown(self.mod_channel, self.reported_message))
-        await self.mod_channel.send(
-            "\n\nPlease select the action(s) you want to take. If you would like to proceed with the preselected, recommended actions, press 'Confirm Action(s)'. If not, please update the selection of appropriate actions.",
+        action_view.add_item(ModeratorActionDropdown(self.mod_channel, self.case))
+        await interaction.client.send_to_mod_channel(
+            self.mod_channel, "\n\nPlease select the action(s) you want to take. If you would like to proceed with the preselected, recommended actions, press 'Confirm Action(s)'. If not, please update the selection of appropriate actions.",
             view=action_view)
 
 
 
-def create_legitimacy_view(mod_channel, reported_message, user_client):
+def create_legitimacy_view(mod_channel, case, user_client):
+    view = View()
+    view.add_item(LegitimacyDropdown(mod_channel, case, user_client))
+    return view
+
+
+def create_action_view(mod_channel, case, user_client, confirm=True):
+    view = View()
+    view.add_item(ModeratorActionDropdown(mod_channel, case, user_client))
+    if confirm:
+        view.add_item(ConfirmButton(mod_channel, case, user_client))
+    return view
+
+
+def create_malicious_link_view(mod_channel, case, user_client, urls):
     view = View()
-    view.add_item(LegitimacyDropdown(mod_channel, reported_message, user_client))
+    view.add_item(MaliciousLinkDropdown(mod_channel, case, user_client, urls))
     return view
 
 
-class ModBot(discord.Client):
-    def __init__(self):
+class ModBot(discord.AutoShardedClient):
+    def __init__(self, virus_total_token=None, scoring_workers=SCORING_WORKERS, virus_total_endpoint=None,
+                 metrics_port=METRICS_PORT, metrics_log_interval=METRICS_LOG_INTERVAL_SECONDS,
+                 shard_count=None, shard_ids=None, guild_config=None):
         intents = discord.Intents.default()
         intents.message_content = True
-        super().__init__(command_prefix='.', intents=intents)
+        # without shard_ids every shard runs in this process, with them several processes split the guilds
+        super().__init__(command_prefix='.', intents=intents, shard_count=shard_count, shard_ids=shard_ids)
         self.group_num = None
-        self.mod_channels = {}  # Map from guild to the mod channel id for that guild
-        self.reports = {}  # Map from user IDs to the state of their report
-        self.user_rules = UserRules(self)
-        self.reported_message = None
+        self.guild_config = guild_config or GuildConfig()  # channel routing, see guild_config.py
+        self.guild_states = {}  # Map from guild id to everything kept for that guild, see guild_state.py
+        self.rules_stores = {}  # Map from rules db path to its store, shared by the guilds kept in it
+        # Map from user IDs to the state of their report, idle reports expire (see session_store.py)
+        self.reports = SessionStore(lambda: Report(self), lambda data: Report.from_dict(self, data),
+                                    path=REPORT_SESSIONS_DB)
+        self.rules_sessions = {}  # Map from user IDs to the guild whose rules they are editing
         self.scam_classifier = ScamClassier()
+        self.virus_total_token = virus_total_token
+        if virus_total_endpoint:
+            configure_link_checker(endpoint=virus_total_endpoint)
+        self.scoring_pool = ScoringPool(scoring_workers, whole_words=MATCH_WHOLE_WORDS) if scoring_workers else None
+        self.learned_verdicts = {}  # message id -> last verdict fed to the classifier
+        self.metrics_port = metrics_port
+        self.metrics_log_interval = metrics_log_interval
+        self._metrics_runner = None
+        self._metrics_logger = None
+        ACTIVE_REPORTS.set_function(lambda: len(self.reports))
+        REPORT_SESSIONS_BYTES.set_function(self.reports.footprint)
+        PENDING_CASES.set_function(lambda: sum(len(state.cases) for state in self.guild_states.values()))
+        NEAR_DUPLICATE_CLUSTERS.set_function(lambda: sum(len(state.near_duplicates) for state in self.guild_states.values()))
+        GUILD_STATES.set_function(lambda: len(self.guild_states))
+
+    async def setup_hook(self):
+        if self.metrics_port:
+            try:
+                self._metrics_runner = await serve_metrics(self.metrics_port)
+            except OSError as e:
+                print(f"Could not serve metrics on port {self.metrics_port}", e)
+        if self.metrics_log_interval:
+            self._metrics_logger = asyncio.create_task(log_summary(logger, self.metrics_log_interval))
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
@@ -238,16 +345,231 @@ class ModBot(discord.Client):
             raise Exception("Group number not found in bot's name. Name format should be \"Group # Bot\".")
 
         for guild in self.guilds:
-            for channel in guild.text_channels:
-                if channel.name == f'group-{self.group_num}-mod':
-                    self.mod_channels[guild.id] = channel
-                    
+            self.guild_state(guild)
+        await self.assign_legacy_rules()
+
+    async def on_guild_join(self, guild):
+        if not self.owns_guild(guild):
+            return
+        state = self.guild_state(guild)
+        print(f'Joined {guild.name}, watching {", ".join(state.settings.channels)} and reporting to #{state.settings.mod_channel}')
+
+    async def on_guild_remove(self, guild):
+        state = self.guild_states.pop(guild.id, None)
+        if state:
+            state.close()
+
+    async def assign_legacy_rules(self):
+        '''
+        Without a legacy_guild_id, rules from before guilds were told apart go to the only guild
+        there is. With several guilds nobody can tell whose they are, so the moderators are told
+        they are not enforced instead of them being dropped silently.
+        '''
+        if self.guild_config.legacy_guild_id is not None:
+            return  # claimed by that guild's state, in the process running its shard
+        for store in list(self.rules_stores.values()):
+            if not store.has_unassigned() and (store.migrated_from_json() or not os.path.isfile(FAKE_DB)):
+                continue
+            states = [state for state in self.guild_states.values() if state.settings.rules_db == store.path]
+            configured = self.guild_config.configured_guild_ids
+            if len(configured) == 1:
+                # with shards in several processes, the one holding the configured guild claims them
+                states = [state for state in states if str(state.guild.id) == configured[0]]
+                if states:
+                    states[0].claim_legacy_rules()
+                continue
+            if self.shard_ids is None and len(states) == 1:
+                states[0].claim_legacy_rules()
+                continue
+            warning = (f"⚠️ {store.path} holds community rules from before the bot told servers apart. They are not "
+                       f"enforced until `legacy_guild_id` in {self.guild_config.path} names the server they belong to.")
+            print(warning)
+            for state in states:
+                if state.mod_channel:
+                    await self.send_to_mod_channel(state.mod_channel, warning)
+
+    def owns_guild(self, guild):
+        '''Whether the guild is on one of this process's shards, the only guilds it keeps state for.'''
+        return self.shard_ids is None or (guild.id >> 22) % self.shard_count in self.shard_ids
+
+    def guild_state(self, guild):
+        '''The guild's state, built on its first event and updated when guild_config.json changes.'''
+        self.guild_config.check()
+        state = self.guild_states.get(guild.id)
+        if state is None:
+            state = self.guild_states[guild.id] = GuildState(
+                self, guild, self.guild_config.settings(guild.id, self.group_num), self.guild_config.version)
+        elif state.config_version != self.guild_config.version:
+            was_legacy = state.settings.legacy
+            state.settings = self.guild_config.settings(guild.id, self.group_num)
+            state.config_version = self.guild_config.version
+            if state.settings.legacy and not was_legacy:
+                state.claim_legacy_rules()
+        state.guild = guild
+        return state
+
+    def rules_store(self, path):
+        store = self.rules_stores.get(path)
+        if store is None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            store = self.rules_stores[path] = RulesStore(path)
+        return store
+
+    async def close(self):
+        if self._metrics_logger:
+            self._metrics_logger.cancel()
+        if self._metrics_runner:
+            await self._metrics_runner.cleanup()
+        await close_link_checker()
+        if self.scoring_pool:
+            self.scoring_pool.close()
+        self.reports.close()
+        for state in self.guild_states.values():
+            state.close()
+        for store in self.rules_stores.values():
+            store.close()
+        if self.scam_classifier.updates_since_snapshot:
+            await self.scam_classifier.snapshot()
+        await super().close()
+
+    def score_messages(self, messages, user_rules):
+        '''
+        Community rule matches (of the guild the messages were posted in) and scam probability for
+        a batch of messages, in the worker processes when a scoring pool is configured.
+        '''
+        if self.scoring_pool:
+            return self.scoring_pool.score_batch(messages, user_rules.store.path, user_rules.store.guild_id,
+                                                 user_rules.rules_version, self.scam_classifier.metadata['version'])
+        with SCORING_SECONDS.time(part="classifier"):
+            probabilities = self.scam_classifier.predict_scam_proba_batch(messages)
+        with SCORING_SECONDS.time(part="rules"):
+            rules = [user_rules.get_rules_scores(message).get("rules", []) for message in messages]
+        return [{"scam_probability": probability, "rules": matches}
+                for probability, matches in zip(probabilities, rules)]
+
+    async def send_to_mod_channel(self, mod_channel, content, view=None):
+        with MOD_CHANNEL_SENDS.time():
+            return await mod_channel.send(content, view=view)
+
+    def open_case(self, message, priority, report_reason, automated, reporter=None, match_content=True):
+        '''Returns the case and whether it is new, duplicates merge into the open case.'''
+        return self.guild_state(message.guild).cases.open(message, priority, report_reason, automated, reporter, match_content)
+
+    def close_case(self, case, actions=None):
+        '''actions are the moderator's decision, later copies of an automated flag inherit it.'''
+        self.guild_state(case.message.guild).cases.close(case)
+        if case.cluster is not None and actions is not None:
+            case.cluster.actions = actions
+            case.cluster.channel_notice = case.channel_notice
+            case.cluster.case = None
+
+    def watch_cluster(self, case, cluster, scores, stages=None):
+        case.evaluations[tuple(stages or PIPELINE_STAGES)] = scores
+        if cluster is not None:
+            case.cluster = cluster
+            cluster.case = case
+
+    async def merge_into_case(self, case, message):
+        # a copy of a message that is already waiting for a moderator, no need to evaluate it again
+        self.guild_state(message.guild).cases.merge(case, message, None, None)
+        asyncio.ensure_future(self.refresh_case_post(case))
+        if case.channel_notice:
+            await message.channel.send(case.channel_notice)
+
+    async def inherit_cluster_verdict(self, cluster, message):
+        '''Handles a message whose near-duplicate cluster was already flagged, returns False if it was not.'''
+        if cluster.case is not None and not cluster.case.closed:
+            NEAR_DUPLICATE_MATCHES.inc(outcome="merged")
+            await self.merge_into_case(cluster.case, message)
+            return True
+        if not cluster.judged():
+            return False
+        NEAR_DUPLICATE_MATCHES.inc(outcome="inherited")
+        if cluster.actions:
+            self.guild_state(message.guild).user_rules.update_user_offenses(message.author.id)
+            await notify_authors([message.author], cluster.actions)
+            if cluster.channel_notice:
+                await message.channel.send(cluster.channel_notice)
+        return True
+
+    async def post_case(self, case, mod_channel, content, view_factory=None, preface=""):
+        # remembered so the "next" command can post the step the case is waiting on again
+        case.summary = content
+        case.view_factory = view_factory
+        view = view_factory() if view_factory else None
+        case.post = await self.send_to_mod_channel(mod_channel, f"{case.header()}\n{preface}{content}", view=view)
+        case.post_edited_at = time.monotonic()
+        return case.post
+
+    async def refresh_case_post(self, case):
+        # a wave of duplicate reports becomes one edit of the case's post every few seconds
+        if case.post is None or case.post_edit_pending:
+            return
+        case.post_edit_pending = True
+        await asyncio.sleep(max(0, case.post_edited_at + CASE_POST_EDIT_INTERVAL_SECONDS - time.monotonic()))
+        case.post_edit_pending = False
+        case.post_edited_at = time.monotonic()
+        try:
+            await case.post.edit(content=f"{case.header()}\n{case.summary}")
+        except discord.HTTPException as e:
+            print(f"Could not update the post of case #{case.id}", e)
+
+    async def evaluate_case(self, case, priority=PRIORITY_AUTOMATED, stages=None):
+        '''eval_text for the case's message, run once per case however many views ask for it.'''
+        key = tuple(stages or PIPELINE_STAGES)
+        if key not in case.evaluations:
+            state = self.guild_state(case.message.guild)
+            case.evaluations[key] = await state.case_evaluations.do(
+                (case.id, key), self.eval_text, case.message.content, priority, stages, state)
+        return case.evaluations[key]
+
+    async def handle_mod_command(self, state, message):
+        if message.content == QUEUE_KEYWORD:
+            cases = state.cases.pending(limit=QUEUE_LISTING_SIZE)
+            if not cases:
+                await message.channel.send("There are no open cases.")
+                return
+            lines = [f"* Case #{case.id} - {case.priority_label()} {case.report_reason} - {case.message.author.name} - "
+                     f"waiting {case.age() / 60:.0f} min" for case in cases]
+            await message.channel.send(f"{len(state.cases)} open case(s), next up first:\n" + "\n".join(lines))
+        elif message.content == NEXT_KEYWORD:
+            case = state.cases.peek()
+            if case is None:
+                await message.channel.send("There are no open cases.")
+                return
+            await self.post_case(case, message.channel, case.summary or "", case.view_factory,
+                                 preface=f"Waiting for {case.age() / 60:.0f} min: \n```{case.message.author.name}: {case.message.content}```\n")
+
+    async def record_verdict(self, message, is_scam):
+        # moderator decisions keep improving the classifier without a full retrain
+        if self.learned_verdicts.get(message.id) == is_scam:
+            return  # several views can confirm the same case
+        self.learned_verdicts[message.id] = is_scam
+        if len(self.learned_verdicts) > 10000:
+            self.learned_verdicts.pop(next(iter(self.learned_verdicts)))
+        self.scam_classifier.learn(message.content, is_scam)
+        if self.scam_classifier.snapshot_due():
+            metadata = await self.scam_classifier.snapshot()
+            logger.info(f"Saved scam classifier version {metadata['version']}")
+
+    async def _wait_for_message(self, prompt, check, timeout=300):
+        start = time.perf_counter()
+        outcome = "reply"
+        try:
+            return await self.wait_for('message', check=check, timeout=timeout)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise
+        finally:
+            WAIT_FOR_SECONDS.observe(time.perf_counter() - start, prompt=prompt, outcome=outcome)
+
     async def wait_for_user_reply(self, channel, user, reply=None):
         def check(m):
             return m.author == user and m.channel == channel
 
         try:
-            message = await self.wait_for('message', check=check, timeout=300)
+            message = await self._wait_for_message("user_reply", check)
             if reply:
                 await channel.send(reply)
             else:
@@ -263,7 +585,7 @@ class ModBot(discord.Client):
             return m.author == user and m.channel == channel
 
         try:
-            message = await self.wait_for('message', check=check, timeout=300)
+            message = await self._wait_for_message("report_reason_update", check)
             if message.content not in priorities:
                 values = message.content.split(" - ")[1].split(", ")
             else:
@@ -285,7 +607,8 @@ class ModBot(discord.Client):
             return
         # Check if this message was sent in a server ("guild") or if it's a DM
         if message.guild:
-            await self.handle_channel_message(message)
+            if self.owns_guild(message.guild):
+                await self.handle_channel_message(message)
         else:
             await self.handle_dm(message)
 
@@ -303,7 +626,8 @@ class ModBot(discord.Client):
 
         reporting = (author_id in self.reports
                      or message.content.startswith(Report.START_KEYWORD))
-        creating_rules = (not self.user_rules.rules_complete()
+        rules_state = self.guild_states.get(self.rules_sessions.get(author_id))
+        creating_rules = ((rules_state is not None and not rules_state.user_rules.rules_complete())
                           or message.content.startswith(UserRules.START_KEYWORD))
 
         # Only respond to messages if they're part of a reporting flow
@@ -312,96 +636,210 @@ class ModBot(discord.Client):
 
         if reporting:
             # If we don't currently have an active report for this user, add one
-            if author_id not in self.reports:
-                self.reports[author_id] = Report(self)
+            report = self.reports.get(author_id)
+            if report is None:
+                report = self.reports.create(author_id)
 
             # Let the report class handle this message; forward all the messages it returns to uss
-            responses = await self.reports[author_id].handle_message(message)
+            responses = await report.handle_message(message)
             for r in responses:
                 await message.channel.send(r.get("response"), view=r.get("view"))
                 if r.get("summary"):
-                    self.reported_message = {"message": r.get("reported_message"), "priority": r.get("priority"), "report_reason": r.get("reported_reason"), "automated": False}
-                    mod_channel = self.mod_channels[r.get("reported_message").guild.id]
-                    view = create_legitimacy_view(mod_channel, self.reported_message, self.user_rules)
-                    offenses = self.user_rules.get_user_offenses(r.get("reported_message").author.id)
-                    await mod_channel.send(r.get("summary") + f"\n* {r.get('reported_message').author.name} has had {offenses} reports made against them\n\nIs the report reason appropriate for the reported content?", view=view)
+                    case, created = self.open_case(r.get("reported_message"), r.get("priority"), r.get("reported_reason"),
+                                                   automated=False, reporter=author_id)
+                    if not created:
+                        # someone already reported this message, the open case carries the new report
+                        asyncio.ensure_future(self.refresh_case_post(case))
+                        continue
+                    state = self.guild_state(r.get("reported_message").guild)
+                    mod_channel = state.mod_channel
+                    offenses = state.user_rules.get_user_offenses(r.get("reported_message").author.id)
+                    await self.post_case(case, mod_channel, r.get("summary") + f"\n* {r.get('reported_message').author.name} has had {offenses} reports made against them\n\nIs the report reason appropriate for the reported content?",
+                                         lambda case=case, mod_channel=mod_channel, state=state: create_legitimacy_view(mod_channel, case, state.user_rules))
 
             # If the report is complete or cancelled, remove it from our map
-            if self.reports[author_id].report_complete():
+            if report.report_complete():
                 self.reports.pop(author_id)
+            else:
+                self.reports.save(author_id)
 
         elif creating_rules:
-            self.user_rules.update_rules(user=author_id)
-            responses = await self.user_rules.handle_message(message)
+            if message.content.startswith(UserRules.START_KEYWORD):
+                rules_state = await self.rules_guild(message)
+                if rules_state is None:
+                    return
+                self.rules_sessions[author_id] = rules_state.guild.id
+            rules_state.user_rules.update_rules(user=author_id)
+            responses = await rules_state.user_rules.handle_message(message)
             for r in responses:
                 await message.channel.send(r.get("response"), view=r.get("view"))
 
-    async def handle_malicious_link(self, message, scores, mod_channel, automated=True):
-        if -1 not in scores['suspicious_link'].values():
-            action_view = View()
-            action_view.add_item(ModeratorActionDropdown(mod_channel, self.reported_message, self.user_rules))
-            action_view.add_item(ConfirmButton(mod_channel, self.reported_message, self.user_rules))
+    async def is_member(self, guild, user_id):
+        if guild.get_member(user_id) is not None:
+            return True
+        # without the members intent only members who posted are cached, ask Discord
+        try:
+            await guild.fetch_member(user_id)
+            return True
+        except discord.NotFound:
+            return False
+        except discord.HTTPException as e:
+            print(f"Could not check whether {user_id} is a member of {guild.name}", e)
+            return False
+
+    async def rules_guild(self, message):
+        '''
+        The state of the guild a "rules [server id]" DM is about, the named one or the only one
+        shared. Only members of a server can edit its rules.
+        '''
+        words = message.content.split()
+        if len(words) > 1:
+            guild = self.get_guild(int(words[1])) if words[1].isdigit() else None
+            if guild is None or not await self.is_member(guild, message.author.id):
+                await message.channel.send(f"You are not in a server with the id {words[1]} that I moderate.")
+                return None
+            return self.guild_state(guild)
+        if len(self.guilds) == 1:
+            guilds = [guild for guild in self.guilds if await self.is_member(guild, message.author.id)]
+        else:
+            guilds = [guild for guild in self.guilds if guild.get_member(message.author.id)]
+        if len(guilds) == 1:
+            return self.guild_state(guilds[0])
+        if not guilds:
+            await message.channel.send(f"Which server are these rules for? Reply with `{UserRules.START_KEYWORD} <server id>`.")
+            return None
+        servers = "\n".join(f"* {guild.name}: `{UserRules.START_KEYWORD} {guild.id}`" for guild in guilds[:MAX_LISTED_GUILDS])
+        if len(guilds) > MAX_LISTED_GUILDS:
+            servers += f"\n* and {len(guilds) - MAX_LISTED_GUILDS} more, reply with `{UserRules.START_KEYWORD} <server id>`"
+        await message.channel.send(f"Which server are these rules for?\n{servers}")
+        return None
+
+    async def handle_incident(self, state, incident, message, mod_channel):
+        '''
+        One mod channel alert per flood or raid: the first throttled message opens a case and the
+        others join it unevaluated. A busy channel is only announced, its messages skip link scans.
+        '''
+        THROTTLED_MESSAGES.inc(kind=incident.kind)
+        if incident.kind == BUSY:
+            if not incident.alerted:
+                incident.alerted = True
+                await self.send_to_mod_channel(
+                    mod_channel, f"⚠️ #{message.channel.name} is receiving more than {state.flood_detector.channel_limit} messages every "
+                                 f"{state.flood_detector.channel_window} seconds. Links posted there are not being scanned until it calms down.")
+            return
+        if incident.case is not None and not incident.case.closed:
+            state.cases.merge(incident.case, message, None, None)
+            asyncio.ensure_future(self.refresh_case_post(incident.case))
+            return
+        date = datetime.today().strftime("%B %d, %Y")
+        if incident.kind == FLOOD:
+            # "lol" from a flooding account must not pull everyone else's "lol" into the case
+            case, _ = self.open_case(message, 3, "Message Flood", automated=True, match_content=False)
+            summary = (f"An automated report was filed on {date}: {message.author.name} is posting more than {state.flood_detector.author_limit} "
+                       f"messages every {state.flood_detector.author_window} seconds in #{message.channel.name}. Their messages are not being checked until it stops.\n"
+                       f"```{message.author.name}: {message.content}```\n* Report reason: Message Flood \n* Priority: 🟡")
+        else:
+            case, _ = self.open_case(message, 2, "Suspected Raid", automated=True, match_content=False)
+            summary = (f"An automated report was filed on {date}: more than {state.flood_detector.raid_limit} new members started posting in "
+                       f"#{message.channel.name} within {state.flood_detector.raid_window} seconds. Their messages are not being checked until it stops.\n"
+                       f"```{message.author.name}: {message.content}```\n* Report reason: Suspected Raid \n* Priority: 🟠")
+        incident.case = case
+        await self.post_case(case, mod_channel, summary + "\n\nPlease determine the appropriate actions for every account involved, if required.",
+                             lambda: create_action_view(mod_channel, case, state.user_rules, confirm=False))
+
+    async def handle_malicious_link(self, case, scores, mod_channel, automated=True):
+        user_rules = self.guild_state(case.message.guild).user_rules
+        if -1 not in scores.get('suspicious_link', {}).values():
             action_message = "\n\nPlease select the action(s) you want to take. If you would like to proceed with the preselected, recommended actions, press 'Confirm Action(s)'. If not, please update the selection of appropriate actions."
 
-            await mod_channel.send(self.code_format(scores, message, automated) + action_message, view=action_view)
+            await self.post_case(case, mod_channel, self.code_format(scores, case.message, automated) + action_message,
+                                 lambda: create_action_view(mod_channel, case, user_rules))
         else:
-            malicious_view = View()
-            malicious_view.add_item(MaliciousLinkDropdown(mod_channel, self.reported_message, self.user_rules))
-            await mod_channel.send(
-                self.code_format(scores, message, automated) + "\nPlease review the reported link. Is it malicious?",
-                view=malicious_view)
+            urls = [url for url, score in scores.get('suspicious_link', {}).items() if score == -1]
+            await self.post_case(
+                case, mod_channel, self.code_format(scores, case.message, automated) + "\nPlease review the reported link. Is it malicious?",
+                lambda: create_malicious_link_view(mod_channel, case, user_rules, urls))
 
     async def handle_channel_message(self, message):
-        # Only handle messages sent in the "group-#" channel
-        if not message.channel.name == f'group-{self.group_num}':
+        state = self.guild_state(message.guild)
+        if message.channel.name == state.settings.mod_channel:
+            await self.handle_mod_command(state, message)
+            return
+        # Only handle messages sent in the channels guild_config.json routes to the bot
+        if not state.settings.watches(message.channel.name):
+            return
+        mod_channel = state.mod_channel
+        if mod_channel is None:
+            if not state.warned_no_mod_channel:
+                print(f"{message.guild.name} has no #{state.settings.mod_channel} channel, ignoring its messages")
+                state.warned_no_mod_channel = True
+            return
+        state.warned_no_mod_channel = False
+
+        # floods and raids are throttled before anything else runs on their messages
+        incident = state.flood_detector.check(message)
+        if incident is not None:
+            await self.handle_incident(state, incident, message, mod_channel)
+            if incident.kind != BUSY:
+                return
+        stages = [stage for stage in PIPELINE_STAGES if stage not in NETWORK_STAGES] if incident else None
+
+        duplicate = state.cases.find(message, automated=True)
+        if duplicate is not None:
+            await self.merge_into_case(duplicate, message)
+            return
+        # lightly varied copies of a flagged message take its case or the moderator's decision
+        cluster, _ = state.near_duplicates.add(message)
+        if cluster is not None and await self.inherit_cluster_verdict(cluster, message):
             return
 
         # Forward the message to the mod channel
-        mod_channel = self.mod_channels[message.guild.id]
-        scores = self.eval_text(message.content)
+        if cluster is not None:
+            # copies arriving while the first one is evaluated share its evaluation
+            scores = await state.cluster_evaluations.do(cluster.id, self.eval_text, message.content, PRIORITY_AUTOMATED, stages, state)
+        else:
+            scores = await self.eval_text(message.content, stages=stages, state=state)
+        # and join the case opened for it meanwhile
+        if cluster is not None and await self.inherit_cluster_verdict(cluster, message):
+            return
         if scores:
             if 'suspicious_link' in scores:
-                self.reported_message = {"message": message, "priority": 4,
-                                         "report_reason": "Suspicious Link", "automated": True}
-                await self.handle_malicious_link(message, scores, mod_channel)
-                await message.channel.send(
-                    "🚨 The above content has been removed as it contains a suspicious link. If you believe this to be in error, please __submit your feedback__. 🚨")
+                case, _ = self.open_case(message, 4, "Suspicious Link", automated=True)
+                self.watch_cluster(case, cluster, scores, stages)
+                case.channel_notice = "🚨 The above content has been removed as it contains a suspicious link. If you believe this to be in error, please __submit your feedback__. 🚨"
+                await self.handle_malicious_link(case, scores, mod_channel)
+                await message.channel.send(case.channel_notice)
 
             elif 'scam' in scores and scores['scam'] == 1:
-                self.reported_message = {"message": message, "priority": 3,
-                                         "report_reason": "Suspected Cryptocurrency Scam", "automated": True}
-                action_view = View()
-                action_view.add_item(ModeratorActionDropdown(mod_channel, self.reported_message, self.user_rules))
-                await mod_channel.send(self.code_format(scores, message), view=action_view)
-                await message.channel.send(
-                    "🚨 The above content has been removed as it violates our policies on cryptocurrency. If you believe this to be in error, please __submit your feedback__. 🚨")
-            else:
-                await mod_channel.send(self.code_format(scores, message))
-                await message.channel.send(
-                    "🚨 The above content has been removed as it violates our community guidelines. If you believe this to be in error, please __submit your feedback__. 🚨")
-
-
-    def eval_text(self, message):
-        ''''
-        TODO: Once you know how you want to evaluate messages in your channel, 
-        insert your code here! This will primarily be used in Milestone 3. 
+                case, _ = self.open_case(message, 3, "Suspected Cryptocurrency Scam", automated=True)
+                self.watch_cluster(case, cluster, scores, stages)
+                case.channel_notice = "🚨 The above content has been removed as it violates our policies on cryptocurrency. If you believe this to be in error, please __submit your feedback__. 🚨"
+                await self.post_case(case, mod_channel, self.code_format(scores, message),
+                                     lambda: create_action_view(mod_channel, case, state.user_rules, confirm=False))
+                await message.channel.send(case.channel_notice)
+            elif scores.get('rules'):
+                # a case like the other flags, so copies of the message merge into it instead of each being posted
+                case, _ = self.open_case(message, 4, "Community Rule Violation", automated=True)
+                self.watch_cluster(case, cluster, scores, stages)
+                case.channel_notice = "🚨 The above content has been removed as it violates our community guidelines. If you believe this to be in error, please __submit your feedback__. 🚨"
+                await self.post_case(case, mod_channel, self.code_format(scores, message) + "\n\nPlease determine the appropriate actions, if required.",
+                                     lambda: create_action_view(mod_channel, case, state.user_rules, confirm=False))
+                await message.channel.send(case.channel_notice)
+
+            elif 'scam' in scores and scores['scam'] == -1:
+                # borderline score: leave the message up and let a moderator decide
+                case, _ = self.open_case(message, 4, "Suspected Cryptocurrency Scam", automated=True)
+                self.watch_cluster(case, cluster, scores, stages)
+                await self.post_case(case, mod_channel, self.code_format(scores, message),
+                                     lambda: create_action_view(mod_channel, case, state.user_rules, confirm=False))
+
+
+    async def eval_text(self, message, priority=PRIORITY_AUTOMATED, stages=None, state=None):
         '''
-        all_scores = {}
-        # Automated flagging for suspicious links
-        scores = identify_suspicious_links(message, virus_total_token)
-        if len(scores) > 0:
-            if -1 in scores.values() or 1 in scores.values():
-                all_scores['suspicious_link'] = scores
-
-        # Automated flagging for community specified rules
-        rules_scores = self.user_rules.get_rules_scores(message)
-        if rules_scores.get("rules"):
-            all_scores['rules'] = rules_scores['rules']
-
-        # Automated flagging for potential scams
-        is_scam = self.scam_classifier.predict_scam(message)
-        all_scores['scam'] = is_scam
-
+        Runs the guild's moderation pipeline (see pipeline.py) over a message and returns the scores
+        of the stages that ran, stopping early once one of them is decisive.
+        '''
+        all_scores = await state.pipeline.evaluate(message, priority, stages)
         if len(all_scores) > 0:
             return all_scores
         return None
@@ -438,9 +876,20 @@ class ModBot(discord.Client):
                     f"This is due to containing the following phrase(s): {phrases_found}")
 
         if "scam" in scores and scores['scam'] == 1:
-            return_message = f"An automated report was filed on {date} on the following message: \n```{message.author.name}: {message.content}```\n* Report reason: Suspected Cryptocurrency Scam \n* Priority: 🟡\n\nPlease determine if this a scam and determine the appropriate actions, if required."
+            return_message = f"An automated report was filed on {date} on the following message: \n```{message.author.name}: {message.content}```\n* Report reason: Suspected Cryptocurrency Scam \n* Priority: 🟡\n* Scam score: {scores['scam_probability']:.0%}\n\nPlease determine if this a scam and determine the appropriate actions, if required."
+            return return_message
+
+        if "scam" in scores and scores['scam'] == -1:
+            return_message = f"The following message was queued for review on {date} and has not been removed: \n```{message.author.name}: {message.content}```\n* Report reason: Suspected Cryptocurrency Scam \n* Priority: 🟢\n* Scam score: {scores['scam_probability']:.0%}\n\nPlease determine if this a scam and determine the appropriate actions, if required."
             return return_message
         return ""
 
-client = ModBot()
-client.run(discord_token)
+
+if __name__ == "__main__":
+    setup_logging()
+    tokens = load_tokens()
+    # an optional "virus_total_endpoint" points link checks at e.g. fake_virus_total.py, optional
+    # "shard_count" and "shard_ids" split the guilds between several bot processes
+    client = ModBot(virus_total_token=tokens['virus_total'], virus_total_endpoint=tokens.get('virus_total_endpoint'),
+                    shard_count=tokens.get('shard_count'), shard_ids=tokens.get('shard_ids'))
+    client.run(tokens['discord'])
@@ -0,0 +1,197 @@
+import hashlib
+import heapq
+import itertools
+import time
+
+from metrics import CASE_SECONDS, CASES_MERGED
+
+# A waiting case gains one priority level for every AGING_SECONDS it has been open, so a P4 that
+# has waited two hours is reviewed before a P1 that just came in
+AGING_SECONDS = 30 * 60
+# Priority of cases whose priority is still "TBD" (report reason "Other")
+UNKNOWN_PRIORITY = 5
+# Copies kept per case for the moderator's decision, a flood can produce thousands
+MAX_DUPLICATES = 500
+# Cases nobody decided on are closed after MAX_CASE_AGE_SECONDS, and the oldest ones once more
+# than MAX_OPEN_CASES are open, so a busy guild cannot pile up messages forever
+MAX_CASE_AGE_SECONDS = 7 * 24 * 60 * 60
+MAX_OPEN_CASES = 1000
+
+
+def content_key(text):
+    # copies of an automated flag differ at most in case and spacing
+    return hashlib.sha1(" ".join(text.casefold().split()).encode()).hexdigest()
+
+
+class Case:
+    '''
+    One message under moderator review. Every view posted for it is bound to this object.
+    Further reports of the same message, and automated flags of identical content, are merged
+    into it instead of opening new cases.
+    '''
+
+    def __init__(self, case_id, message, priority, report_reason, automated):
+        self.id = case_id
+        self.message = message
+        self.priority = priority if isinstance(priority, int) else UNKNOWN_PRIORITY
+        self.report_reasons = [report_reason] if report_reason else []
+        self.automated = automated
+        self.created_at = time.time()
+        self.closed = False
+        self.reporters = set()
+        self.duplicates = []  # other messages with the same content, acted on together
+        self.dropped_duplicates = 0  # copies counted past MAX_DUPLICATES
+        self.evaluations = {}  # pipeline stages -> scores, so a case is only evaluated once
+        self.summary = None  # last text posted to the mod channel, re-posted by the "next" command
+        self.view_factory = None  # builds a fresh view for that post, discord views time out
+        self.post = None  # that post, edited as duplicate reports come in
+        self.channel_notice = None  # what was said in the channel when the message was flagged
+        self.cluster = None  # near-duplicate cluster of an automated flag, see near_duplicates.py
+        self.post_edit_pending = False
+        self.post_edited_at = 0
+
+    @property
+    def report_reason(self):
+        # predetermine_action and is_scam_report look for reasons by substring
+        return "; ".join(self.report_reasons)
+
+    @report_reason.setter
+    def report_reason(self, reason):
+        self.report_reasons = [reason] if reason else []
+
+    def priority_label(self):
+        return "TBD" if self.priority == UNKNOWN_PRIORITY else f"P{self.priority}"
+
+    def authors(self):
+        '''Distinct authors of the message and its duplicates, every one of them gets the decision.'''
+        authors = {}
+        for message in [self.message] + self.duplicates:
+            authors.setdefault(message.author.id, message.author)
+        return list(authors.values())
+
+    def report_count(self):
+        # the automated flag, every user report and every flagged copy count once
+        return max(1, self.automated + len(self.reporters) + len(self.duplicates) + self.dropped_duplicates)
+
+    def header(self):
+        header = f"**Case #{self.id}**"
+        if self.report_count() > 1:
+            header += f" - reported {self.report_count()} times ({self.report_reason})"
+        return header
+
+    def age(self):
+        return time.time() - self.created_at
+
+
+class CaseQueue:
+    '''
+    Open moderation cases keyed by id, with a heap ordered by priority * aging interval + creation
+    time. The key of a case only changes when a merged report raises its priority; the new key is
+    pushed and stale heap entries, like those of closed cases, are dropped lazily.
+
+    Open cases are also indexed by reported message id and, for automated flags, by content hash.
+    Stale cases are closed without a decision when new ones are opened, see expire.
+    '''
+
+    def __init__(self, aging_interval=AGING_SECONDS, max_age=MAX_CASE_AGE_SECONDS, max_cases=MAX_OPEN_CASES):
+        self.aging_interval = aging_interval
+        self.max_age = max_age
+        self.max_cases = max_cases
+        self.cases = {}  # in the order they were opened
+        self._heap = []
+        self._ids = itertools.count(1)
+        self._by_message = {}
+        self._by_content = {}
+
+    def __len__(self):
+        return len(self.cases)
+
+    def get(self, case_id):
+        return self.cases.get(case_id)
+
+    def find(self, message, automated=False):
+        case = self._by_message.get(message.id)
+        if case is None and automated:
+            case = self._by_content.get(content_key(message.content))
+        return case
+
+    def open(self, message, priority, report_reason, automated, reporter=None, match_content=True):
+        '''
+        Returns the case for the message and whether it was newly opened. match_content=False keeps
+        other automated flags with the same text out of the case.
+        '''
+        case = self.find(message, automated)
+        if case is not None:
+            self.merge(case, message, priority, report_reason, reporter)
+            return case, False
+        self.expire()
+        case = Case(next(self._ids), message, priority, report_reason, automated)
+        if reporter is not None:
+            case.reporters.add(reporter)
+        self.cases[case.id] = case
+        self._by_message[message.id] = case
+        if automated and match_content:
+            self._by_content.setdefault(content_key(message.content), case)
+        heapq.heappush(self._heap, (self._key(case), case.id))
+        return case, True
+
+    def merge(self, case, message, priority, report_reason, reporter=None):
+        CASES_MERGED.inc(kind="automated" if reporter is None else "report")
+        if reporter is not None:
+            case.reporters.add(reporter)
+        if message.id != case.message.id and message.id not in self._by_message:
+            if len(case.duplicates) < MAX_DUPLICATES:
+                case.duplicates.append(message)
+                self._by_message[message.id] = case
+            else:
+                case.dropped_duplicates += 1
+        if report_reason and report_reason not in case.report_reasons:
+            case.report_reasons.append(report_reason)
+        if isinstance(priority, int) and priority < case.priority:
+            case.priority = priority
+            heapq.heappush(self._heap, (self._key(case), case.id))
+
+    def _key(self, case):
+        return case.priority * self.aging_interval + case.created_at
+
+    def close(self, case):
+        if case.closed:
+            return False
+        case.closed = True
+        self.cases.pop(case.id, None)
+        for message in [case.message] + case.duplicates:
+            if self._by_message.get(message.id) is case:
+                del self._by_message[message.id]
+        key = content_key(case.message.content)
+        if self._by_content.get(key) is case:
+            del self._by_content[key]
+        CASE_SECONDS.observe(case.age())
+        return True
+
+    def expire(self, now=None):
+        '''Closes cases older than max_age, then the oldest while max_cases or more are open.'''
+        now = now or time.time()
+        expired = []
+        for case in self.cases.values():
+            if now - case.created_at <= self.max_age and len(self.cases) - len(expired) < self.max_cases:
+                break
+            expired.append(case)
+        for case in expired:
+            print(f"Closing case #{case.id} ({case.priority_label()}, {case.report_reason or 'automated'}) "
+                  f"without a decision after {case.age() / 3600:.1f}h")
+            self.close(case)
+        return expired
+
+    def peek(self):
+        while self._heap:
+            key, case_id = self._heap[0]
+            case = self.cases.get(case_id)
+            if case is not None and key == self._key(case):
+                return case
+            heapq.heappop(self._heap)
+        return None
+
+    def pending(self, limit=None):
+        '''Open cases, the one to review first at the front.'''
+        ordered = sorted(self.cases.values(), key=self._key)
+        return ordered[:limit] if limit else ordered
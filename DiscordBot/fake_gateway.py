@@ -0,0 +1,251 @@
+'''
+Offline stand-in for the Discord gateway, to try multi-guild and sharded operation without a
+token or network access:
+
+    python fake_gateway.py --guilds 12 --shards 3 --messages 600 --late-guilds 2
+
+Fake guilds are assigned to shards the way Discord does it, (guild id >> 22) % shard count. One
+ModBot runs per shard, as if each was its own process started with shard_ids=[n], and only has
+the guilds of its shard in its cache. Every message and guild join is dispatched to every bot
+though, so a bot that acts on a guild outside its shards shows up as a problem instead of being
+hidden by the harness. Messages come from the synthetic corpus in benchmarks/corpus.py and links
+are checked against fake_virus_total.py. The first guild is routed through guild_config.json
+(every channel watched, alerts to #mod-log) and --late-guilds join halfway through the run. At
+the end the harness checks that no bot holds state for, or posted to, a guild outside its shard,
+and prints what each shard did.
+'''
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import bot
+from benchmarks.corpus import generate_corpus
+from benchmarks.suite import isolate_link_checker
+from fake_virus_total import FakeVirusTotal
+from guild_config import GuildConfig
+from suspicious_link_detection import configure_link_checker
+
+BOT_NAME = "Group 2 Bot"
+GROUP_CHANNEL = "group-2"
+MOD_CHANNEL = "group-2-mod"
+
+_ids = itertools.count(1)
+# the shard whose bot is handling the current event, tasks it starts inherit it
+_shard = contextvars.ContextVar("shard", default=None)
+
+
+def snowflake(rng):
+    # discord ids carry a millisecond timestamp above bit 22, which is what shards are picked by
+    return (rng.getrandbits(41) << 22) | next(_ids)
+
+
+class FakeMessage:
+    def __init__(self, message_id, content, author, channel):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.edits = 0
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+        self.edits += 1
+        return self
+
+
+class FakeUser:
+    def __init__(self, user_id, name, joined_at=None):
+        self.id = user_id
+        self.name = name
+        self.joined_at = joined_at
+        self.dms = []
+
+    async def send(self, content, **kwargs):
+        self.dms.append(content)
+
+
+class FakeChannel:
+    def __init__(self, channel_id, name, guild, gateway):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.gateway = gateway
+        self.sent = []
+        self.senders = []  # shard of the bot behind every post
+
+    async def send(self, content, view=None, **kwargs):
+        self.sent.append(content)
+        self.senders.append(_shard.get())
+        return FakeMessage(next(_ids), content, self.gateway.bot_user, self)
+
+
+class FakeGuild:
+    def __init__(self, guild_id, name, channel_names, gateway):
+        self.id = guild_id
+        self.name = name
+        self.text_channels = [FakeChannel(next(_ids), channel, self, gateway) for channel in channel_names]
+        self.members = {}
+
+    def get_channel(self, channel_id):
+        return next((channel for channel in self.text_channels if channel.id == channel_id), None)
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    def channel(self, name):
+        return next(channel for channel in self.text_channels if channel.name == name)
+
+
+class FakeGateway:
+    def __init__(self, shard_count, seed=152):
+        self.shard_count = shard_count
+        self.rng = random.Random(seed)
+        self.bot_user = FakeUser(snowflake(self.rng), BOT_NAME)
+        self.bots = {}  # shard id -> ModBot
+        self.guilds = []
+
+    def shard_for(self, guild_id):
+        return (guild_id >> 22) % self.shard_count
+
+    def create_guild(self, name, channel_names=(GROUP_CHANNEL, MOD_CHANNEL, "general"), members=20, joined=True):
+        '''A guild the bot is in from the start, or with joined=False one that joins later.'''
+        guild = FakeGuild(snowflake(self.rng), name, list(channel_names), self)
+        joined_at = datetime.now(timezone.utc) - timedelta(days=30)
+        for i in range(members):
+            member = FakeUser(snowflake(self.rng), f"{name}-member-{i}", joined_at)
+            guild.members[member.id] = member
+        if joined:
+            self.guilds.append(guild)
+        return guild
+
+    async def connect(self, shard_id, client):
+        # what login() and the READY event would set up for this shard
+        await client._async_setup_hook()
+        client._connection.user = self.bot_user
+        for guild in self.guilds:
+            if self.shard_for(guild.id) == shard_id:
+                client._connection._add_guild(guild)
+        self.bots[shard_id] = client
+
+    async def ready(self):
+        for client in self.bots.values():
+            await client.on_ready()
+
+    async def dispatch(self, event, *args):
+        # to every bot, each has to keep to the guilds of its own shards
+        for shard_id, client in self.bots.items():
+            token = _shard.set(shard_id)
+            try:
+                await getattr(client, event)(*args)
+            finally:
+                _shard.reset(token)
+
+    async def join(self, guild):
+        self.guilds.append(guild)
+        self.bots[self.shard_for(guild.id)]._connection._add_guild(guild)
+        await self.dispatch("on_guild_join", guild)
+
+    async def post(self, guild, channel_name, author, content):
+        message = FakeMessage(snowflake(self.rng), content, author, guild.channel(channel_name))
+        await self.dispatch("on_message", message)
+        return message
+
+
+def check_partitioning(gateway):
+    problems = []
+    for shard_id, client in gateway.bots.items():
+        for guild_id in client.guild_states:
+            if gateway.shard_for(guild_id) != shard_id:
+                problems.append(f"shard {shard_id} holds state for guild {guild_id} of shard {gateway.shard_for(guild_id)}")
+    for guild in gateway.guilds:
+        senders = {shard_id for channel in guild.text_channels for shard_id in channel.senders}
+        for shard_id in senders - {gateway.shard_for(guild.id)}:
+            problems.append(f"shard {shard_id} posted to {guild.name} of shard {gateway.shard_for(guild.id)}")
+        if senders and guild.id not in gateway.bots[gateway.shard_for(guild.id)].guild_states:
+            problems.append(f"{guild.name} received posts from a shard that holds no state for it")
+    return problems
+
+
+def print_shards(gateway, handled):
+    print(f"{'shard':<7}{'guilds':>8}{'messages':>10}{'open cases':>12}{'mod posts':>11}")
+    for shard_id, client in sorted(gateway.bots.items()):
+        states = client.guild_states.values()
+        mod_posts = sum(len(state.mod_channel.sent) for state in states if state.mod_channel)
+        print(f"{shard_id:<7}{len(client.guild_states):>8}{handled[shard_id]:>10}"
+              f"{sum(len(state.cases) for state in states):>12}{mod_posts:>11}")
+
+
+async def run(args, workdir):
+    gateway = FakeGateway(args.shards, args.seed)
+    guilds = [gateway.create_guild(f"guild-{i}") for i in range(args.guilds)]
+    routed = gateway.create_guild("routed", channel_names=("general", "trading", "mod-log"))
+    late = [gateway.create_guild(f"late-{i}", joined=False) for i in range(args.late_guilds)]
+
+    config_path = os.path.join(workdir, "guild_config.json")
+    with open(config_path, "w") as f:
+        json.dump({"default": {"channels": [GROUP_CHANNEL], "mod_channel": MOD_CHANNEL,
+                               "rules_db": os.path.join(workdir, "rules.db")},
+                   "guilds": {str(routed.id): {"channels": ["*"], "mod_channel": "mod-log"}}}, f)
+
+    server = FakeVirusTotal(latency=args.vt_latency, seed=args.seed)
+    configure_link_checker(endpoint=await server.start())
+    isolate_link_checker(os.path.join(workdir, "links"))
+    bot.REPORT_SESSIONS_DB = None
+    for shard_id in range(args.shards):
+        await gateway.connect(shard_id, bot.ModBot(virus_total_token="fake-token", metrics_port=None,
+                                             shard_count=args.shards, shard_ids=[shard_id],
+                                             guild_config=GuildConfig(config_path)))
+    await gateway.ready()
+
+    corpus = [message for message, _ in generate_corpus(args.messages, 60, args.url_density, args.spam_ratio, args.seed)]
+    handled = {shard_id: 0 for shard_id in gateway.bots}
+    start = time.perf_counter()
+    for i, content in enumerate(corpus):
+        if i == len(corpus) // 2:
+            for guild in late:
+                await gateway.join(guild)
+            guilds += late
+        guild = gateway.rng.choice(guilds + [routed])
+        channel = "trading" if guild is routed else GROUP_CHANNEL
+        author = gateway.rng.choice(list(guild.members.values()))
+        await gateway.post(guild, channel, author, content)
+        handled[gateway.shard_for(guild.id)] += 1
+    elapsed = time.perf_counter() - start
+
+    print_shards(gateway, handled)
+    print(f"{len(corpus)} messages in {elapsed:.1f}s, fake VirusTotal answered {server.requests} requests")
+    problems = check_partitioning(gateway)
+    for problem in problems:
+        print("PROBLEM:", problem)
+    if not routed.channel("mod-log").sent and not problems:
+        print("note: nothing posted in the routed guild was flagged")
+    for client in gateway.bots.values():
+        await client.close()
+    await server.close()
+    return not problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run sharded ModBots against a fake gateway.")
+    parser.add_argument("--guilds", type=int, default=12)
+    parser.add_argument("--shards", type=int, default=3)
+    parser.add_argument("--late-guilds", type=int, default=2, help="guilds joining halfway through the run")
+    parser.add_argument("--messages", type=int, default=600)
+    parser.add_argument("--url-density", type=float, default=0.1)
+    parser.add_argument("--spam-ratio", type=float, default=0.2)
+    parser.add_argument("--vt-latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=152)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        ok = asyncio.run(run(args, workdir))
+    print("partitioning ok" if ok else "partitioning FAILED")
+    raise SystemExit(0 if ok else 1)
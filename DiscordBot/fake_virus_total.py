@@ -0,0 +1,158 @@
+'''
+Local stand-in for the two VirusTotal endpoints the bot uses (POST /urls and GET /analyses/{id}),
+for integration and load testing without an API key or network access:
+
+    python fake_virus_total.py --port 8089 --latency 0.3 --rate-limit 240 --queued-for 2
+
+then add "virus_total_endpoint": "http://localhost:8089/api/v3/" to tokens.json.
+
+Verdicts are scripted with a JSON file mapping url substrings to a verdict, the first match wins:
+    {"free-btc": "malicious", "wallet-verify": "suspicious", "github.com": "clean"}
+Other urls get a verdict from a hash of the url, so repeated runs see the same answers.
+'''
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+import time
+from collections import deque
+
+from aiohttp import web
+
+API_PREFIX = "/api/v3/"
+VERDICT_STATS = {
+    "malicious": {"malicious": 7, "suspicious": 1, "undetected": 20, "harmless": 62, "timeout": 0},
+    "suspicious": {"malicious": 0, "suspicious": 48, "undetected": 10, "harmless": 30, "timeout": 0},
+    "clean": {"malicious": 0, "suspicious": 0, "undetected": 22, "harmless": 68, "timeout": 0},
+}
+QUEUED_STATS = {"malicious": 0, "suspicious": 0, "undetected": 0, "harmless": 0, "timeout": 0}
+
+
+class FakeVirusTotal:
+    '''
+    latency:      mean seconds per response, uniformly jittered by +-jitter
+    rate_limit:   requests per minute before answering 429 with a Retry-After header (0 = unlimited)
+    error_rate:   share of requests answered with a 429 regardless of the rate limit
+    queued_for:   seconds an analysis reports "queued" with all-zero stats after its submission
+    verdicts:     url substring -> "malicious", "suspicious" or "clean"
+    '''
+
+    def __init__(self, verdicts=None, latency=0.0, jitter=0.0, rate_limit=0, error_rate=0.0,
+                 queued_for=0.0, malicious_ratio=0.05, suspicious_ratio=0.05, seed=152):
+        self.verdicts = verdicts or {}
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.queued_for = queued_for
+        self.malicious_ratio = malicious_ratio
+        self.suspicious_ratio = suspicious_ratio
+        self._random = random.Random(seed)
+        self._ids = itertools.count()
+        self._analyses = {}  # analysis id -> (url, submitted at)
+        self._recent = deque()  # request times within the last minute
+        self.requests = 0
+        self.rate_limited = 0
+        self.app = web.Application()
+        self.app.add_routes([web.post(API_PREFIX + "urls", self.submit_url),
+                             web.get(API_PREFIX + "analyses/{id}", self.get_analysis),
+                             web.get("/stats", self.stats)])
+        self._runner = None
+
+    def verdict(self, url):
+        for pattern, verdict in self.verdicts.items():
+            if pattern in url:
+                return verdict
+        bucket = int.from_bytes(hashlib.blake2b(url.encode(), digest_size=4).digest(), "big") / 2 ** 32
+        if bucket < self.malicious_ratio:
+            return "malicious"
+        if bucket < self.malicious_ratio + self.suspicious_ratio:
+            return "suspicious"
+        return "clean"
+
+    async def _before_response(self, request):
+        '''Applies the latency and returns a 429 / 401 response when the request is refused.'''
+        self.requests += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)))
+        if not request.headers.get("x-apikey"):
+            return web.json_response({"error": {"code": "WrongCredentialsError"}}, status=401)
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] > 60:
+            self._recent.popleft()
+        over_limit = self.rate_limit and len(self._recent) >= self.rate_limit
+        if over_limit or self._random.random() < self.error_rate:
+            self.rate_limited += 1
+            retry_after = 60 - (now - self._recent[0]) if over_limit else 1
+            return web.json_response({"error": {"code": "QuotaExceededError"}}, status=429,
+                                     headers={"Retry-After": f"{max(1, round(retry_after))}"})
+        self._recent.append(now)
+        return None
+
+    async def submit_url(self, request):
+        refused = await self._before_response(request)
+        if refused:
+            return refused
+        url = (await request.post()).get("url", "")
+        analysis_id = f"u-{hashlib.sha256(url.encode()).hexdigest()[:16]}-{next(self._ids)}"
+        self._analyses[analysis_id] = (url, time.monotonic())
+        return web.json_response({"data": {"type": "analysis", "id": analysis_id}})
+
+    async def get_analysis(self, request):
+        refused = await self._before_response(request)
+        if refused:
+            return refused
+        analysis_id = request.match_info["id"]
+        if analysis_id not in self._analyses:
+            return web.json_response({"error": {"code": "NotFoundError"}}, status=404)
+        url, submitted_at = self._analyses[analysis_id]
+        if time.monotonic() - submitted_at < self.queued_for:
+            attributes = {"status": "queued", "stats": QUEUED_STATS}
+        else:
+            attributes = {"status": "completed", "stats": VERDICT_STATS[self.verdict(url)]}
+        return web.json_response({"data": {"type": "analysis", "id": analysis_id, "attributes": attributes}})
+
+    async def stats(self, request):
+        return web.json_response({"requests": self.requests, "rate_limited": self.rate_limited,
+                                  "analyses": len(self._analyses)})
+
+    async def start(self, host="127.0.0.1", port=0):
+        '''Serves in the running event loop and returns the endpoint to configure the bot with.'''
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}{API_PREFIX}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+        self._runner = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the VirusTotal url scan API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--verdicts", default=None, help="JSON file mapping url substrings to verdicts")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean seconds per response")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, default=0, help="requests per minute, 0 for unlimited")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument("--queued-for", type=float, default=0.0, help="seconds analyses stay queued")
+    parser.add_argument("--malicious-ratio", type=float, default=0.05)
+    parser.add_argument("--suspicious-ratio", type=float, default=0.05)
+    args = parser.parse_args()
+
+    verdicts = None
+    if args.verdicts:
+        with open(args.verdicts) as f:
+            verdicts = json.load(f)
+    server = FakeVirusTotal(verdicts, latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit,
+                            error_rate=args.error_rate, queued_for=args.queued_for,
+                            malicious_ratio=args.malicious_ratio, suspicious_ratio=args.suspicious_ratio)
+    print(f"Fake VirusTotal listening on http://{args.host}:{args.port}{API_PREFIX}")
+    web.run_app(server.app, host=args.host, port=args.port, print=None)
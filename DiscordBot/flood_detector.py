@@ -0,0 +1,139 @@
+'''
+Sliding-window message rates per author and per channel, checked before the moderation pipeline
+so a flood does not turn into one full evaluation (and link scan) per message:
+
+    flood   one account posting faster than AUTHOR_LIMIT messages in AUTHOR_WINDOW_SECONDS
+    raid    more than RAID_LIMIT newcomers posting in one channel within RAID_WINDOW_SECONDS
+    busy    a channel above CHANNEL_LIMIT messages in CHANNEL_WINDOW_SECONDS
+
+Rates are kept as per-second counts in small ring buffers, only for the most recently active
+authors and channels, so memory stays bounded however many accounts post. A throttled message
+belongs to an incident, which ends once INCIDENT_QUIET_SECONDS pass without one.
+'''
+import time
+from collections import OrderedDict
+
+FLOOD = "flood"
+RAID = "raid"
+BUSY = "busy"
+
+AUTHOR_WINDOW_SECONDS = 10
+AUTHOR_LIMIT = 8
+CHANNEL_WINDOW_SECONDS = 10
+CHANNEL_LIMIT = 50
+RAID_WINDOW_SECONDS = 60
+RAID_LIMIT = 15
+# Accounts that joined the server at most this long ago count as newcomers
+NEWCOMER_SECONDS = 24 * 60 * 60
+INCIDENT_QUIET_SECONDS = 2 * 60
+MAX_AUTHORS = 10000
+MAX_CHANNELS = 1000
+
+
+class RingCounter:
+    '''Events within the last len(counts) seconds, one slot per second reused as time moves on.'''
+    __slots__ = ("counts", "seconds")
+
+    def __init__(self, window):
+        self.counts = [0] * window
+        self.seconds = [0] * window  # the second each slot was last counted for
+
+    def add(self, now):
+        second = int(now)
+        slot = second % len(self.counts)
+        if self.seconds[slot] != second:
+            self.seconds[slot] = second
+            self.counts[slot] = 0
+        self.counts[slot] += 1
+
+    def total(self, now):
+        second = int(now)
+        return sum(count for count, seen in zip(self.counts, self.seconds) if second - seen < len(self.counts))
+
+
+class Incident:
+    def __init__(self, kind, key, now):
+        self.kind = kind
+        self.key = key  # author id for a flood, channel id otherwise
+        self.started_at = now
+        self.last_seen = now
+        self.messages = 0
+        self.authors = set()
+        self.case = None  # mod channel case collecting the throttled messages, see case_queue.py
+        self.alerted = False
+
+
+class FloodDetector:
+    def __init__(self, author_limit=AUTHOR_LIMIT, author_window=AUTHOR_WINDOW_SECONDS,
+                 channel_limit=CHANNEL_LIMIT, channel_window=CHANNEL_WINDOW_SECONDS,
+                 raid_limit=RAID_LIMIT, raid_window=RAID_WINDOW_SECONDS,
+                 max_authors=MAX_AUTHORS, max_channels=MAX_CHANNELS):
+        self.author_limit = author_limit
+        self.author_window = author_window
+        self.channel_limit = channel_limit
+        self.channel_window = channel_window
+        self.raid_limit = raid_limit
+        self.raid_window = raid_window
+        self.max_authors = max_authors
+        self.max_channels = max_channels
+        self._authors = OrderedDict()  # author id -> RingCounter, least recently active first
+        self._channels = OrderedDict()  # channel id -> (messages RingCounter, newcomers RingCounter)
+        self.incidents = {}  # (kind, key) -> Incident
+
+    @staticmethod
+    def _touch(table, key, factory, limit):
+        entry = table.get(key)
+        if entry is None:
+            while len(table) >= limit:
+                table.popitem(last=False)
+            entry = table[key] = factory()
+        table.move_to_end(key)
+        return entry
+
+    def _newcomer(self, author, now):
+        # a member the detector has not seen post recently who also joined the server recently
+        if author.id in self._authors:
+            return False
+        joined_at = getattr(author, "joined_at", None)
+        if joined_at is None:
+            return True
+        return now - joined_at.timestamp() < NEWCOMER_SECONDS
+
+    def _incident(self, kind, key, author_id, now):
+        incident = self.incidents.get((kind, key))
+        if incident is None:
+            incident = self.incidents[(kind, key)] = Incident(kind, key, now)
+        incident.last_seen = now
+        incident.messages += 1
+        incident.authors.add(author_id)
+        return incident
+
+    def expire(self, now):
+        for key in [key for key, incident in self.incidents.items()
+                    if now - incident.last_seen > INCIDENT_QUIET_SECONDS]:
+            del self.incidents[key]
+
+    def check(self, message, now=None):
+        '''Counts the message and returns the incident it is throttled under, or None.'''
+        now = now or time.time()
+        self.expire(now)
+        author_id, channel_id = message.author.id, message.channel.id
+        newcomer = self._newcomer(message.author, now)
+        author = self._touch(self._authors, author_id, lambda: RingCounter(self.author_window), self.max_authors)
+        author.add(now)
+        messages, newcomers = self._touch(self._channels, channel_id, lambda: (
+            RingCounter(self.channel_window), RingCounter(self.raid_window)), self.max_channels)
+        messages.add(now)
+        if newcomer:
+            newcomers.add(now)
+
+        if author.total(now) > self.author_limit:
+            return self._incident(FLOOD, author_id, author_id, now)
+        raid = self.incidents.get((RAID, channel_id))
+        if newcomer and raid is None and newcomers.total(now) > self.raid_limit:
+            return self._incident(RAID, channel_id, author_id, now)
+        if raid is not None and (newcomer or author_id in raid.authors):
+            return self._incident(RAID, channel_id, author_id, now)
+        if messages.total(now) > self.channel_limit:
+            return self._incident(BUSY, channel_id, author_id, now)
+        return None
@@ -0,0 +1,101 @@
+'''
+Per guild channel routing, read from guild_config.json:
+
+    {
+        "default": {"channels": ["group-{group_num}"], "mod_channel": "group-{group_num}-mod"},
+        "guilds": {
+            "1211760623969370122": {"channels": ["general", "trading"], "mod_channel": "mod-log"}
+        },
+        "legacy_guild_id": "1211760623969370122"
+    }
+
+A guild entry overrides the default key by key, "channels": ["*"] watches every text channel.
+"rules_db" is the sqlite file the guild's community rules and offense counts are kept in, by
+default one shared by all guilds. The file is read again when it changes, so guilds can be added
+or rerouted without restarting the bot.
+
+Rules and offenses from before the bot told guilds apart (in rules.db or fake_db.json) belong to
+the one server it ran in then, "legacy_guild_id". That guild keeps them, every other guild starts
+without rules. Without legacy_guild_id they go to the only guild, when just one is configured or
+connected; otherwise every mod channel is told they are not enforced until it is set.
+'''
+import json
+import os
+import time
+
+from rules_store import RULES_DB
+
+GUILD_CONFIG = "guild_config.json"
+DEFAULT_SETTINGS = {
+    "channels": ["group-{group_num}"],
+    "mod_channel": "group-{group_num}-mod",
+    "rules_db": RULES_DB,
+}
+# How often to look at the file's modification time
+RELOAD_CHECK_SECONDS = 10
+
+
+class GuildSettings:
+    def __init__(self, guild_id, channels, mod_channel, rules_db, legacy=False):
+        self.guild_id = guild_id
+        self.channels = channels
+        self.mod_channel = mod_channel
+        self.rules_db = rules_db
+        self.legacy = legacy  # the guild owning the rules and offenses from before guilds were told apart
+
+    def watches(self, channel_name):
+        return "*" in self.channels or channel_name in self.channels
+
+
+class GuildConfig:
+    def __init__(self, path=GUILD_CONFIG):
+        self.path = path
+        self.version = 0  # bumped whenever the file is read again
+        self._config = {}
+        self._mtime = None
+        self._checked_at = 0
+        self.reload()
+
+    def reload(self):
+        self._checked_at = time.monotonic()
+        mtime = os.path.getmtime(self.path) if os.path.isfile(self.path) else None
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        if mtime is None:
+            self._config = {}
+        else:
+            try:
+                with open(self.path) as f:
+                    self._config = json.load(f)
+            except ValueError as e:
+                # keep routing messages with the last good configuration
+                print(f"Could not read {self.path}", e)
+                return False
+        self.version += 1
+        return True
+
+    def check(self):
+        if time.monotonic() - self._checked_at >= RELOAD_CHECK_SECONDS:
+            self.reload()
+
+    @property
+    def legacy_guild_id(self):
+        guild_id = self._config.get("legacy_guild_id")
+        return str(guild_id) if guild_id else None
+
+    @property
+    def configured_guild_ids(self):
+        return list(self._config.get("guilds", {}))
+
+    def settings(self, guild_id, group_num=None):
+        # layered, a guild entry may repeat any key of the default block
+        values = {**DEFAULT_SETTINGS, **self._config.get("default", {}),
+                  **self._config.get("guilds", {}).get(str(guild_id), {})}
+
+        def expand(value):
+            return value.format(group_num=group_num, guild_id=guild_id)
+
+        return GuildSettings(guild_id, [expand(channel) for channel in values["channels"]],
+                             expand(values["mod_channel"]), expand(values["rules_db"]),
+                             str(guild_id) == self.legacy_guild_id)
@@ -0,0 +1,60 @@
+'''
+Everything the bot keeps for one guild: community rules and offense counts, open cases,
+near-duplicate clusters, message rates and the moderation pipeline scoring against the guild's
+rules. State is built on the first event from a guild and dropped when the bot leaves it, and an
+auto-sharded bot only receives events for the guilds on its shards, so every process holds only
+its own guilds' data.
+
+The scam classifier, url verdict cache and blocklist describe messages and links rather than a
+guild, and stay shared. Bot processes running other shards from the same directory see each
+other's url verdicts and blocklist entries through url_cache.db and blocklist.txt.
+'''
+from case_queue import CaseQueue
+from flood_detector import FloodDetector
+from micro_batcher import MicroBatcher
+from near_duplicates import NearDuplicateIndex
+from pipeline import ModerationPipeline
+from single_flight import SingleFlight
+from user_rules import FAKE_DB, UserRules
+
+
+class GuildState:
+    def __init__(self, client, guild, settings, config_version=0):
+        self.guild = guild
+        self.settings = settings
+        self.config_version = config_version
+        self.user_rules = UserRules(client, store=client.rules_store(settings.rules_db).for_guild(guild.id))
+        if settings.legacy:
+            self.claim_legacy_rules()
+        self.cases = CaseQueue()  # cases waiting for a moderator decision, see case_queue.py
+        self.near_duplicates = NearDuplicateIndex()  # lightly varied copies of flagged messages
+        self.flood_detector = FloodDetector()  # per author and channel message rates
+        self.case_evaluations = SingleFlight()
+        self.cluster_evaluations = SingleFlight()
+        self.warned_no_mod_channel = False  # warn once, not on every message, until the channel exists
+        # messages arriving within a few milliseconds of each other are scored together
+        self.batcher = MicroBatcher(lambda messages: client.score_messages(messages, self.user_rules))
+        self.pipeline = ModerationPipeline(self.batcher.submit, client.scam_classifier, client.virus_total_token)
+
+    @property
+    def mod_channel(self):
+        # looked up every time, the channel may be created or renamed after the bot joined
+        for channel in self.guild.text_channels:
+            if channel.name == self.settings.mod_channel:
+                return channel
+        return None
+
+    def claim_legacy_rules(self):
+        '''
+        Takes over the rules from fake_db.json (imported once) and the ones added before guilds were
+        told apart. Only the server the bot ran in back then should.
+        '''
+        store = self.user_rules.store
+        imported = store.migrate_from_json(FAKE_DB)
+        claimed = store.claim_unassigned()
+        if imported or claimed:
+            self.user_rules.reload_rules()
+            print(f"{self.guild.name} took over the community rules from before guilds were told apart")
+
+    def close(self):
+        self.user_rules.store.close()
@@ -0,0 +1,225 @@
+'''
+In-process counters, gauges and latency histograms for the bot, exposed in the Prometheus text
+format on http://127.0.0.1:<port>/metrics and optionally summarised to the log every few minutes.
+
+Metrics are module level so any module can record into them without a reference to the bot:
+    with STAGE_SECONDS.time(stage="rules"):
+        ...
+    VIRUS_TOTAL_REQUESTS.inc(endpoint="urls", status=200)
+'''
+import asyncio
+import bisect
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+# Seconds. Wide enough for sub-millisecond rule matches and five minute moderator prompts.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536)
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(_key(labels), 0)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Gauge(Counter):
+    '''A value that goes up and down, or is read from a callback when the metrics are rendered.'''
+    kind = "gauge"
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        self.values[_key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn, **labels):
+        self._functions[_key(labels)] = fn
+
+    def samples(self):
+        yield from super().samples()
+        for key, fn in self._functions.items():
+            try:
+                yield self.name, key, fn()
+            except Exception as e:
+                print(f"Could not read gauge {self.name}", e)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.values = {}  # label key -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        series = self.values.get(_key(labels))
+        return sum(series[:-1]) if series else 0
+
+    def quantile(self, q, **labels):
+        '''Upper bound of the bucket holding the q-th quantile, inf if it is past the last bucket.'''
+        series = self.values.get(_key(labels))
+        if not series:
+            return None
+        rank = q * sum(series[:-1])
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        for key, series in self.values.items():
+            seen = 0
+            for bound, count in zip(self.buckets, series):
+                seen += count
+                yield self.name + "_bucket", key + (("le", bound),), seen
+            yield self.name + "_bucket", key + (("le", "+Inf"),), seen + series[-2]
+            yield self.name + "_sum", key, series[-1]
+            yield self.name + "_count", key, seen + series[-2]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        # modules can be imported more than once (e.g. in scoring workers), keep the first
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self._register(Gauge(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        '''One line per series: counters and gauges with their value, histograms with count/p50/p95.'''
+        lines = []
+        for metric in self.metrics.values():
+            if isinstance(metric, Histogram):
+                for key in metric.values:
+                    labels = dict(key)
+                    lines.append(f"{metric.name}{_format_labels(key)} count={metric.count(**labels)} "
+                                 f"p50<={metric.quantile(0.5, **labels)} p95<={metric.quantile(0.95, **labels)}")
+            else:
+                for name, key, value in metric.samples():
+                    lines.append(f"{name}{_format_labels(key)} {value:g}")
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("modbot_stage_seconds", "Time spent in each eval_text pipeline stage")
+EVAL_SECONDS = REGISTRY.histogram("modbot_eval_seconds", "Time for a whole eval_text call")
+SCORING_SECONDS = REGISTRY.histogram("modbot_scoring_seconds",
+                                     "Rule matching and scam classification time per scored batch")
+VIRUS_TOTAL_REQUESTS = REGISTRY.counter("modbot_virus_total_requests_total", "VirusTotal HTTP requests by endpoint and status")
+VIRUS_TOTAL_ERRORS = REGISTRY.counter("modbot_virus_total_errors_total", "Failed VirusTotal checks by kind")
+VIRUS_TOTAL_SECONDS = REGISTRY.histogram("modbot_virus_total_seconds", "Time for a complete VirusTotal check")
+VERDICT_CACHE_LOOKUPS = REGISTRY.counter("modbot_verdict_cache_lookups_total", "Url verdict cache lookups by result")
+VERDICT_CACHE_HIT_RATIO = REGISTRY.gauge("modbot_verdict_cache_hit_ratio", "Share of url verdict lookups served from the cache")
+SCAN_QUEUE_DEPTH = REGISTRY.gauge("modbot_scan_queue_depth", "Link scans waiting for a VirusTotal token")
+SCANS_DROPPED = REGISTRY.gauge("modbot_scans_dropped", "Automated link scans given up on because the queue was full or too slow")
+SCAN_WAIT_SECONDS = REGISTRY.gauge("modbot_scan_wait_seconds", "Time link scans waited in the queue, by statistic (avg or max)")
+ACTIVE_REPORTS = REGISTRY.gauge("modbot_active_reports", "User report sessions in progress")
+REPORT_SESSION_BYTES = REGISTRY.histogram("modbot_report_session_bytes", "Serialized size of a report session when saved",
+                                          buckets=SIZE_BUCKETS)
+REPORT_SESSIONS_BYTES = REGISTRY.gauge("modbot_report_sessions_bytes", "Serialized size of all report sessions held")
+REPORT_SESSIONS_EVICTED = REGISTRY.counter("modbot_report_sessions_evicted_total", "Report sessions dropped by reason")
+GUILD_STATES = REGISTRY.gauge("modbot_guild_states", "Guilds whose rules, cases and caches this process holds")
+PENDING_CASES = REGISTRY.gauge("modbot_pending_cases", "Cases posted to the mod channel waiting for a moderator decision")
+CASE_SECONDS = REGISTRY.histogram("modbot_case_seconds", "Time from posting a case to the moderator decision")
+CASES_MERGED = REGISTRY.counter("modbot_cases_merged_total", "Reports and automated flags merged into an open case")
+NEAR_DUPLICATE_MATCHES = REGISTRY.counter("modbot_near_duplicate_matches_total",
+                                          "Channel messages handled through their near-duplicate cluster, by outcome")
+NEAR_DUPLICATE_CLUSTERS = REGISTRY.gauge("modbot_near_duplicate_clusters", "Near-duplicate clusters in the window")
+THROTTLED_MESSAGES = REGISTRY.counter("modbot_throttled_messages_total",
+                                      "Channel messages handled by the flood detector instead of the full pipeline, by incident kind")
+MOD_CHANNEL_SENDS = REGISTRY.histogram("modbot_mod_channel_send_seconds", "Time to post to the mod channel")
+WAIT_FOR_SECONDS = REGISTRY.histogram("modbot_wait_for_seconds", "Time a prompt waited for its reply, by prompt and outcome")
+
+VERDICT_CACHE_HIT_RATIO.set_function(
+    lambda: VERDICT_CACHE_LOOKUPS.get(result="hit") / max(1, VERDICT_CACHE_LOOKUPS.get(result="hit")
+                                                          + VERDICT_CACHE_LOOKUPS.get(result="miss")))
+
+
+async def serve_metrics(port, host="127.0.0.1", registry=REGISTRY):
+    '''Starts the /metrics endpoint in the running event loop and returns its runner.'''
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.add_routes([web.get("/metrics", handle)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def log_summary(logger, interval, registry=REGISTRY):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("Metrics summary\n" + registry.summary())
@@ -0,0 +1,68 @@
+import asyncio
+import inspect
+
+
+class MicroBatcher:
+    '''
+    Collects items submitted within max_delay seconds (or until max_batch_size are waiting) and
+    hands them to fn as one list. fn returns one result per item, every submitter gets its own.
+    fn may be a plain function or a coroutine function.
+    '''
+
+    def __init__(self, fn, max_batch_size=64, max_delay=0.005):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.batches = 0
+        self.items = 0
+        self._pending = []
+        self._timer = None
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = self.fn([item for item, _ in batch])
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        if inspect.isawaitable(results):
+            asyncio.ensure_future(self._resolve_later(batch, results))
+        else:
+            self._resolve(batch, results)
+
+    async def _resolve_later(self, batch, results):
+        try:
+            results = await results
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        self._resolve(batch, results)
+
+    @staticmethod
+    def _resolve(batch, results):
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _fail(batch, error):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,137 @@
+'''
+Streaming near-duplicate index for channel messages. Scam waves post lightly varied copies of one
+text from many accounts; every copy lands in the same cluster so it is evaluated and moderated once.
+
+Each message gets a MinHash signature over its character shingles. The signature is cut into
+LSH bands and a message is a candidate for every cluster it shares a band with; the candidate whose
+signature agrees on at least SIMILARITY_THRESHOLD of the hashes (the estimated Jaccard similarity
+of the shingle sets) is the match. Clusters not seen for WINDOW_SECONDS are forgotten together
+with their buckets, as are the least recently seen ones past MAX_CLUSTERS.
+'''
+import itertools
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+SHINGLE_SIZE = 5
+# Messages with fewer characters than this are too short to tell copies from coincidences
+MIN_LENGTH = 20
+NUM_HASHES = 64
+# 16 bands of 4 rows: pairs above ~0.5 similarity almost always share a band
+BANDS = 16
+SIMILARITY_THRESHOLD = 0.6
+WINDOW_SECONDS = 60 * 60
+MAX_CLUSTERS = 20000
+# Buckets a cluster claims as varied copies come in, beyond this copies only match existing ones
+MAX_BUCKETS_PER_CLUSTER = 32 * BANDS
+
+_PRIME = (1 << 31) - 1
+
+
+def normalize(text):
+    return " ".join(text.casefold().split())
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    text = normalize(text)
+    return {text[i:i + size] for i in range(max(1, len(text) - size + 1))}
+
+
+class Cluster:
+    '''
+    Near-duplicate messages seen within the window. Until a moderator decides, the case opened for
+    the first flagged copy collects the others; afterwards the decision applies to new copies.
+    '''
+
+    def __init__(self, cluster_id, signature):
+        self.id = cluster_id
+        self.signature = signature  # of the first message, new messages are compared against it
+        self.bucket_keys = []  # LSH buckets pointing at the cluster, dropped with it
+        self.case = None  # open case for the cluster, see case_queue.py
+        self.channel_notice = None
+        self.actions = None  # moderator decision, [] when no action was needed
+        self.last_seen = time.time()
+
+    def judged(self):
+        return self.actions is not None
+
+
+
+class NearDuplicateIndex:
+    def __init__(self, num_hashes=NUM_HASHES, bands=BANDS, threshold=SIMILARITY_THRESHOLD,
+                 window=WINDOW_SECONDS, max_clusters=MAX_CLUSTERS, seed=152):
+        if num_hashes % bands:
+            raise ValueError("num_hashes must be a multiple of bands")
+        self.bands = bands
+        self.threshold = threshold
+        self.window = window
+        self.max_clusters = max_clusters
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, num_hashes, dtype=np.uint64)[:, None]
+        self._b = rng.integers(0, _PRIME, num_hashes, dtype=np.uint64)[:, None]
+        self._ids = itertools.count(1)
+        self.clusters = OrderedDict()  # cluster id -> Cluster, least recently seen first
+        self._buckets = {}  # (band, band hashes) -> cluster id
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def signature(self, text):
+        hashes = np.fromiter((zlib.crc32(s.encode()) % _PRIME for s in shingles(text)), dtype=np.uint64)
+        # a * x + b stays below 2 ** 63 since all three are below 2 ** 31
+        return ((self._a * hashes + self._b) % _PRIME).min(axis=1)
+
+    def _bucket_keys(self, signature):
+        return [(band, rows.tobytes()) for band, rows in enumerate(np.split(signature, self.bands))]
+
+    def expire(self, now=None):
+        # clusters are kept in last seen order, so only the expired ones are looked at
+        cutoff = (now or time.time()) - self.window
+        while self.clusters:
+            cluster = next(iter(self.clusters.values()))
+            if cluster.last_seen > cutoff and len(self.clusters) <= self.max_clusters:
+                break
+            self.clusters.popitem(last=False)
+            for key in cluster.bucket_keys:
+                if self._buckets.get(key) == cluster.id:
+                    del self._buckets[key]
+
+    def _best(self, signature):
+        keys = self._bucket_keys(signature)
+        best, best_similarity = None, self.threshold
+        for cluster_id in {self._buckets[key] for key in keys if key in self._buckets}:
+            cluster = self.clusters.get(cluster_id)
+            if cluster is None:
+                continue
+            similarity = float(np.mean(cluster.signature == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = cluster, similarity
+        return best, keys
+
+    def add(self, message):
+        '''
+        Files the message under its cluster, opening one if it has no near duplicate in the window.
+        Returns the cluster and whether it is new, or (None, False) for messages too short to index.
+        '''
+        if len(normalize(message.content)) < MIN_LENGTH:
+            return None, False
+        self.expire()
+        signature = self.signature(message.content)
+        cluster, keys = self._best(signature)
+        created = cluster is None
+        if created:
+            cluster = Cluster(next(self._ids), signature)
+            self.clusters[cluster.id] = cluster
+        cluster.last_seen = time.time()
+        self.clusters.move_to_end(cluster.id)
+        for key in keys:
+            if len(cluster.bucket_keys) >= MAX_BUCKETS_PER_CLUSTER:
+                break
+            if self._buckets.get(key) not in self.clusters:
+                self._buckets[key] = cluster.id
+                cluster.bucket_keys.append(key)
+        if created:
+            self.expire()
+        return cluster, created
@@ -0,0 +1,115 @@
+import asyncio
+
+from metrics import EVAL_SECONDS, STAGE_SECONDS
+from rate_limiter import PRIORITY_AUTOMATED
+from suspicious_link_detection import get_blocklist, identify_suspicious_links
+from url_extractor import extract_urls
+
+# Order in which eval_text runs its checks. Local stages run one after the other, network stages
+# are started as soon as they are reached and run concurrently with everything after them.
+PIPELINE_STAGES = ["blocklist", "rules", "classifier", "links"]
+NETWORK_STAGES = {"links"}
+
+
+class Evaluation:
+    def __init__(self, message, priority):
+        self.message = message
+        self.priority = priority
+        self.scores = {}
+        self._urls = None
+        self._local = None
+
+    @property
+    def urls(self):
+        if self._urls is None:
+            self._urls = extract_urls(self.message)
+        return self._urls
+
+    def merge_links(self, url_scores):
+        merged = dict(self.scores.get('suspicious_link', {}), **url_scores)
+        if -1 in merged.values() or 1 in merged.values():
+            self.scores['suspicious_link'] = merged
+
+
+class ModerationPipeline:
+    '''
+    Runs the checks behind ModBot.eval_text and stops as soon as one of them is decisive:
+    a blocklisted or malicious link, a community rule match or a scam score above the removal
+    threshold. A confidently clean scam score on an automated scan also ends the evaluation
+    before any network check. Every stage merges its result into the scores dict code_format reads.
+    '''
+
+    def __init__(self, score_local, scam_classifier, virus_total_token, stages=PIPELINE_STAGES):
+        self.score_local = score_local  # coroutine returning {"scam_probability", "rules"} for a message
+        self.scam_classifier = scam_classifier
+        self.virus_total_token = virus_total_token
+        self.stages = list(stages)
+        self._stage_functions = {
+            "blocklist": self._blocklist,
+            "rules": self._rules,
+            "classifier": self._classifier,
+            "links": self._links,
+        }
+
+    async def _local_scores(self, evaluation):
+        # rules and classifier are scored together by the batcher / worker pool
+        if evaluation._local is None:
+            evaluation._local = await self.score_local(evaluation.message)
+        return evaluation._local
+
+    async def _blocklist(self, evaluation):
+        blocklist = get_blocklist()
+        hits = {url: 1 for url in evaluation.urls if url in blocklist}
+        evaluation.merge_links(hits)
+        return bool(hits)
+
+    async def _rules(self, evaluation):
+        rules = (await self._local_scores(evaluation))['rules']
+        if rules:
+            evaluation.scores['rules'] = rules
+        return bool(rules)
+
+    async def _classifier(self, evaluation):
+        probability = (await self._local_scores(evaluation))['scam_probability']
+        evaluation.scores['scam'] = self.scam_classifier.verdict(probability)
+        evaluation.scores['scam_probability'] = probability
+        if evaluation.priority == PRIORITY_AUTOMATED and self.scam_classifier.is_confidently_clean(probability):
+            return True
+        return evaluation.scores['scam'] == 1
+
+    async def _links(self, evaluation):
+        urls = [url for url in evaluation.urls if url not in evaluation.scores.get('suspicious_link', {})]
+        if not urls:
+            return False
+        url_scores = await identify_suspicious_links(evaluation.message, self.virus_total_token,
+                                                     evaluation.priority, urls=urls)
+        evaluation.merge_links(url_scores)
+        return 1 in url_scores.values()
+
+    async def _run_stage(self, stage, evaluation):
+        # cancelled network stages are recorded too, up to the moment the early exit stopped them
+        with STAGE_SECONDS.time(stage=stage):
+            return await self._stage_functions[stage](evaluation)
+
+    async def evaluate(self, message, priority=PRIORITY_AUTOMATED, stages=None):
+        with EVAL_SECONDS.time():
+            return await self._evaluate(message, priority, stages)
+
+    async def _evaluate(self, message, priority, stages):
+        evaluation = Evaluation(message, priority)
+        pending = set()
+        try:
+            for stage in stages or self.stages:
+                run = self._run_stage(stage, evaluation)
+                if stage in NETWORK_STAGES:
+                    pending.add(asyncio.ensure_future(run))
+                elif await run:
+                    return evaluation.scores
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if any(task.result() for task in done):
+                    return evaluation.scores
+            return evaluation.scores
+        finally:
+            for task in pending:
+                task.cancel()
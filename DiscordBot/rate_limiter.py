@@ -0,0 +1,132 @@
+import asyncio
+import itertools
+import time
+
+# Lower numbers are scanned first
+PRIORITY_USER_REPORT = 0
+PRIORITY_AUTOMATED = 1
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate  # tokens added per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds):
+        # the upstream told us to back off, stop handing out tokens until then
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self, tokens=1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class ScanScheduler:
+    '''
+    Runs outbound scans through a token bucket, highest priority first. Automated scans are
+    given up on (resolved to None) when the queue is full or they waited longer than max_wait,
+    user reports are always kept.
+    '''
+
+    def __init__(self, bucket, workers=2, max_queue=500, max_wait=120, max_retries=1):
+        self.bucket = bucket
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self._queue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        self._tasks = []
+        self.completed = 0
+        self.dropped = 0
+        self.rate_limited = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+
+    def _ensure_workers(self):
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.ensure_future(self._worker()))
+
+    async def submit(self, fn, *args, priority=PRIORITY_AUTOMATED, cost=1):
+        self._ensure_workers()
+        if priority != PRIORITY_USER_REPORT and self._queue.qsize() >= self.max_queue:
+            self.dropped += 1
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._counter), time.monotonic(), fn, args, cost, future, 0))
+        return await future
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            priority, seq, enqueued_at, fn, args, cost, future, attempt = job
+            if future.done():
+                continue
+            if priority != PRIORITY_USER_REPORT and time.monotonic() - enqueued_at > self.max_wait:
+                self.dropped += 1
+                future.set_result(None)
+                continue
+            await self.bucket.acquire(cost)
+            waited = time.monotonic() - enqueued_at
+            self.total_wait += waited
+            self.max_wait_seen = max(self.max_wait_seen, waited)
+            try:
+                result = await fn(*args)
+            except RateLimited as e:
+                self.rate_limited += 1
+                self.bucket.pause(e.retry_after)
+                if attempt < self.max_retries:
+                    # keep its place at the front of its priority class
+                    self._queue.put_nowait((priority, seq, enqueued_at, fn, args, cost, future, attempt + 1))
+                elif not future.done():
+                    future.set_result(None)
+                continue
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            self.completed += 1
+            if not future.done():
+                future.set_result(result)
+
+    def metrics(self):
+        started = self.completed + self.rate_limited
+        return {
+            "queue_depth": self._queue.qsize(),
+            "completed": self.completed,
+            "dropped": self.dropped,
+            "rate_limited": self.rate_limited,
+            "avg_wait_seconds": self.total_wait / started if started else 0.0,
+            "max_wait_seconds": self.max_wait_seen,
+        }
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
@@ -29,10 +29,41 @@ class Report:
         self.report_reason = None
         self.additional_info = ""
         self.selections = []
+        self.message_ref = None  # (guild, channel, message) ids of a restored report, fetched on its next message
         self.priority = {"Assets Sent": 2, "Personal Information Provided": 2, "Suspicion of Impersonation": 3,
                          "Explicit Content": 3, "Personal/Sensitive Information": 2, "Threat to do Physical Harm": 1,
                          "Suspicious Link": 4, "Imminent Danger": 1, "Other": "TBD"}
 
+    def to_dict(self):
+        message_ref = self.message_ref
+        if self.message is not None:
+            message_ref = [self.message.guild.id, self.message.channel.id, self.message.id]
+        return {"state": self.state.name, "report_reason": self.report_reason, "additional_info": self.additional_info,
+                "selections": list(self.selections), "message": message_ref}
+
+    @classmethod
+    def from_dict(cls, client, data):
+        report = cls(client)
+        report.state = State[data["state"]]
+        report.report_reason = data["report_reason"]
+        report.additional_info = data["additional_info"]
+        report.selections = data["selections"]
+        report.message_ref = data["message"]
+        return report
+
+    async def fetch_message(self, guild_id, channel_id, message_id):
+        '''Returns the message, or None and the reply explaining why it could not be fetched.'''
+        guild = self.client.get_guild(guild_id)
+        if not guild:
+            return None, "I cannot accept reports of messages from guilds that I'm not in. Please have the guild owner add me to the guild and try again."
+        channel = guild.get_channel(channel_id)
+        if not channel:
+            return None, "It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."
+        try:
+            return await channel.fetch_message(message_id), None
+        except discord.errors.NotFound:
+            return None, "It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."
+
     def get_report_view(self):
         options = [
             SelectOption(emoji="📫", label='Blackmail', value='Blackmail',
@@ -160,7 +191,23 @@ class Report:
         if message.content == self.CANCEL_KEYWORD:
             self.state = State.REPORT_COMPLETE
             return [{"response": "Report cancelled."}]
-        
+
+        if self.message is None and self.message_ref:
+            # the report was restored after a restart, only the ids of the reported message were kept
+            self.message, error = await self.fetch_message(*self.message_ref)
+            self.message_ref = None
+            if not self.message:
+                self.state = State.REPORT_COMPLETE
+                return [{"response": "The message you were reporting can no longer be found, please start a new report."}]
+
+        if self.state == State.MESSAGE_IDENTIFIED:
+            # the dropdown still needs an answer, e.g. the one sent before a restart no longer works
+            if self.report_reason == "Blackmail":
+                return [{"response": "Please select the form(s) of blackmail", "view": self.get_blackmail_view()}]
+            if self.report_reason == "Investment Scam":
+                return [{"response": "Please select all that applies", "view": self.get_scam_view()}]
+            return [{"response": "Please select the reason for reporting this message.", "view": self.get_report_view()}]
+
         if self.state == State.REPORT_START:
             reply =  "Thank you for starting the reporting process. "
             reply += "Say `help` at any time for more information.\n\n"
@@ -174,16 +221,9 @@ class Report:
             m = re.search('/(\d+)/(\d+)/(\d+)', message.content)
             if not m:
                 return [{"response": "I'm sorry, I couldn't read that link. Please try again or say `cancel` to cancel."}]
-            guild = self.client.get_guild(int(m.group(1)))
-            if not guild:
-                return [{"response": "I cannot accept reports of messages from guilds that I'm not in. Please have the guild owner add me to the guild and try again."}]
-            channel = guild.get_channel(int(m.group(2)))
-            if not channel:
-                return [{"response": "It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."}]
-            try:
-                message = await channel.fetch_message(int(m.group(3)))
-            except discord.errors.NotFound:
-                return [{"response": "It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."}]
+            message, error = await self.fetch_message(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+            if not message:
+                return [{"response": error}]
 
             # Here we've found the message - it's up to you to decide what to do next!
             self.state = State.MESSAGE_IDENTIFIED
@@ -0,0 +1,134 @@
+from collections import deque
+
+
+def _fold(text):
+    # lowercase without changing the length so match offsets still point into the original text
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return "".join(c if len(c.lower()) != 1 else c.lower() for c in text)
+
+
+def _is_word_char(c):
+    return c.isalnum() or c == "_"
+
+
+class PhraseMatcher:
+    '''
+    Aho-Corasick automaton over the community rule phrases. The trie is updated in place when a
+    phrase is added or removed and the failure links are recomputed lazily on the next match,
+    so a rule change never re-tokenizes the other phrases.
+    '''
+
+    def __init__(self, phrases=(), whole_words=False):
+        self.whole_words = whole_words
+        self._counts = {}  # folded phrase -> number of rules using it
+        self._reset()
+        for phrase in phrases:
+            self.add(phrase)
+
+    def _reset(self):
+        self._goto = [{}]
+        self._length = [0]  # length of the phrase ending at a node, 0 if none does
+        self._fail = [0]
+        self._output = [0]  # nearest node on the failure chain where a phrase ends
+        self._dirty = False
+
+    def _insert(self, key):
+        node = 0
+        for c in key:
+            child = self._goto[node].get(c)
+            if child is None:
+                child = len(self._goto)
+                self._goto[node][c] = child
+                self._goto.append({})
+                self._length.append(0)
+            node = child
+        self._length[node] = len(key)
+        self._dirty = True
+
+    def _find_node(self, key):
+        node = 0
+        for c in key:
+            node = self._goto[node].get(c)
+            if node is None:
+                return None
+        return node
+
+    def add(self, phrase):
+        key = _fold(phrase)
+        if not key:
+            return
+        self._counts[key] = self._counts.get(key, 0) + 1
+        if self._counts[key] == 1:
+            self._insert(key)
+
+    def remove(self, phrase):
+        key = _fold(phrase)
+        if key not in self._counts:
+            return
+        self._counts[key] -= 1
+        if self._counts[key] > 0:
+            return
+        del self._counts[key]
+        self._length[self._find_node(key)] = 0
+        self._dirty = True
+        # too many dead branches left behind by removed phrases, start over from the live ones
+        if len(self._goto) > 2 * sum(len(k) for k in self._counts) + 64:
+            self._reset()
+            for live in self._counts:
+                self._insert(live)
+
+    def _build(self):
+        size = len(self._goto)
+        self._fail = [0] * size
+        self._output = [0] * size
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(c, 0)
+                self._fail[child] = fail
+                self._output[child] = fail if self._length[fail] else self._output[fail]
+                queue.append(child)
+        self._dirty = False
+
+    def _matches(self, folded):
+        goto, fail, length, output = self._goto, self._fail, self._length, self._output
+        node = 0
+        for end, c in enumerate(folded, 1):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            hit = node if length[node] else output[node]
+            while hit:
+                yield end - length[hit], end
+                hit = output[hit]
+
+    def find_spans(self, text):
+        '''Leftmost-longest, non-overlapping (start, end) spans of phrases in text.'''
+        if not self._counts:
+            return []
+        if self._dirty:
+            self._build()
+        candidates = self._matches(_fold(text))
+        if self.whole_words:
+            candidates = ((start, end) for start, end in candidates
+                          if (start == 0 or not _is_word_char(text[start - 1]))
+                          and (end == len(text) or not _is_word_char(text[end])))
+        spans = []
+        last_end = 0
+        for start, end in sorted(candidates, key=lambda span: (span[0], -span[1])):
+            if start >= last_end:
+                spans.append((start, end))
+                last_end = end
+        return spans
+
+    def findall(self, text):
+        return [text[start:end] for start, end in self.find_spans(text)]
+
+    def __len__(self):
+        return len(self._counts)
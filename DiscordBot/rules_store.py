@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import sqlite3
+
+RULES_DB = "rules.db"
+# Seconds to wait for another bot process holding the database lock
+BUSY_TIMEOUT_SECONDS = 10
+# Rows from before guilds were told apart, until the legacy guild claims them (see guild_config.py)
+UNASSIGNED = ""
+
+
+class RulesStore:
+    '''
+    Community rules and offense counts in sqlite, one row per (guild, user, rule) and per guild
+    user offense count, so a change only touches its own row. WAL mode lets readers run during a
+    write. Every rule change bumps the guild's rules version in the meta table within the same
+    transaction, so anything caching rules (e.g. scoring workers) can tell when to reload.
+
+    All guilds share one database; for_guild returns a store limited to one guild that uses the
+    same connection, so the number of open files does not grow with the number of guilds.
+    '''
+
+    def __init__(self, path=RULES_DB, guild_id=UNASSIGNED, connection=None):
+        self.path = path
+        self.guild_id = str(guild_id)
+        self._owns_connection = connection is None
+        if connection is not None:
+            self._conn = connection
+            return
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._upgrade_schema()
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS rules (guild_id TEXT NOT NULL, user_id TEXT NOT NULL, "
+                               "phrase TEXT NOT NULL, PRIMARY KEY (guild_id, user_id, phrase))")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS offenses (guild_id TEXT NOT NULL, user_id TEXT NOT NULL, "
+                               "count INTEGER NOT NULL, PRIMARY KEY (guild_id, user_id))")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _upgrade_schema(self):
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(rules)")]
+        if not columns or "guild_id" in columns:
+            return
+        # a rules.db from before guilds were told apart, its rows stay unassigned
+        self._conn.executescript(f'''
+            BEGIN;
+            ALTER TABLE rules RENAME TO rules_old;
+            ALTER TABLE offenses RENAME TO offenses_old;
+            CREATE TABLE rules (guild_id TEXT NOT NULL, user_id TEXT NOT NULL, phrase TEXT NOT NULL,
+                                PRIMARY KEY (guild_id, user_id, phrase));
+            CREATE TABLE offenses (guild_id TEXT NOT NULL, user_id TEXT NOT NULL, count INTEGER NOT NULL,
+                                   PRIMARY KEY (guild_id, user_id));
+            INSERT INTO rules SELECT '{UNASSIGNED}', user_id, phrase FROM rules_old ORDER BY rowid;
+            INSERT INTO offenses SELECT '{UNASSIGNED}', user_id, count FROM offenses_old;
+            DROP TABLE rules_old;
+            DROP TABLE offenses_old;
+            COMMIT;
+        ''')
+
+    def for_guild(self, guild_id):
+        return RulesStore(self.path, guild_id, self._conn)
+
+    def _bump_rules_version(self):
+        # call inside the transaction that changed the rules
+        self._conn.execute("INSERT INTO meta VALUES (?, '1') "
+                           "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+                           ("rules_version:" + self.guild_id,))
+
+    def rules_version(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", ("rules_version:" + self.guild_id,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def migrated_from_json(self):
+        return self._conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone() is not None
+
+    def migrate_from_json(self, json_path):
+        '''Imports a fake_db.json style file into this guild once. Returns False if it was already imported.'''
+        if self.migrated_from_json():
+            return False
+        db = {}
+        if os.path.isfile(json_path):
+            with open(json_path) as f:
+                db = json.load(f)
+        with self._conn:
+            for user, data in db.items():
+                self._conn.executemany("INSERT OR IGNORE INTO rules VALUES (?, ?, ?)",
+                                       [(self.guild_id, str(user), phrase) for phrase in data.get("rules", [])])
+                if data.get("offenses"):
+                    self._conn.execute("INSERT OR REPLACE INTO offenses VALUES (?, ?, ?)",
+                                       (self.guild_id, str(user), data["offenses"]))
+            self._conn.execute("INSERT INTO meta VALUES ('migrated_from_json', ?)", (json_path,))
+            self._bump_rules_version()
+        return True
+
+    def claim_unassigned(self):
+        '''Moves the rules and offenses from before guilds were told apart into this guild.'''
+        with self._conn:
+            rules = self._conn.execute("UPDATE OR IGNORE rules SET guild_id = ? WHERE guild_id = ?",
+                                       (self.guild_id, UNASSIGNED)).rowcount
+            self._conn.execute("DELETE FROM rules WHERE guild_id = ?", (UNASSIGNED,))
+            offenses = self._conn.execute("INSERT INTO offenses SELECT ?, user_id, count FROM offenses WHERE guild_id = ? "
+                                          "ON CONFLICT (guild_id, user_id) DO UPDATE SET count = count + excluded.count",
+                                          (self.guild_id, UNASSIGNED)).rowcount
+            self._conn.execute("DELETE FROM offenses WHERE guild_id = ?", (UNASSIGNED,))
+            if rules:
+                self._bump_rules_version()
+        return rules + offenses
+
+    def has_unassigned(self):
+        return any(self._conn.execute(f"SELECT 1 FROM {table} WHERE guild_id = ? LIMIT 1", (UNASSIGNED,)).fetchone()
+                   for table in ("rules", "offenses"))
+
+    def get_rules(self, user):
+        rows = self._conn.execute("SELECT phrase FROM rules WHERE guild_id = ? AND user_id = ? ORDER BY rowid",
+                                  (self.guild_id, str(user)))
+        return [phrase for phrase, in rows]
+
+    def get_all_rules(self):
+        rows = self._conn.execute("SELECT phrase FROM rules WHERE guild_id = ? ORDER BY rowid", (self.guild_id,))
+        return [phrase for phrase, in rows]
+
+    def add_rule(self, user, phrase):
+        with self._conn:
+            cursor = self._conn.execute("INSERT OR IGNORE INTO rules VALUES (?, ?, ?)", (self.guild_id, str(user), phrase))
+            if cursor.rowcount > 0:
+                self._bump_rules_version()
+        return cursor.rowcount > 0
+
+    def add_rules(self, user, phrases):
+        with self._conn:
+            cursor = self._conn.executemany("INSERT OR IGNORE INTO rules VALUES (?, ?, ?)",
+                                            [(self.guild_id, str(user), phrase) for phrase in phrases])
+            if cursor.rowcount > 0:
+                self._bump_rules_version()
+
+    def remove_rule(self, user, phrase):
+        with self._conn:
+            cursor = self._conn.execute("DELETE FROM rules WHERE guild_id = ? AND user_id = ? AND phrase = ?",
+                                        (self.guild_id, str(user), phrase))
+            if cursor.rowcount > 0:
+                self._bump_rules_version()
+        return cursor.rowcount > 0
+
+    def get_offenses(self, user):
+        row = self._conn.execute("SELECT count FROM offenses WHERE guild_id = ? AND user_id = ?",
+                                 (self.guild_id, str(user))).fetchone()
+        return row[0] if row else 0
+
+    def increment_offenses(self, user):
+        with self._conn:
+            self._conn.execute("INSERT INTO offenses VALUES (?, ?, 1) "
+                               "ON CONFLICT (guild_id, user_id) DO UPDATE SET count = count + 1",
+                               (self.guild_id, str(user)))
+        return self.get_offenses(user)
+
+    def close(self):
+        # stores for a single guild share the connection of the store they came from
+        if self._owns_connection:
+            self._conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import fake_db.json into the sqlite rules store.")
+    parser.add_argument("--json", default="fake_db.json")
+    parser.add_argument("--db", default=RULES_DB)
+    parser.add_argument("--guild", default=UNASSIGNED, help="guild id to import the rules for")
+    args = parser.parse_args()
+
+    store = RulesStore(args.db, args.guild)
+    if store.migrate_from_json(args.json):
+        print(f"Imported {args.json} into {args.db}")
+    else:
+        print(f"{args.db} was already migrated")
@@ -1,46 +1,308 @@
-import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.model_selection import train_test_split
-from sklearn.naive_bayes import MultinomialNB
-from sklearn.metrics import confusion_matrix, accuracy_score, ConfusionMatrixDisplay
-import matplotlib.pyplot as plt
-import seaborn as sns
+'''
+Crypto scam classifier. Train it offline once, the bot then only loads the saved artifact:
+    python scam_classifier.py train [--data crypto_data.csv] [--plot]
+
+Every run writes models/scam_classifier-<version>.pkl and points models/scam_classifier.json
+(checksum and training metadata) at it. If no artifact exists the bot trains at startup as before.
+
+Moderator verdicts are appended to feedback.csv (include them in the next run with --feedback).
+With a stateless featurizer (the default hashing-char, or hashing) they also update the live
+model right away and the updated model is saved as a new artifact version every few updates,
+keeping the last KEEP_ARTIFACTS versions.
+'''
+import argparse
+import asyncio
+import copy
+import csv
+import hashlib
+import json
+import os
+import pickle
+import time
+from datetime import datetime
+
 import numpy as np
 
+MODEL_DIR = "models"
+MODEL_METADATA = os.path.join(MODEL_DIR, "scam_classifier.json")
+TRAINING_DATA = "crypto_data.csv"
+FEEDBACK_DATA = "feedback.csv"
+
+FEATURIZERS = ["tfidf", "hashing", "hashing-char"]
+# Featurizers that need no fitted vocabulary, so the model can keep learning with partial_fit
+STATELESS_FEATURIZERS = {"hashing", "hashing-char"}
+# Stateless so moderator verdicts keep improving the live model, as accurate as tfidf on crypto_data.csv
+DEFAULT_FEATURIZER = "hashing-char"
+HASHING_FEATURES = 2 ** 18
+SNAPSHOT_EVERY_UPDATES = 25
+SNAPSHOT_INTERVAL_SECONDS = 10 * 60
+# Artifact versions kept on disk, older ones are deleted after each snapshot
+KEEP_ARTIFACTS = 5
+
+# Scam probability bands: remove automatically, queue for moderator review, or ignore.
+# Messages under CLEAN_THRESHOLD are confidently clean and skip the automated link scan.
+REMOVE_THRESHOLD = 0.9
+REVIEW_THRESHOLD = 0.5
+CLEAN_THRESHOLD = 0.1
+
+
+class ArtifactError(Exception):
+    pass
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_vectorizer(featurizer=DEFAULT_FEATURIZER, n_features=HASHING_FEATURES):
+    '''
+    tfidf:        fitted vocabulary, grows with the training data
+    hashing:      word features hashed into n_features float32 columns, no state to fit or share
+    hashing-char: same with character 3-5 grams, more robust to misspellings like "cr.ypto"
+    '''
+    from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
+
+    if featurizer in STATELESS_FEATURIZERS:
+        if featurizer == "hashing-char":
+            tokens = {"analyzer": "char_wb", "ngram_range": (3, 5)}
+        else:
+            tokens = {"stop_words": "english"}
+        # non-negative features so MultinomialNB can consume them
+        return HashingVectorizer(n_features=n_features, alternate_sign=False, norm='l2', dtype=np.float32, **tokens)
+    return TfidfVectorizer(stop_words='english')
+
+
+def train(data_path=TRAINING_DATA, plot=False, featurizer=DEFAULT_FEATURIZER, feedback_path=None, n_features=HASHING_FEATURES):
+    # pandas and sklearn training code are only needed here, not when the bot loads an artifact
+    import pandas as pd
+    import sklearn
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.metrics import accuracy_score, brier_score_loss, confusion_matrix
+    from sklearn.model_selection import cross_val_predict, train_test_split
+    from sklearn.naive_bayes import MultinomialNB
+
+    data = pd.read_csv(data_path)
+    if feedback_path and os.path.isfile(feedback_path):
+        data = pd.concat([data, pd.read_csv(feedback_path)], ignore_index=True)
+    x = data['Message']
+    y = data['Label']
+
+    vectorizer = make_vectorizer(featurizer, n_features)
+    x_train, x_test, y_train, y_test = train_test_split(vectorizer.fit_transform(x), y, test_size=0.3, random_state=79)
+
+    model = MultinomialNB()
+    model.fit(x_train, y_train)
+
+    # Naive Bayes posteriors are pushed towards 0 and 1, so fit a sigmoid (Platt scaling) on the
+    # cross-validated log-odds to turn them into usable probabilities
+    log_proba = cross_val_predict(MultinomialNB(), x_train, y_train, cv=5, method='predict_log_proba')
+    platt = LogisticRegression().fit((log_proba[:, 1] - log_proba[:, 0]).reshape(-1, 1), y_train)
+    calibration = (float(platt.coef_[0][0]), float(platt.intercept_[0]))
+
+    y_pred = model.predict(x_test)
+    cm = confusion_matrix(y_test, y_pred)
+    '''
+    [[13  1]
+     [ 1 15]]
+    '''
+    if plot:
+        plot_confusion_matrix(cm)
+
+    metadata = {
+        "version": datetime.now().strftime("%Y%m%d%H%M%S"),
+        "trained_at": datetime.now().isoformat(timespec="seconds"),
+        "training_data": data_path,
+        "training_data_sha256": _sha256(data_path),
+        "featurizer": featurizer,
+        "hashing_features": n_features if featurizer in STATELESS_FEATURIZERS else None,
+        "num_samples": len(data),
+        "test_accuracy": float(accuracy_score(y_test, y_pred)),
+        "test_brier_score": float(brier_score_loss(y_test, _calibrate(model, calibration, x_test))),
+        "calibration": calibration,
+        "confusion_matrix": cm.tolist(),
+        "sklearn_version": sklearn.__version__,
+    }
+    return vectorizer, model, metadata
+
+
+def _calibrate(model, calibration, features):
+    log_proba = model.predict_log_proba(features)
+    slope, intercept = calibration
+    return 1 / (1 + np.exp(-(slope * (log_proba[:, 1] - log_proba[:, 0]) + intercept)))
+
+
+def plot_confusion_matrix(cm):
+    import matplotlib.pyplot as plt
+    import numpy as np
+    import seaborn as sns
+
+    cm_normalized = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
+    plt.figure(figsize=(8, 6))
+    sns.heatmap(cm_normalized, annot=True, fmt='.2f', annot_kws={"size": 16}, cmap='Blues', xticklabels=['Not Scam', 'Scam'],
+                yticklabels=['Not Scam', 'Scam'])
+    plt.xlabel('Predicted Labels')
+    plt.ylabel('True Labels')
+    plt.title('Classifier Confusion Matrix')
+    plt.show()
+
+
+def save_artifact(vectorizer, model, metadata, metadata_path=MODEL_METADATA):
+    model_dir = os.path.dirname(metadata_path)
+    os.makedirs(model_dir or ".", exist_ok=True)
+    artifact = f"scam_classifier-{metadata['version']}.pkl"
+    artifact_path = os.path.join(model_dir, artifact)
+    with open(artifact_path + ".tmp", "wb") as f:
+        pickle.dump({"vectorizer": vectorizer, "model": model}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(artifact_path + ".tmp", artifact_path)
+
+    metadata = dict(metadata, artifact=artifact, sha256=_sha256(artifact_path))
+    with open(metadata_path + ".tmp", "w") as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(metadata_path + ".tmp", metadata_path)
+    return metadata
+
+
+def prune_artifacts(metadata_path=MODEL_METADATA, keep=KEEP_ARTIFACTS):
+    '''Deletes all but the newest keep artifacts, never the one the metadata points at.'''
+    model_dir = os.path.dirname(metadata_path) or "."
+    with open(metadata_path) as f:
+        current = json.load(f).get("artifact")
+    artifacts = sorted((name for name in os.listdir(model_dir)
+                        if name.startswith("scam_classifier-") and name.endswith(".pkl")),
+                       key=lambda name: os.path.getmtime(os.path.join(model_dir, name)), reverse=True)
+    removed = []
+    for name in artifacts[keep:]:
+        if name == current:
+            continue
+        try:
+            os.remove(os.path.join(model_dir, name))
+            removed.append(name)
+        except OSError as e:
+            print(f"Could not remove old artifact {name}", e)
+    return removed
+
+
+def load_artifact(metadata_path=MODEL_METADATA):
+    with open(metadata_path) as f:
+        metadata = json.load(f)
+    artifact_path = os.path.join(os.path.dirname(metadata_path), metadata["artifact"])
+    if _sha256(artifact_path) != metadata["sha256"]:
+        raise ArtifactError(f"checksum mismatch for {artifact_path}")
+    with open(artifact_path, "rb") as f:
+        artifact = pickle.load(f)
+    return artifact["vectorizer"], artifact["model"], metadata
+
+
 class ScamClassier:
-    def __init__(self):
-        self.vectorizer = TfidfVectorizer(stop_words='english')
-        self.model = self._train()
-
-
-    def _train(self):
-        data = pd.read_csv('crypto_data.csv')
-        x = data['Message']
-        y = data['Label']
-
-        x_train, x_test, y_train, y_test = train_test_split(self.vectorizer.fit_transform(x), y, test_size=0.3, random_state=79)
-
-        model = MultinomialNB()
-        model.fit(x_train, y_train)
-
-        # Calculate confusion matrix
-        # y_pred = model.predict(x_test)
-        # cm = confusion_matrix(y_test, y_pred)
-        # cm_normalized = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
-        #
-        # plt.figure(figsize=(8, 6))
-        # sns.heatmap(cm_normalized, annot=True, fmt='.2f',  annot_kws={"size": 16}, cmap='Blues', xticklabels=['Not Scam', 'Scam'],
-        #             yticklabels=['Not Scam', 'Scam'])
-        # plt.xlabel('Predicted Labels')
-        # plt.ylabel('True Labels')
-        # plt.title('Classifier Confusion Matrix')
-        # plt.show()
+    def __init__(self, metadata_path=MODEL_METADATA, remove_threshold=REMOVE_THRESHOLD,
+                 review_threshold=REVIEW_THRESHOLD, clean_threshold=CLEAN_THRESHOLD):
+        self.remove_threshold = remove_threshold
+        self.review_threshold = review_threshold
+        self.clean_threshold = clean_threshold
+        start = time.perf_counter()
+        try:
+            self.vectorizer, self.model, self.metadata = load_artifact(metadata_path)
+            source = f"artifact version {self.metadata['version']}"
+        except (OSError, KeyError, ArtifactError) as e:
+            print(f"Could not load the scam classifier artifact ({e}), training from {TRAINING_DATA}")
+            self.vectorizer, self.model, self.metadata = train()
+            source = "training"
+        # artifacts from before calibration was added fall back to the raw model probabilities
+        self.calibration = self.metadata.get("calibration", (1.0, 0.0))
+        self.online = self.metadata.get("featurizer") in STATELESS_FEATURIZERS
+        if not self.online:
+            print(f"WARNING: the scam classifier uses the {self.metadata.get('featurizer')} featurizer, moderator verdicts are "
+                  f"only saved to {FEEDBACK_DATA} and will not update the live model. Retrain with "
+                  f"`python scam_classifier.py train --featurizer {DEFAULT_FEATURIZER}` to learn from them.")
+        self.updates_since_snapshot = 0
+        self.last_snapshot = time.monotonic()
+        print(f"Scam classifier ready from {source} in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    def predict_scam(self, message):
+        return self.predict_scam_batch([message])[0]
+
+    def predict_scam_batch(self, messages):
+        # one sparse transform and one model call for the whole batch
+        return self.model.predict(self.vectorizer.transform(messages)).tolist()
+
+    def predict_scam_proba(self, message):
+        return self.predict_scam_proba_batch([message])[0]
+
+    def predict_scam_proba_batch(self, messages):
+        return _calibrate(self.model, self.calibration, self.vectorizer.transform(messages)).tolist()
+
+    def verdict(self, probability):
         '''
-        [[13  1]
-         [ 1 15]]
+        1 = remove automatically, -1 = queue for moderator review, 0 = no action
         '''
+        if probability >= self.remove_threshold:
+            return 1
+        if probability >= self.review_threshold:
+            return -1
+        return 0
 
-        return model
+    def is_confidently_clean(self, probability):
+        return probability < self.clean_threshold
 
-    def predict_scam(self, message):
-        return self.model.predict(self.vectorizer.transform([message]))[0]
+    def learn(self, message, is_scam, feedback_path=FEEDBACK_DATA):
+        '''
+        Records a moderator verdict for the next offline training run and, with a stateless
+        featurizer, updates the live model. The calibration stays as trained until then.
+        '''
+        label = int(is_scam)
+        new_file = not os.path.isfile(feedback_path)
+        with open(feedback_path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(["Message", "Label"])
+            writer.writerow([message, label])
+        if not self.online:
+            return False
+        self.model.partial_fit(self.vectorizer.transform([message]), [label])
+        self.updates_since_snapshot += 1
+        return True
+
+    def snapshot_due(self):
+        if self.updates_since_snapshot == 0:
+            return False
+        return (self.updates_since_snapshot >= SNAPSHOT_EVERY_UPDATES
+                or time.monotonic() - self.last_snapshot >= SNAPSHOT_INTERVAL_SECONDS)
+
+    async def snapshot(self, metadata_path=MODEL_METADATA):
+        '''Saves the incrementally updated model as a new artifact version without blocking the bot.'''
+        model = copy.deepcopy(self.model)
+        metadata = dict(self.metadata,
+                        version=datetime.now().strftime("%Y%m%d%H%M%S"),
+                        trained_at=datetime.now().isoformat(timespec="seconds"),
+                        parent_version=self.metadata.get("version"),
+                        online_updates=self.metadata.get("online_updates", 0) + self.updates_since_snapshot)
+        self.updates_since_snapshot = 0
+        self.last_snapshot = time.monotonic()
+        self.metadata = await asyncio.to_thread(save_artifact, self.vectorizer, model, metadata, metadata_path)
+        # only once the metadata points at the new version, so nothing loads a deleted file
+        await asyncio.to_thread(prune_artifacts, metadata_path)
+        return self.metadata
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline training for the scam classifier.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="train and save a new versioned artifact")
+    train_parser.add_argument("--data", default=TRAINING_DATA)
+    train_parser.add_argument("--output", default=MODEL_METADATA, help="metadata file pointing at the artifact")
+    train_parser.add_argument("--plot", action="store_true", help="show the confusion matrix")
+    train_parser.add_argument("--featurizer", choices=FEATURIZERS, default=DEFAULT_FEATURIZER,
+                              help="the hashing featurizers let the bot keep learning from moderator verdicts")
+    train_parser.add_argument("--hash-features", type=int, default=HASHING_FEATURES,
+                              help="number of hashed feature columns")
+    train_parser.add_argument("--feedback", default=None, help="moderator verdicts to train on as well")
+    args = parser.parse_args()
+
+    vectorizer, model, metadata = train(args.data, plot=args.plot, featurizer=args.featurizer,
+                                        feedback_path=args.feedback, n_features=args.hash_features)
+    metadata = save_artifact(vectorizer, model, metadata, args.output)
+    print(f"Saved {metadata['artifact']} (test accuracy {metadata['test_accuracy']:.3f}, sha256 {metadata['sha256'][:12]})")
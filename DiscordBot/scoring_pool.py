@@ -0,0 +1,67 @@
+'''
+Optional process pool for the CPU bound part of eval_text (rule matching and scam classification),
+so large pastes and message floods do not stall the event loop.
+
+Each worker loads the classifier artifact once and builds a rule matcher per guild.
+Every batch carries its guild's rules store and id with the current rules and model versions; a worker
+that sees a newer version than the one it loaded reloads from the store / artifact before scoring,
+which is how rule changes reach all workers.
+'''
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from rule_matcher import PhraseMatcher
+from rules_store import RulesStore
+from scam_classifier import MODEL_METADATA, ScamClassier
+
+_config = {}
+_classifier = None
+_matchers = {}  # (rules db, guild id) -> (rules version, matcher)
+_model_version = None
+
+
+def _init_worker(metadata_path, whole_words):
+    _config.update(metadata_path=metadata_path, whole_words=whole_words)
+
+
+def _load_rules(rules_db, guild_id, version):
+    store = RulesStore(rules_db, guild_id)
+    try:
+        _matchers[(rules_db, guild_id)] = (version, PhraseMatcher(store.get_all_rules(), whole_words=_config["whole_words"]))
+    finally:
+        store.close()
+
+
+def _load_model(version):
+    global _classifier, _model_version
+    _classifier = ScamClassier(_config["metadata_path"])
+    _model_version = version
+
+
+def score_batch(messages, rules_db, guild_id, rules_version, model_version):
+    if _matchers.get((rules_db, guild_id), (None,))[0] != rules_version:
+        _load_rules(rules_db, guild_id, rules_version)
+    if _classifier is None or model_version != _model_version:
+        _load_model(model_version)
+    matcher = _matchers[(rules_db, guild_id)][1]
+    probabilities = _classifier.predict_scam_proba_batch(messages)
+    return [{"scam_probability": probability, "rules": matcher.findall(message)}
+            for message, probability in zip(messages, probabilities)]
+
+
+class ScoringPool:
+    def __init__(self, workers, metadata_path=MODEL_METADATA, whole_words=False):
+        # spawn so workers never inherit the event loop or the discord connection
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=_init_worker,
+                                             initargs=(metadata_path, whole_words))
+        self.workers = workers
+
+    async def score_batch(self, messages, rules_db, guild_id, rules_version, model_version):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, score_batch, messages, rules_db, guild_id,
+                                          rules_version, model_version)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,121 @@
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+
+from metrics import REPORT_SESSION_BYTES, REPORT_SESSIONS_EVICTED
+
+SESSION_IDLE_SECONDS = 30 * 60
+MAX_SESSIONS = 1000
+# Seconds to wait for another bot process holding the database lock
+BUSY_TIMEOUT_SECONDS = 10
+
+
+class SessionStore:
+    '''
+    In-progress sessions keyed by user id. A session untouched for idle_timeout seconds is dropped
+    and past max_sessions the least recently used one goes first, so abandoned reports (and the
+    discord messages they hold) do not pile up.
+
+    Sessions provide to_dict(); restore(data) builds one back from it. With a path, save() writes
+    the session to sqlite so it survives a restart.
+    '''
+
+    def __init__(self, factory, restore=None, path=None, idle_timeout=SESSION_IDLE_SECONDS, max_sessions=MAX_SESSIONS):
+        self.factory = factory
+        self.restore = restore
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # key -> (session, last used), least recently used first
+        self._footprints = {}  # key -> bytes of the serialized session
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                               "key INTEGER PRIMARY KEY, data TEXT NOT NULL, last_used REAL NOT NULL)")
+            self._load()
+
+    def _load(self):
+        with self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE last_used <= ?", (time.time() - self.idle_timeout,))
+        rows = self._conn.execute("SELECT key, data, last_used FROM sessions ORDER BY last_used DESC LIMIT ?",
+                                  (self.max_sessions,)).fetchall()
+        for key, data, last_used in reversed(rows):
+            try:
+                self._sessions[key] = (self.restore(json.loads(data)), last_used)
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Could not restore session {key}", e)
+                continue
+            self._footprints[key] = len(data)
+
+    def _drop(self, key, reason):
+        self._sessions.pop(key, None)
+        self._footprints.pop(key, None)
+        if self._conn is not None:
+            with self._conn:
+                self._conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+        if reason:
+            REPORT_SESSIONS_EVICTED.inc(reason=reason)
+
+    def evict_expired(self):
+        # least recently used first, so stop at the first session that is still fresh
+        deadline = time.time() - self.idle_timeout
+        expired = 0
+        while self._sessions:
+            key, (session, last_used) = next(iter(self._sessions.items()))
+            if last_used > deadline:
+                break
+            self._drop(key, "idle")
+            expired += 1
+        return expired
+
+    def __contains__(self, key):
+        self.evict_expired()
+        return key in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, key):
+        self.evict_expired()
+        entry = self._sessions.get(key)
+        if entry is None:
+            return None
+        self._sessions[key] = (entry[0], time.time())
+        self._sessions.move_to_end(key)
+        return entry[0]
+
+    def create(self, key):
+        self.evict_expired()
+        while len(self._sessions) >= self.max_sessions:
+            self._drop(next(iter(self._sessions)), "capacity")
+        session = self.factory()
+        self._sessions[key] = (session, time.time())
+        self.save(key)
+        return session
+
+    def save(self, key):
+        entry = self._sessions.get(key)
+        if entry is None:
+            return
+        data = json.dumps(entry[0].to_dict())
+        self._footprints[key] = len(data)
+        REPORT_SESSION_BYTES.observe(len(data))
+        if self._conn is not None:
+            with self._conn:
+                self._conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (key, data, entry[1]))
+
+    def pop(self, key):
+        entry = self._sessions.get(key)
+        self._drop(key, None)
+        return entry[0] if entry else None
+
+    def footprint(self):
+        '''Bytes of serialized state held by all sessions.'''
+        return sum(self._footprints.values())
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = None
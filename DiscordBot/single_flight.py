@@ -0,0 +1,27 @@
+import asyncio
+
+
+class SingleFlight:
+    '''
+    Deduplicates concurrent calls: while a call for a key is running, every other caller
+    with the same key waits on it and receives the same result.
+    '''
+
+    def __init__(self):
+        self._in_flight = {}
+
+    async def do(self, key, fn, *args):
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        # a waiter being cancelled must not cancel the lookup the others share
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+
+    def __len__(self):
+        return len(self._in_flight)
@@ -1,71 +1,252 @@
-import requests
+import asyncio
+import aiohttp
+import os
 import re
 
-internal_blacklist = ["https://in-internal-list-spam.com"]
+from blocklist import DomainBlocklist
+from blocklist_index import BlocklistIndex
+from metrics import (SCAN_QUEUE_DEPTH, SCAN_WAIT_SECONDS, SCANS_DROPPED, VERDICT_CACHE_LOOKUPS, VIRUS_TOTAL_ERRORS,
+                     VIRUS_TOTAL_REQUESTS, VIRUS_TOTAL_SECONDS)
+from rate_limiter import PRIORITY_AUTOMATED, RateLimited, ScanScheduler, TokenBucket
+from single_flight import SingleFlight
+from url_cache import VerdictCache
+from url_extractor import canonicalize_url, extract_urls
 
+VIRUS_TOTAL_BASE_ENDPOINT = "https://www.virustotal.com/api/v3/"
+REQUEST_TIMEOUT_SECONDS = 10
+MAX_CONNECTIONS = 20
+# The public API allows 4 requests a minute, every check is a submission plus an analysis fetch
+VIRUS_TOTAL_REQUESTS_PER_MINUTE = 4
+REQUESTS_PER_CHECK = 2
+DEFAULT_RETRY_AFTER_SECONDS = 60
+# Fresh submissions are often still "queued" on the first analysis fetch, every poll costs a request
+ANALYSIS_POLL_ATTEMPTS = 3
+ANALYSIS_POLL_SECONDS = 15
+# Indexes built from external feeds with `python blocklist_index.py build`
+EXTERNAL_BLOCKLIST_INDEXES = ["blocklist.idx"]
 
-def check_with_virus_total(url, virus_total_token):
-    virus_total_base_endpoint = "https://www.virustotal.com/api/v3/"
+_endpoint = VIRUS_TOTAL_BASE_ENDPOINT
+_session = None
+_verdict_cache = None
+_scheduler = None
+_blocklist = None
+_lookups = SingleFlight()
 
-    payload = {"url": url}
+
+def get_session():
+    # one pooled session for every lookup instead of a new connection per request
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS),
+            connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS))
+    return _session
+
+
+def get_verdict_cache():
+    global _verdict_cache
+    if _verdict_cache is None:
+        _verdict_cache = VerdictCache()
+    return _verdict_cache
+
+
+def get_blocklist():
+    global _blocklist
+    if _blocklist is None:
+        indexes = [BlocklistIndex(path) for path in EXTERNAL_BLOCKLIST_INDEXES if os.path.isfile(path)]
+        _blocklist = DomainBlocklist(indexes=indexes)
+    return _blocklist
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        bucket = TokenBucket(rate=VIRUS_TOTAL_REQUESTS_PER_MINUTE / 60, capacity=VIRUS_TOTAL_REQUESTS_PER_MINUTE)
+        _scheduler = ScanScheduler(bucket)
+    return _scheduler
+
+
+def configure_link_checker(verdict_cache=None, blocklist=None, scheduler=None, endpoint=None):
+    '''
+    Swaps in other components, e.g. isolated ones for benchmarks and load tests. endpoint points
+    the lookups at another VirusTotal compatible API such as fake_virus_total.py.
+    '''
+    global _verdict_cache, _blocklist, _scheduler, _endpoint
+    if endpoint is not None:
+        _endpoint = endpoint if endpoint.endswith("/") else endpoint + "/"
+    if verdict_cache is not None:
+        _verdict_cache = verdict_cache
+    if blocklist is not None:
+        _blocklist = blocklist
+    if scheduler is not None:
+        _scheduler = scheduler
+
+
+def get_scan_metrics():
+    return get_scheduler().metrics()
+
+
+def _scan_metric(name):
+    # read when the metrics are rendered, without starting a scheduler nothing has used yet
+    return _scheduler.metrics()[name] if _scheduler is not None else 0
+
+
+SCAN_QUEUE_DEPTH.set_function(lambda: _scan_metric("queue_depth"))
+SCANS_DROPPED.set_function(lambda: _scan_metric("dropped"))
+SCAN_WAIT_SECONDS.set_function(lambda: _scan_metric("avg_wait_seconds"), stat="avg")
+SCAN_WAIT_SECONDS.set_function(lambda: _scan_metric("max_wait_seconds"), stat="max")
+
+
+async def close_link_checker():
+    global _session, _verdict_cache, _scheduler, _blocklist
+    if _blocklist is not None:
+        _blocklist.close()
+    _blocklist = None
+    if _scheduler is not None:
+        await _scheduler.close()
+    _scheduler = None
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    if _verdict_cache is not None:
+        _verdict_cache.close()
+    _verdict_cache = None
+
+
+def _check_rate_limit(response, endpoint):
+    VIRUS_TOTAL_REQUESTS.inc(endpoint=endpoint, status=response.status)
+    if response.status == 429:
+        retry_after = response.headers.get("Retry-After")
+        raise RateLimited(float(retry_after) if retry_after else DEFAULT_RETRY_AFTER_SECONDS)
+
+
+class QueuedAnalysis:
+    '''What a check returns while VirusTotal is still analysing the url, to be polled again later.'''
+
+    def __init__(self, report_id):
+        self.report_id = report_id
+
+
+async def _get_analysis(session, report_id, virus_total_token):
     headers = {
         "accept": "application/json",
-        "x-apikey": virus_total_token,
-        "content-type": "application/x-www-form-urlencoded"
+        "x-apikey": virus_total_token
     }
+    async with session.get(_endpoint + f"analyses/{report_id}", headers=headers) as response:
+        _check_rate_limit(response, "analyses")
+        response = await response.json()
+    attributes = response.get("data", {}).get("attributes", {})
+    if attributes.get("status", "completed") != "completed":
+        # a queued analysis has all-zero stats
+        return QueuedAnalysis(report_id)
+    return attributes.get("stats")
+
+
+async def _handle_errors(url, coro):
     try:
-        response = requests.post(virus_total_base_endpoint + "urls", data=payload, headers=headers).json()
-        report_id = response.get("data", {}).get("id")
-        headers = {
-            "accept": "application/json",
-            "x-apikey": virus_total_token
-        }
-        response = requests.get(virus_total_base_endpoint + f"analyses/{report_id}", headers=headers).json()
-        return response.get("data", {}).get("attributes", {}).get("stats")
+        return await coro
+    except RateLimited:
+        VIRUS_TOTAL_ERRORS.inc(kind="rate_limited")
+        raise
+    except asyncio.TimeoutError:
+        VIRUS_TOTAL_ERRORS.inc(kind="timeout")
+        print(f"Timed out when checking url={url}")
     except Exception as e:
+        VIRUS_TOTAL_ERRORS.inc(kind="error")
         print(f"An error occurred when checking url={url}", e)
 
 
+async def check_with_virus_total(url, virus_total_token):
+    '''Submits the url and fetches its analysis: the stats, a QueuedAnalysis, or None on errors.'''
+    with VIRUS_TOTAL_SECONDS.time():
+        return await _handle_errors(url, _check_with_virus_total(url, virus_total_token))
+
+
+async def poll_analysis(url, report_id, virus_total_token):
+    return await _handle_errors(url, _get_analysis(get_session(), report_id, virus_total_token))
+
+
+async def _check_with_virus_total(url, virus_total_token):
+    session = get_session()
+    payload = {"url": url}
+    headers = {
+        "accept": "application/json",
+        "x-apikey": virus_total_token,
+        "content-type": "application/x-www-form-urlencoded"
+    }
+    async with session.post(_endpoint + "urls", data=payload, headers=headers) as response:
+        _check_rate_limit(response, "urls")
+        response = await response.json()
+    report_id = response.get("data", {}).get("id")
+    return await _get_analysis(session, report_id, virus_total_token)
+
+
 def get_url_variations(url):
     if not re.match(r'^(http://|https://)', url):
         return ['http://' + url, 'https://' + url]
     return [url]
 
 
-def identify_suspicious_links(message, virus_total_token):
-    url_pattern = re.compile(
-        r'\b((http|https)://)?(www\.)?([a-zA-Z0-9-]+(\.[a-zA-Z]{2,})+)(/[a-zA-Z0-9@:%_\+.~#?&//=,-]*)?\b')
-    matches = url_pattern.finditer(message)
-    urls = [match.group(0) for match in matches]
-    actions_per_url = {}
-    if len(urls) > 0:
-        for url in urls:
-            suspicious = 0
-            num_vendors = 0
-            for u in get_url_variations(url):
-                if u in internal_blacklist:
-                    actions_per_url[url] = 1
-                    break
-                else:
-                    stats = check_with_virus_total(u, virus_total_token)
-                    total = sum(stats.values())
-                    if total != 0:
-                        if stats.get("malicious") >= 2:
-                            internal_blacklist.append(u)
-                            actions_per_url[url] = 1
-                            break
-                        elif stats.get("suspicious")/total > 0.5:
-                            actions_per_url[url] = -1
-                            break
-                        else:
-                            # check other variations before making decision
-                            suspicious += stats.get("suspicious")
-                            num_vendors += total
-            if num_vendors == 0:
-                if url not in actions_per_url:
-                    actions_per_url[url] = -1
-            elif suspicious/num_vendors > 0.5:
-                actions_per_url[url] = -1
+async def _fetch_url_stats(url, virus_total_token, priority):
+    scheduler = get_scheduler()
+    stats = await scheduler.submit(check_with_virus_total, url, virus_total_token,
+                                   priority=priority, cost=REQUESTS_PER_CHECK)
+    for _ in range(ANALYSIS_POLL_ATTEMPTS):
+        if not isinstance(stats, QueuedAnalysis):
+            break
+        # wait outside the scheduler so no scan worker is held, then queue the poll like any other scan
+        await asyncio.sleep(ANALYSIS_POLL_SECONDS)
+        stats = await scheduler.submit(poll_analysis, url, stats.report_id, virus_total_token, priority=priority)
+    if isinstance(stats, QueuedAnalysis):
+        VIRUS_TOTAL_ERRORS.inc(kind="still_queued")
+        print(f"Analysis of url={url} is still queued, leaving it to the moderators")
+        return None
+    if stats:
+        get_verdict_cache().put(url, stats)
+    return stats
+
+
+async def get_url_stats(url, virus_total_token, priority=PRIORITY_AUTOMATED):
+    stats = get_verdict_cache().get(url)
+    VERDICT_CACHE_LOOKUPS.inc(result="miss" if stats is None else "hit")
+    if stats is None:
+        # the same link posted many times at once only costs a single lookup
+        stats = await _lookups.do(canonicalize_url(url), _fetch_url_stats, url, virus_total_token, priority)
+    return stats
+
+
+async def check_url(url, virus_total_token, priority=PRIORITY_AUTOMATED):
+    blocklist = get_blocklist()
+    if url in blocklist:
+        return 1
+    suspicious = 0
+    num_vendors = 0
+    for u in get_url_variations(url):
+        stats = await get_url_stats(u, virus_total_token, priority)
+        if not stats:
+            # lookup failed, timed out or was shed under load, leave the decision to the moderators
+            continue
+        total = sum(stats.values())
+        if total != 0:
+            if stats.get("malicious", 0) >= 2:
+                blocklist.add_url(u)
+                return 1
+            elif stats.get("suspicious", 0)/total > 0.5:
+                return -1
             else:
-                actions_per_url[url] = 0
-    return actions_per_url
+                # check other variations before making decision
+                suspicious += stats.get("suspicious", 0)
+                num_vendors += total
+    if num_vendors == 0 or suspicious/num_vendors > 0.5:
+        return -1
+    return 0
+
+
+async def identify_suspicious_links(message, virus_total_token, priority=PRIORITY_AUTOMATED, urls=None):
+    if urls is None:
+        urls = extract_urls(message)
+    if len(urls) == 0:
+        return {}
+    # every url in the message is looked up at the same time
+    results = await asyncio.gather(*(check_url(url, virus_total_token, priority) for url in urls))
+    return dict(zip(urls, results))
@@ -0,0 +1,135 @@
+'''
+Run from DiscordBot/ with: python -m unittest discover tests
+'''
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from case_queue import AGING_SECONDS, CaseQueue
+
+NOW = 1_700_000_000
+
+
+def make_message(message_id, content=None, author_id=None):
+    author = SimpleNamespace(id=author_id or message_id)
+    return SimpleNamespace(id=message_id, content=content or f"message {message_id}", author=author)
+
+
+def open_at(queue, at, message, priority, reason="Investment Scam", automated=False, **kwargs):
+    with mock.patch("case_queue.time.time", return_value=at):
+        case, _ = queue.open(message, priority, reason, automated, **kwargs)
+    return case
+
+
+class OrderingTest(unittest.TestCase):
+    def test_higher_priority_first(self):
+        queue = CaseQueue()
+        low = open_at(queue, NOW, make_message(1), 4)
+        high = open_at(queue, NOW, make_message(2), 1)
+        middle = open_at(queue, NOW, make_message(3), 2)
+        self.assertIs(queue.peek(), high)
+        self.assertEqual(queue.pending(), [high, middle, low])
+
+    def test_same_priority_oldest_first(self):
+        queue = CaseQueue()
+        older = open_at(queue, NOW - 60, make_message(1), 3)
+        newer = open_at(queue, NOW, make_message(2), 3)
+        self.assertEqual(queue.pending(), [older, newer])
+
+    def test_unknown_priority_last(self):
+        queue = CaseQueue()
+        unknown = open_at(queue, NOW, make_message(1), "TBD", reason="Other")
+        low = open_at(queue, NOW, make_message(2), 4)
+        self.assertEqual(unknown.priority_label(), "TBD")
+        self.assertEqual(queue.pending(), [low, unknown])
+
+
+class AgingTest(unittest.TestCase):
+    def test_waiting_case_is_promoted(self):
+        queue = CaseQueue()
+        # three levels lower but open for more than three aging intervals
+        waiting = open_at(queue, NOW - 3 * AGING_SECONDS - 1, make_message(1), 4)
+        urgent = open_at(queue, NOW, make_message(2), 1)
+        self.assertIs(queue.peek(), waiting)
+        self.assertEqual(queue.pending(), [waiting, urgent])
+
+    def test_not_yet_promoted(self):
+        queue = CaseQueue()
+        waiting = open_at(queue, NOW - 3 * AGING_SECONDS + 1, make_message(1), 4)
+        urgent = open_at(queue, NOW, make_message(2), 1)
+        self.assertEqual(queue.pending(), [urgent, waiting])
+
+    def test_merged_report_raises_priority(self):
+        queue = CaseQueue()
+        first = open_at(queue, NOW, make_message(1), 2)
+        reported = open_at(queue, NOW, make_message(2), 4)
+        self.assertIs(queue.peek(), first)
+        same = open_at(queue, NOW, make_message(2), 1, reason="Imminent Danger", reporter=42)
+        self.assertIs(same, reported)
+        self.assertEqual(reported.priority, 1)
+        self.assertEqual(reported.report_reason, "Investment Scam; Imminent Danger")
+        self.assertIs(queue.peek(), reported)
+
+    def test_lower_priority_report_keeps_position(self):
+        queue = CaseQueue()
+        case = open_at(queue, NOW, make_message(1), 2)
+        open_at(queue, NOW, make_message(1), 4, reporter=42)
+        self.assertEqual(case.priority, 2)
+        self.assertEqual(case.report_count(), 1)
+
+
+class RemovalTest(unittest.TestCase):
+    def test_close_removes_case_and_indexes(self):
+        queue = CaseQueue()
+        case = open_at(queue, NOW, make_message(1, "send btc now"), 3, automated=True)
+        self.assertIs(queue.find(make_message(2, "Send  BTC now"), automated=True), case)
+        self.assertTrue(queue.close(case))
+        self.assertFalse(queue.close(case))
+        self.assertIsNone(queue.peek())
+        self.assertEqual(len(queue), 0)
+        self.assertIsNone(queue.find(make_message(1)))
+        self.assertIsNone(queue.find(make_message(2, "send btc now"), automated=True))
+
+    def test_peek_skips_closed_cases(self):
+        queue = CaseQueue()
+        first = open_at(queue, NOW, make_message(1), 1)
+        second = open_at(queue, NOW, make_message(2), 2)
+        queue.close(first)
+        self.assertIs(queue.peek(), second)
+        self.assertIs(queue.get(second.id), second)
+        self.assertIsNone(queue.get(first.id))
+
+    def test_automated_copies_merge_into_open_case(self):
+        queue = CaseQueue()
+        case = open_at(queue, NOW, make_message(1, "free btc", author_id=10), 3, automated=True)
+        same = open_at(queue, NOW, make_message(2, "FREE btc", author_id=11), 3, automated=True)
+        self.assertIs(same, case)
+        self.assertEqual({author.id for author in case.authors()}, {10, 11})
+        self.assertEqual(case.report_count(), 2)
+
+    def test_open_closes_cases_past_max_age(self):
+        queue = CaseQueue(max_age=3600)
+        stale = open_at(queue, NOW - 7200, make_message(1), 1)
+        fresh = open_at(queue, NOW, make_message(2), 4)
+        self.assertTrue(stale.closed)
+        self.assertEqual(queue.pending(), [fresh])
+
+    def test_open_closes_oldest_at_cap(self):
+        queue = CaseQueue(max_cases=2)
+        oldest = open_at(queue, NOW - 20, make_message(1), 1)
+        older = open_at(queue, NOW - 10, make_message(2), 1)
+        newest = open_at(queue, NOW, make_message(3), 1)
+        self.assertTrue(oldest.closed)
+        self.assertEqual(queue.pending(), [older, newest])
+
+    def test_expire_returns_closed_cases(self):
+        queue = CaseQueue(max_age=3600, max_cases=10)
+        stale = open_at(queue, NOW - 3000, make_message(1), 3)
+        kept = open_at(queue, NOW - 60, make_message(2), 3)
+        with mock.patch("case_queue.time.time", return_value=NOW + 1000):
+            self.assertEqual(queue.expire(now=NOW + 1000), [stale])
+        self.assertEqual(queue.pending(), [kept])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+'''
+Run from DiscordBot/ with: python -m unittest discover tests
+'''
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from near_duplicates import NearDuplicateIndex
+
+NOW = 1_700_000_000
+
+SCAM = "Congrats! You won 0.5 BTC, claim it now at http://free-btc.example before the offer ends"
+COPIES = [
+    "congrats!! you won 0.5 BTC, claim it now at http://free-btc.example before the offer ends",
+    "Congrats! You won 0.5 BTC,  claim it NOW at http://free-btc.example before the offer ends!!",
+    "Congrats! You won 0.5 BTC, claim it now at http://free-btc.example before this offer ends",
+]
+UNRELATED = [
+    "Does anyone know when the next community game night is happening this month?",
+    "I pushed the fix for the login page, can someone review the pull request today",
+    "Reminder that the library closes early on Friday because of the holiday weekend",
+]
+
+
+def add_at(index, at, content):
+    with mock.patch("near_duplicates.time.time", return_value=at):
+        return index.add(SimpleNamespace(content=content))
+
+
+class ClusteringTest(unittest.TestCase):
+    def test_copies_join_one_cluster(self):
+        index = NearDuplicateIndex()
+        cluster, created = add_at(index, NOW, SCAM)
+        self.assertTrue(created)
+        for copy in COPIES:
+            same, created = add_at(index, NOW, copy)
+            self.assertIs(same, cluster)
+            self.assertFalse(created)
+        self.assertEqual(len(index), 1)
+
+    def test_unrelated_messages_get_own_clusters(self):
+        index = NearDuplicateIndex()
+        clusters = [add_at(index, NOW, text)[0] for text in [SCAM] + UNRELATED]
+        self.assertEqual(len({cluster.id for cluster in clusters}), len(clusters))
+        self.assertEqual(len(index), len(clusters))
+
+    def test_short_messages_not_indexed(self):
+        index = NearDuplicateIndex()
+        self.assertEqual(add_at(index, NOW, "gm  everyone"), (None, False))
+        self.assertEqual(len(index), 0)
+
+    def test_same_seed_same_signature(self):
+        first, second = NearDuplicateIndex(), NearDuplicateIndex()
+        self.assertTrue((first.signature(SCAM) == second.signature(SCAM)).all())
+
+
+class ExpiryTest(unittest.TestCase):
+    def test_cluster_forgotten_after_window(self):
+        index = NearDuplicateIndex(window=3600)
+        old, _ = add_at(index, NOW, SCAM)
+        new, created = add_at(index, NOW + 3601, COPIES[0])
+        self.assertTrue(created)
+        self.assertIsNot(new, old)
+        self.assertEqual(list(index.clusters), [new.id])
+        self.assertEqual(set(index._buckets.values()), {new.id})
+
+    def test_copy_within_window_keeps_cluster(self):
+        index = NearDuplicateIndex(window=3600)
+        cluster, _ = add_at(index, NOW, SCAM)
+        add_at(index, NOW + 3000, COPIES[0])
+        same, created = add_at(index, NOW + 6000, COPIES[1])
+        self.assertIs(same, cluster)
+        self.assertFalse(created)
+
+    def test_cap_evicts_least_recently_seen(self):
+        index = NearDuplicateIndex(max_clusters=2)
+        scam, _ = add_at(index, NOW, SCAM)
+        first, _ = add_at(index, NOW + 1, UNRELATED[0])
+        add_at(index, NOW + 2, COPIES[0])  # the scam cluster is now the most recently seen
+        second, _ = add_at(index, NOW + 3, UNRELATED[1])
+        self.assertEqual(list(index.clusters), [scam.id, second.id])
+        self.assertNotIn(first.id, set(index._buckets.values()))
+
+    def test_expire_without_new_messages(self):
+        index = NearDuplicateIndex(window=3600)
+        add_at(index, NOW, SCAM)
+        kept, _ = add_at(index, NOW + 1800, UNRELATED[0])
+        index.expire(now=NOW + 3601)
+        self.assertEqual(list(index.clusters), [kept.id])
+
+
+if __name__ == "__main__":
+    unittest.main()
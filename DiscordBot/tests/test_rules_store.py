@@ -0,0 +1,149 @@
+'''
+Run from DiscordBot/ with: python -m unittest discover tests
+'''
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from rules_store import UNASSIGNED, RulesStore
+
+GUILD = 1001
+OTHER_GUILD = 2002
+
+
+class RulesStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.db_path = os.path.join(tmp.name, "rules.db")
+        self.json_path = os.path.join(tmp.name, "fake_db.json")
+
+    def open_store(self):
+        store = RulesStore(self.db_path)
+        self.addCleanup(store.close)
+        return store
+
+    def write_json(self, db):
+        with open(self.json_path, "w") as f:
+            json.dump(db, f)
+
+
+class SchemaUpgradeTest(RulesStoreTestCase):
+    def create_old_database(self):
+        # the schema before guilds were told apart
+        conn = sqlite3.connect(self.db_path)
+        with conn:
+            conn.execute("CREATE TABLE rules (user_id TEXT NOT NULL, phrase TEXT NOT NULL, PRIMARY KEY (user_id, phrase))")
+            conn.execute("CREATE TABLE offenses (user_id TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.executemany("INSERT INTO rules VALUES (?, ?)", [("1", "free nitro"), ("1", "dm me"), ("2", "airdrop")])
+            conn.execute("INSERT INTO offenses VALUES ('3', 2)")
+            conn.execute("INSERT INTO meta VALUES ('migrated_from_json', 'fake_db.json')")
+        conn.close()
+
+    def test_old_rows_become_unassigned(self):
+        self.create_old_database()
+        store = self.open_store()
+        self.assertTrue(store.has_unassigned())
+        self.assertEqual(store.get_all_rules(), ["free nitro", "dm me", "airdrop"])
+        self.assertEqual(store.get_offenses(3), 2)
+        self.assertTrue(store.migrated_from_json())
+        self.assertEqual(store.for_guild(GUILD).get_all_rules(), [])
+
+    def test_upgrade_runs_once(self):
+        self.create_old_database()
+        self.open_store().for_guild(GUILD).add_rule(4, "gift card")
+        store = self.open_store()
+        self.assertEqual(store.get_all_rules(), ["free nitro", "dm me", "airdrop"])
+        self.assertEqual(store.for_guild(GUILD).get_rules(4), ["gift card"])
+
+    def test_new_database_has_nothing_unassigned(self):
+        store = self.open_store()
+        self.assertFalse(store.has_unassigned())
+        self.assertFalse(store.migrated_from_json())
+
+
+class MigrateFromJsonTest(RulesStoreTestCase):
+    def test_imports_into_guild_once(self):
+        self.write_json({"1": {"rules": ["free nitro", "dm me"], "offenses": 2}, "2": {"rules": ["airdrop"]}})
+        store = self.open_store().for_guild(GUILD)
+        self.assertTrue(store.migrate_from_json(self.json_path))
+        self.assertEqual(store.get_rules(1), ["free nitro", "dm me"])
+        self.assertEqual(store.get_offenses(1), 2)
+        self.assertEqual(store.get_offenses(2), 0)
+        self.assertEqual(store.rules_version(), 1)
+
+        # the import is recorded for the whole database, not per guild
+        other = self.open_store().for_guild(OTHER_GUILD)
+        self.assertTrue(other.migrated_from_json())
+        self.assertFalse(other.migrate_from_json(self.json_path))
+        self.assertEqual(other.get_all_rules(), [])
+
+    def test_missing_file_is_marked_migrated(self):
+        store = self.open_store().for_guild(GUILD)
+        self.assertTrue(store.migrate_from_json(self.json_path))
+        self.assertEqual(store.get_all_rules(), [])
+        self.write_json({"1": {"rules": ["late"]}})
+        self.assertFalse(store.migrate_from_json(self.json_path))
+
+
+class ClaimUnassignedTest(RulesStoreTestCase):
+    def test_claim_moves_rows_and_merges_offenses(self):
+        store = self.open_store()
+        legacy = store.for_guild(UNASSIGNED)
+        legacy.add_rules(1, ["free nitro", "dm me"])
+        legacy.increment_offenses(3)
+        legacy.increment_offenses(3)
+        guild = store.for_guild(GUILD)
+        guild.add_rule(1, "dm me")
+        guild.increment_offenses(3)
+        version = guild.rules_version()
+
+        # "dm me" is already a rule of the guild, so one rule and one offense count move
+        self.assertEqual(guild.claim_unassigned(), 2)
+        self.assertFalse(store.has_unassigned())
+        # claimed rules keep their place before the ones added since
+        self.assertEqual(guild.get_rules(1), ["free nitro", "dm me"])
+        self.assertEqual(guild.get_offenses(3), 3)
+        self.assertEqual(guild.rules_version(), version + 1)
+        self.assertEqual(legacy.get_all_rules(), [])
+        self.assertEqual(legacy.get_offenses(3), 0)
+
+    def test_second_claim_finds_nothing(self):
+        store = self.open_store()
+        store.add_rule(1, "airdrop")
+        guild = store.for_guild(GUILD)
+        self.assertEqual(guild.claim_unassigned(), 1)
+        other = store.for_guild(OTHER_GUILD)
+        self.assertEqual(other.claim_unassigned(), 0)
+        self.assertEqual(other.rules_version(), 0)
+        self.assertEqual(other.get_all_rules(), [])
+        self.assertEqual(guild.get_all_rules(), ["airdrop"])
+
+
+class GuildIsolationTest(RulesStoreTestCase):
+    def test_guilds_do_not_share_rules_or_versions(self):
+        store = self.open_store()
+        guild, other = store.for_guild(GUILD), store.for_guild(OTHER_GUILD)
+        self.assertTrue(guild.add_rule(1, "free nitro"))
+        self.assertFalse(guild.add_rule(1, "free nitro"))
+        other.increment_offenses(1)
+        self.assertEqual(guild.rules_version(), 1)
+        self.assertEqual(other.rules_version(), 0)
+        self.assertEqual(other.get_rules(1), [])
+        self.assertEqual(guild.get_offenses(1), 0)
+        self.assertFalse(other.remove_rule(1, "free nitro"))
+        self.assertTrue(guild.remove_rule(1, "free nitro"))
+        self.assertEqual(guild.rules_version(), 2)
+
+    def test_writes_visible_to_other_connections(self):
+        self.open_store().for_guild(GUILD).add_rule(1, "free nitro")
+        reader = self.open_store().for_guild(GUILD)
+        self.assertEqual(reader.get_all_rules(), ["free nitro"])
+        self.assertEqual(reader.rules_version(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+
+from url_extractor import canonicalize_url
+
+URL_CACHE_DB = "url_cache.db"
+MAX_ENTRIES = 50000
+# Seconds to wait for another bot process holding the database lock
+BUSY_TIMEOUT_SECONDS = 10
+
+# How long (in seconds) a VirusTotal verdict is trusted before the url is scanned again
+VERDICT_TTLS = {
+    "malicious": 7 * 24 * 60 * 60,
+    "suspicious": 6 * 60 * 60,
+    "clean": 24 * 60 * 60,
+    "unknown": 10 * 60,  # no vendor has looked at the url yet
+}
+
+
+def classify_stats(stats):
+    total = sum(stats.values())
+    if total == 0:
+        return "unknown"
+    if stats.get("malicious", 0) >= 2:
+        return "malicious"
+    if stats.get("suspicious", 0) / total > 0.5:
+        return "suspicious"
+    return "clean"
+
+
+class VerdictCache:
+    '''
+    LRU cache of VirusTotal stats keyed by canonical url. Lookups are served from memory,
+    every write goes through to a sqlite file so verdicts survive a restart. Urls missing from
+    memory are looked up in the file too, where bot processes running other shards put theirs.
+    '''
+
+    def __init__(self, path=URL_CACHE_DB, ttls=None, max_entries=MAX_ENTRIES):
+        self.ttls = dict(VERDICT_TTLS, **(ttls or {}))
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # url -> (verdict, stats, expires_at)
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS verdicts ("
+                           "url TEXT PRIMARY KEY, verdict TEXT NOT NULL, stats TEXT NOT NULL, "
+                           "expires_at REAL NOT NULL, updated_at REAL NOT NULL)")
+        self._load()
+
+    def _load(self):
+        now = time.time()
+        with self._conn:
+            self._conn.execute("DELETE FROM verdicts WHERE expires_at <= ?", (now,))
+        rows = self._conn.execute("SELECT url, verdict, stats, expires_at FROM verdicts "
+                                  "ORDER BY updated_at DESC LIMIT ?", (self.max_entries,)).fetchall()
+        for url, verdict, stats, expires_at in reversed(rows):
+            self._entries[url] = (verdict, json.loads(stats), expires_at)
+
+    def get(self, url):
+        key = canonicalize_url(url)
+        entry = self._entries.get(key)
+        if entry is None:
+            row = self._conn.execute("SELECT verdict, stats, expires_at FROM verdicts WHERE url = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            entry = self._entries[key] = (row[0], json.loads(row[1]), row[2])
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if entry[2] <= time.time():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, url, stats):
+        key = canonicalize_url(url)
+        verdict = classify_stats(stats)
+        now = time.time()
+        expires_at = now + self.ttls[verdict]
+        self._entries[key] = (verdict, stats, expires_at)
+        self._entries.move_to_end(key)
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)",
+                               (key, verdict, json.dumps(stats), expires_at, now))
+        while len(self._entries) > self.max_entries:
+            oldest, _ = self._entries.popitem(last=False)
+            with self._conn:
+                self._conn.execute("DELETE FROM verdicts WHERE url = ?", (oldest,))
+        return verdict
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        with self._conn:
+            self._conn.execute("DELETE FROM verdicts WHERE url = ?", (key,))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        self._conn.close()
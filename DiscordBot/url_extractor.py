@@ -0,0 +1,80 @@
+import re
+from urllib.parse import urlsplit
+
+# Common ways scammers defang links so filters miss them: hxxp://, evil[.]com, evil(dot)com
+_OBFUSCATION_PATTERN = re.compile(r'hxxp|\[\.\]|\(\.\)|\{\.\}|\[dot\]|\(dot\)|\{dot\}|\[:\]', re.IGNORECASE)
+_DOT_WORD_PATTERN = re.compile(r'[\[({]dot[\])}]', re.IGNORECASE)
+
+_URL_PATTERN = re.compile(
+    r'(?<![\w@.-])'
+    r'(?:(https?)://)?'
+    r'((?:[^\W_](?:[\w-]{0,61}[^\W_])?\.)+(?:[^\W\d_]{2,63}|xn--[a-z0-9-]{2,59}))'
+    r'(?::(\d{1,5}))?'
+    r'(/[^\s<>"\'`]*)?',
+    re.IGNORECASE)
+
+_DEFAULT_PORTS = {"http": "80", "https": "443"}
+_TRAILING_PUNCTUATION = ".,;:!?)]}'\""
+
+
+def _deobfuscate(match):
+    token = match.group(0).lower()
+    if token == "hxxp":
+        return "http"
+    if token == "[:]":
+        return ":"
+    return "."
+
+
+def _canonical(scheme, host, port, path):
+    scheme = scheme.lower() if scheme else ""
+    host = host.lower().rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    if not host.isascii():
+        try:
+            host = host.encode("idna").decode("ascii")
+        except UnicodeError:
+            return None
+    if port and (port == _DEFAULT_PORTS.get(scheme) or (not scheme and port in _DEFAULT_PORTS.values())):
+        port = None
+    url = f"{scheme}://{host}" if scheme else host
+    if port:
+        url += ":" + port
+    if path:
+        url += path.rstrip("/")
+    return url
+
+
+def canonicalize_url(url):
+    '''Canonical form of a single url: lowercase host without www., punycode, no default port.'''
+    url = _OBFUSCATION_PATTERN.sub(_deobfuscate, url.strip())
+    parts = urlsplit(url if "://" in url else "//" + url)
+    if not parts.hostname:
+        return url
+    path = parts.path
+    if parts.query:
+        path += "?" + parts.query
+    port = str(parts.port) if parts.port else None
+    return _canonical(parts.scheme, parts.hostname, port, path) or url
+
+
+def extract_urls(message):
+    '''
+    Returns the canonical form of every url in the message in order of appearance, without duplicates.
+    Urls without a scheme are kept without one.
+    '''
+    # fast reject: a host needs a dot, most chat messages have none
+    if "." not in message and not _DOT_WORD_PATTERN.search(message):
+        return []
+    message = _OBFUSCATION_PATTERN.sub(_deobfuscate, message)
+
+    urls = {}
+    for match in _URL_PATTERN.finditer(message):
+        scheme, host, port, path = match.groups()
+        if path:
+            path = path.rstrip(_TRAILING_PUNCTUATION)
+        url = _canonical(scheme, host, port, path)
+        if url:
+            urls[url] = None
+    return list(urls)
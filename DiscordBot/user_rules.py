@@ -1,11 +1,13 @@
-import re
 from enum import Enum, auto
-import json
 
 from discord.components import SelectOption
 from discord.ui import Select, View
 
-FAKE_DB = "fake_db.json"
+from rule_matcher import PhraseMatcher
+from rules_store import RulesStore
+
+FAKE_DB = "fake_db.json"  # imported into the rules store the first time the bot starts
+MATCH_WHOLE_WORDS = False  # when True, "cash" no longer matches inside "cashback"
 
 
 class State(Enum):
@@ -23,36 +25,31 @@ class UserRules:
     HELP_KEYWORD = "help"
     CANCEL_KEYWORD = "cancel"
 
-    def __init__(self, client):
+    def __init__(self, client, store=None):
         self.client = client
         self.user = None
-        self._db = self._get_db()
+        if store is None:
+            store = RulesStore()
+            store.migrate_from_json(FAKE_DB)
+        self.store = store
         self.user_flags = None
-        self.flags = self._get_flags()  # flag words from all users (not a good way to do this in real life)
+        # flag words from all users, each counted once per user that has it
+        self.matcher = PhraseMatcher(self._get_all_rules(), whole_words=MATCH_WHOLE_WORDS)
         self.state = State.RULES_SET
 
-    @staticmethod
-    def _get_db() -> dict:
-        with open(FAKE_DB, "r") as f:
-            db = json.load(f)
-
-        return db
-
-    def _write_db(self):
-        with open(FAKE_DB, "w") as f:
-            f.write(json.dumps(self._db, indent=2))
-
-        return True
+    @property
+    def rules_version(self):
+        # kept with the rules, so it survives restarts and is shared by everything using the store
+        return self.store.rules_version()
 
     def _get_flags(self, for_user: bool = False) -> list:
         if for_user:
-            return list(set(self._db.get(self.user, {}).get("rules", [])))  # get rid of duplicates
+            return self.store.get_rules(self.user)
 
-        flags = []
-        for user in self._db.values():
-            flags.extend(user["rules"])
+        return list(set(self._get_all_rules()))  # get rid of duplicates
 
-        return list(set(flags))  # get rid of duplicates
+    def _get_all_rules(self) -> list:
+        return self.store.get_all_rules()
 
     def get_rules_view(self):
         options = [
@@ -106,10 +103,9 @@ class UserRules:
         )
 
         async def callback(interaction):
-            self._db[self.user]["rules"].remove(dropdown.values[0])
-            self._write_db()
+            self.store.remove_rule(self.user, dropdown.values[0])
+            self.matcher.remove(dropdown.values[0])
             self.user_flags = self._get_flags(for_user=True)
-            self.flags = self._get_flags(for_user=False)
             self.state = State.RULES_SET
             await interaction.response.send_message(
                 f"The rule for '{dropdown.values[0]}' has been deleted")
@@ -133,9 +129,9 @@ class UserRules:
 
         async def callback(interaction):
             # for simplicity, just delete the rule and add a new one
-            self._db[self.user]["rules"].remove(dropdown.values[0])
+            self.store.remove_rule(self.user, dropdown.values[0])
+            self.matcher.remove(dropdown.values[0])
             self.user_flags = self._get_flags(for_user=True)
-            self.flags = self._get_flags(for_user=False)
 
             self.state = State.RULE_EDIT
             await interaction.response.send_message(
@@ -164,14 +160,8 @@ class UserRules:
                 self.state = State.RULES_SET
                 return [{"response": f"Rule for '{message.content}' is already in rules."}]
             self.user_flags.append(message.content)
-            if self._db.get(self.user):
-                if self._db[self.user].get("rules"):
-                    self._db[self.user]["rules"].append(message.content)
-                else:
-                    self._db[self.user]["rules"] = [message.content]
-            else:
-                self._db[self.user] = {"rules": [message.content]}
-            self._write_db()
+            if self.store.add_rule(self.user, message.content):
+                self.matcher.add(message.content)
             if self.state == State.RULE_CREATE:
                 response = f"Rule for '{message.content}' created."
             else:
@@ -183,6 +173,10 @@ class UserRules:
     def rules_complete(self) -> bool:
         return self.state == State.RULES_SET
 
+    def reload_rules(self):
+        # after rules were added to the store behind this object's back, e.g. legacy ones claimed
+        self.matcher = PhraseMatcher(self._get_all_rules(), whole_words=MATCH_WHOLE_WORDS)
+
     def update_rules(self, user: str) -> None:
         self.user = str(user)
         self.user_flags = self._get_flags(for_user=True)
@@ -190,32 +184,17 @@ class UserRules:
             self.state = State.RULES_START
 
     def get_rules_scores(self, message: str) -> dict:
-        # Create a regex pattern that matches any of the phrases
-        pattern = '|'.join(re.escape(phrase) for phrase in self.flags)
-        # Search for the pattern in the sentence
-        matches = re.findall(pattern, message, re.IGNORECASE)
+        # Single pass over the message with the automaton built from every user's phrases
+        matches = self.matcher.findall(message)
         if matches:
             return {"rules": matches}
         return {}
 
     def get_user_offenses(self, user):
-        user = str(user)
-        if user in self._db:
-            if self._db[user].get("offenses"):
-                return self._db[user].get("offenses")
-            return 0
-        return 0
+        return self.store.get_offenses(user)
 
     def update_user_offenses(self, user):
-        user = str(user)
-        if user in self._db:
-            if self._db[user].get("offenses"):
-                self._db[user]["offenses"] += 1
-            else:
-                self._db[user]["offenses"] = 1
-        else:
-            self._db[user] = {"offenses": 1}
-        self._write_db()
+        return self.store.increment_offenses(user)
 
 
 